@@ -0,0 +1,84 @@
+"""
+Compares the exact cardinality aggregation with approx_cardinality: memory
+held by one aggregation, throughput of add and expire, and estimate error.
+
+    python benchmarks/bench_cardinality.py [--events N] [--window N] [--distinct N]
+
+Values are drawn uniformly from --distinct values, and the window holds the
+last --window events, like an EventWindow of a busy query_key would.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from elastalert_modules.aggregations import make_aggregation  # noqa: E402
+
+
+def feed(aggregation_config, values, window):
+    aggregation = make_aggregation(aggregation_config)
+    for ordinal, value in enumerate(values):
+        aggregation.add(ordinal, value)
+        if ordinal >= window:
+            aggregation.expire(ordinal - window + 1)
+        aggregation.value()
+    return aggregation
+
+
+def run(aggregation_config, values, window):
+    """
+    Returns the final value, the memory held by the aggregation in bytes and
+    the number of events per second. Memory is measured in a separate pass,
+    as tracing allocations slows the aggregation down.
+    """
+    start = time.perf_counter()
+    aggregation = feed(aggregation_config, values, window)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    traced = feed(aggregation_config, values, window)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del traced
+    return aggregation.value(), memory, len(values) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=200000)
+    parser.add_argument('--window', type=int, default=50000)
+    parser.add_argument('--distinct', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    values = ['10.%d.%d.%d' % divmod3(rng.randrange(args.distinct)) for _ in range(args.events)]
+
+    configs = [('cardinality', {'aggregation_type': 'cardinality'})]
+    for precision in (6, 8, 10, 12):
+        configs.append(('approx_cardinality p=%d' % precision,
+                        {'aggregation_type': 'approx_cardinality', 'aggregation_precision': precision}))
+
+    print('%d events, window of %d events, %d possible values' % (args.events, args.window, args.distinct))
+    print('%-26s %12s %12s %14s %8s' % ('aggregation', 'value', 'memory KB', 'events/sec', 'error'))
+    exact = None
+    for name, config in configs:
+        value, memory, throughput = run(config, values, args.window)
+        if exact is None:
+            exact = value
+        print('%-26s %12.0f %12.1f %14.0f %7.2f%%' % (name, value, memory / 1024.0, throughput,
+                                                       100.0 * abs(value - exact) / exact))
+
+
+def divmod3(number):
+    high, low = divmod(number, 256)
+    high, middle = divmod(high, 256)
+    return high, middle, low
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Measures CorrelationRule on synthetic events shaped like those of the
+example rules: events per second, latency of add_data per batch (p50 and
+p99) and peak RSS of the process, for each combination of the scenario,
+window, key count and selectivity parameters.
+
+    python benchmarks/bench_correlation.py [--scenarios NAME ...] [--events N]
+        [--window N ...] [--keys N ...] [--selectivity F ...]
+        [--option NAME=VALUE ...] [--output FILE] [--compare FILE]
+
+--window is the number of events in the window of each query_key, and
+--selectivity the fraction of events that can match a position. Each
+combination runs in its own process, so that the peak RSS is its own, and
+the events are fed in batches of --batch-size, with a garbage_collect after
+each batch, like ElastAlert2 does with the results of its queries.
+
+ElastAlert2 is used if it is installed, unless --stub is given, otherwise
+the stand-in of elastalert_stub.py, so the benchmark also runs offline.
+--output saves the results as JSON, and --compare prints the change from
+the results of a previous run.
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+from generators import SCENARIOS, generate_batches, load_rule  # noqa: E402
+
+
+def import_rule_class(stub):
+    """
+    Imports CorrelationRule, on the stand-in of ElastAlert2 if stub is set
+    or ElastAlert2 is not installed. Returns the class and whether the
+    stand-in is used.
+    """
+    if not stub:
+        try:
+            import elastalert.ruletypes  # noqa: F401
+        except ImportError:
+            stub = True
+    if stub:
+        import elastalert_stub
+        elastalert_stub.install()
+    from elastalert_modules.custom_rule_types import CorrelationRule
+    return CorrelationRule, stub
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+    return peak / (1024.0 * 1024.0) if sys.platform == 'darwin' else peak / 1024.0
+
+
+def run(params):
+    """
+    Runs one combination of the parameters, in a worker process, and returns
+    its result.
+    """
+    rule_class, stub = import_rule_class(params['stub'])
+    rules = load_rule(params['scenario'])
+    rules.update(params['options'])
+    rule = rule_class(rules)
+    rng = random.Random(params['seed'])
+    latencies = []
+    collect_time = 0.0
+    num_matches = 0
+    for batch in generate_batches(params['scenario'], rng, params['events'], params['keys'], params['window'],
+                                  params['selectivity'], rules['timeframe'], params['batch_size']):
+        start = time.perf_counter()
+        rule.add_data(batch)
+        middle = time.perf_counter()
+        rule.garbage_collect(batch[-1]['@timestamp'])
+        collect_time += time.perf_counter() - middle
+        latencies.append(middle - start)
+        num_matches += len(rule.matches)
+        rule.matches = []
+    latencies.sort()
+    return {
+        'scenario': params['scenario'],
+        'window': params['window'],
+        'keys': params['keys'],
+        'selectivity': params['selectivity'],
+        'events': params['events'],
+        'options': params['options'],
+        'stub': stub,
+        'matches': num_matches,
+        'events_per_sec': params['events'] / (sum(latencies) + collect_time),
+        'add_data_p50_ms': 1000 * percentile(latencies, 0.5),
+        'add_data_p99_ms': 1000 * percentile(latencies, 0.99),
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def get_version():
+    """ Returns the git commit of the repository, to tell the results of versions apart. """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARKS,
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_option(option):
+    """ Parses a NAME=VALUE rule option, VALUE being JSON or a string. """
+    name, _, value = option.partition('=')
+    try:
+        return name, json.loads(value)
+    except ValueError:
+        return name, value
+
+
+def result_id(result):
+    return (result['scenario'], result['window'], result['keys'], result['selectivity'], result['events'],
+            json.dumps(result['options'], sort_keys=True), result['stub'])
+
+
+def compare(results, baseline):
+    """
+    Prints the change of the events per second, p99 latency and peak RSS of
+    each result from the result with the same parameters in baseline.
+    """
+    baseline_results = dict((result_id(result), result) for result in baseline['results'])
+    compared = [(result, baseline_results[result_id(result)]) for result in results
+                if result_id(result) in baseline_results]
+    if not compared:
+        print('\nNo result of %s has the same parameters' % baseline.get('version'))
+        return
+    print('\nChange from %s (%s)' % (baseline.get('version'), baseline.get('date')))
+    print('%-16s %7s %6s %6s %12s %12s %12s' % (
+        'scenario', 'window', 'keys', 'select', 'events/sec', 'p99', 'peak RSS'))
+    for result, previous in compared:
+        print('%-16s %7d %6d %6.2f %+11.1f%% %+11.1f%% %+11.1f%%' % (
+            result['scenario'], result['window'], result['keys'], result['selectivity'],
+            100.0 * (result['events_per_sec'] / previous['events_per_sec'] - 1),
+            100.0 * (result['add_data_p99_ms'] / previous['add_data_p99_ms'] - 1),
+            100.0 * (result['peak_rss_mb'] / previous['peak_rss_mb'] - 1)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=sorted(SCENARIOS))
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--window', type=int, nargs='+', default=[10, 100])
+    parser.add_argument('--keys', type=int, nargs='+', default=[100, 10000])
+    parser.add_argument('--selectivity', type=float, nargs='+', default=[0.1, 0.9])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--option', action='append', default=[], help='rule option, as NAME=VALUE')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stub', action='store_true', help='use the stand-in of ElastAlert2')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--compare', help='JSON file of previous results to compare with')
+    args = parser.parse_args()
+
+    options = dict(parse_option(option) for option in args.option)
+    combinations = [{'scenario': scenario, 'window': window, 'keys': keys, 'selectivity': selectivity,
+                     'events': args.events, 'batch_size': args.batch_size, 'options': options, 'seed': args.seed,
+                     'stub': args.stub}
+                    for scenario, window, keys, selectivity in itertools.product(
+                        args.scenarios, args.window, args.keys, args.selectivity)]
+
+    print('%-16s %7s %6s %6s %8s %12s %9s %9s %10s' % (
+        'scenario', 'window', 'keys', 'select', 'matches', 'events/sec', 'p50 ms', 'p99 ms', 'RSS MB'))
+    results = []
+    # A new process per combination, spawned so that its peak RSS is its own
+    pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+    try:
+        for result in pool.imap(run, combinations):
+            results.append(result)
+            print('%-16s %7d %6d %6.2f %8d %12.0f %9.2f %9.2f %10.1f' % (
+                result['scenario'], result['window'], result['keys'], result['selectivity'], result['matches'],
+                result['events_per_sec'], result['add_data_p50_ms'], result['add_data_p99_ms'],
+                result['peak_rss_mb']))
+    finally:
+        pool.close()
+        pool.join()
+
+    report = {
+        'version': get_version(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'batch_size': args.batch_size,
+        'seed': args.seed,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Stand-in for the parts of ElastAlert2 that elastalert_modules and the
+replay import, so that the benchmarks and replays run without ElastAlert2
+and its dependencies installed.
+RuleType.add_match and the helpers of elastalert.util behave like those of
+ElastAlert2.
+"""
+import copy
+import datetime
+import logging
+import sys
+import types
+
+elastalert_logger = logging.getLogger('elastalert')
+
+
+class EAException(Exception):
+    pass
+
+
+class RuleType(object):
+    required_options = frozenset()
+
+    def __init__(self, rules, args=None):
+        self.matches = []
+        self.rules = rules
+        self.occurrences = {}
+        self.rules['category'] = self.rules.get('category', '')
+        self.rules['description'] = self.rules.get('description', '')
+        self.rules['owner'] = self.rules.get('owner', '')
+        self.rules['priority'] = self.rules.get('priority', '2')
+
+    def add_match(self, event):
+        ts = self.rules.get('timestamp_field')
+        if ts in event:
+            event[ts] = dt_to_ts(event[ts])
+        self.matches.append(copy.deepcopy(event))
+
+    def get_match_str(self, match):
+        return ''
+
+    def garbage_collect(self, timestamp):
+        pass
+
+
+def dt_to_ts(dt):
+    if not isinstance(dt, datetime.datetime):
+        return dt
+    ts = dt.isoformat()
+    if dt.tzinfo is None:
+        return ts + 'Z'
+    return ts.replace('000+00:00', 'Z').replace('+00:00', 'Z')
+
+
+def ts_to_dt(timestamp):
+    if isinstance(timestamp, datetime.datetime):
+        return timestamp
+    dt = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return dt
+
+
+def unix_to_dt(timestamp):
+    return datetime.datetime.fromtimestamp(float(timestamp), tz=datetime.timezone.utc)
+
+
+def unixms_to_dt(timestamp):
+    return unix_to_dt(float(timestamp) / 1000)
+
+
+def hashable(obj):
+    if not obj.__hash__:
+        return str(obj)
+    return obj
+
+
+def lookup_es_key(lookup_dict, term):
+    if term in lookup_dict:
+        return lookup_dict[term]
+    value = lookup_dict
+    for part in term.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def pretty_ts(timestamp, tz=True, ts_format=None):
+    dt = ts_to_dt(timestamp)
+    if tz:
+        dt = dt.astimezone()
+    return dt.strftime(ts_format or '%Y-%m-%d %H:%M %Z')
+
+
+def install():
+    """
+    Registers the elastalert, elastalert.ruletypes and elastalert.util
+    modules, unless elastalert is already imported.
+    """
+    if 'elastalert' in sys.modules:
+        return
+    package = types.ModuleType('elastalert')
+    package.__path__ = []
+    ruletypes = types.ModuleType('elastalert.ruletypes')
+    ruletypes.RuleType = RuleType
+    util = types.ModuleType('elastalert.util')
+    for name in ('EAException', 'dt_to_ts', 'elastalert_logger', 'hashable', 'lookup_es_key', 'pretty_ts',
+                 'ts_to_dt', 'unix_to_dt', 'unixms_to_dt'):
+        setattr(util, name, globals()[name])
+    package.ruletypes = ruletypes
+    package.util = util
+    sys.modules.update({'elastalert': package, 'elastalert.ruletypes': ruletypes, 'elastalert.util': util})
@@ -0,0 +1,111 @@
+"""
+Synthetic events shaped like the events the example rules correlate.
+
+Each scenario has an example rule and a function that returns one event for
+a query_key: with probability selectivity an event that can match a position
+of the rule, otherwise a noise event that matches none. The events are
+spread evenly over time so that the window of each query_key holds about
+window events.
+"""
+import datetime
+import os
+
+import yaml
+
+EXAMPLE_RULES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example_rules')
+START = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def brute_force_event(rng, key, relevant):
+    if relevant and rng.random() < 0.1:
+        result_type, signature = '0', 'SUCCESS'
+    elif relevant:
+        result_type, signature = rng.choice(['50097', '50140', '50126', '0']), 'FAILURE'
+    else:
+        result_type, signature = rng.choice(['50053', '50055', '50057', '50058']), 'FAILURE'
+    return {
+        'user': {'name': key},
+        'resultType': result_type,
+        'resultSignature': signature,
+        'ipAddress': '10.0.%d.%d' % (rng.randrange(256), rng.randrange(256)),
+        'appDisplayName': rng.choice(['Office 365', 'Azure Portal', 'Teams']),
+        'location': {'countryOrRegion': rng.choice(['US', 'GB', 'DE', 'FR', 'NL'])},
+    }
+
+
+def aws_instance_event(rng, key, relevant):
+    if relevant:
+        event_name = rng.choice(['StopInstances', 'ModifyInstanceAttribute', 'StartInstances'])
+    else:
+        event_name = rng.choice(['DescribeInstances', 'GetObject', 'ListBuckets', 'AssumeRole'])
+    return {
+        'userIdentity': {'principalId': key, 'type': 'AssumedRole'},
+        'eventName': event_name,
+        'eventSource': 'ec2.amazonaws.com',
+        'awsRegion': rng.choice(['us-east-1', 'eu-west-1', 'ap-southeast-2']),
+        'sourceIPAddress': '10.1.%d.%d' % (rng.randrange(256), rng.randrange(256)),
+        'requestParameters': {'instancesSet': {'items': [{'instanceId': 'i-%08x' % rng.randrange(1 << 32)}]}},
+    }
+
+
+def failed_attempts_event(rng, key, relevant):
+    if relevant:
+        status = 'success' if rng.random() < 0.1 else 'failed'
+    else:
+        status = rng.choice(['mfa_prompt', 'logout'])
+    return {
+        'source': {'ip': key},
+        'auth': {'status': status, 'method': rng.choice(['password', 'token'])},
+        'user': {'name': 'user%d' % rng.randrange(1000)},
+        'user_agent': {'original': rng.choice(['curl/8.4.0', 'Mozilla/5.0', 'python-requests/2.31'])},
+    }
+
+
+# Example rule and event function of each scenario
+SCENARIOS = {
+    'brute_force': ('brute_force_detection.yaml', brute_force_event),
+    'aws_instance': ('aws_instance_manipulation.yaml', aws_instance_event),
+    'failed_attempts': ('multiple_failed_attempts.yaml', failed_attempts_event),
+}
+
+
+def load_rule(scenario):
+    """
+    Returns the options of the example rule of a scenario, see load_rule_file.
+    """
+    return load_rule_file(os.path.join(EXAMPLE_RULES, SCENARIOS[scenario][0]))
+
+
+def load_rule_file(path):
+    """
+    Returns the options of a rule file, with its timeframe converted to a
+    timedelta like ElastAlert2's rule loader does, and the path of the file
+    in rule_file.
+    """
+    with open(path) as rule_file:
+        rule = yaml.safe_load(rule_file)
+    if 'timeframe' in rule:
+        rule['timeframe'] = datetime.timedelta(**rule['timeframe'])
+    rule['rule_file'] = path
+    return rule
+
+
+def generate_batches(scenario, rng, num_events, num_keys, window, selectivity, timeframe, batch_size):
+    """
+    Yields the events of a scenario in batches of batch_size events, in
+    timestamp order, like the results of the queries of ElastAlert2. The
+    query_keys are drawn uniformly from num_keys values.
+    """
+    make_event = SCENARIOS[scenario][1]
+    interval = timeframe / float(window * num_keys)
+    batch = []
+    for index in range(num_events):
+        event = make_event(rng, 'key%d' % rng.randrange(num_keys), rng.random() < selectivity)
+        event['@timestamp'] = START + index * interval
+        event['_id'] = '%s-%d' % (scenario, index)
+        batch.append(event)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,352 @@
+"""
+Replays events exported from Elasticsearch through a rule, offline, to
+backtest its timeframe, num_events and thresholds without a cluster.
+
+    python benchmarks/replay.py RULE [FILE ...] [--interval SECONDS]
+        [--max-query-size N] [--sort] [--option NAME=VALUE ...]
+        [--matches FILE] [--output FILE] [--stub]
+
+The files hold one JSON document per line (NDJSON), either the _source of
+the events or the hits of a search or scroll (with _id and _source), and
+are read with gzip when they end with .gz, memory-mapped otherwise, or from
+stdin with -. The events are replayed like ElastAlert2 runs the rule: they
+are split into queries of --interval seconds (the run_every of the rule by
+default) of their timestamps, each query is sorted by timestamp and passed
+to add_data in pages of --max-query-size events, and garbage_collect is
+called with the end of the query. The files must be in timestamp order,
+unless --sort is given, which loads all the events first.
+
+The matches are printed, or saved as NDJSON with --matches, along with the
+throughput of the replay. The rule starts empty: its checkpoint_file is
+ignored unless it is given with --option. Rules of type CorrelationRuleGroup
+replay all their rules in one pass, and the matches are counted per rule.
+"""
+import argparse
+import collections
+import datetime
+import gzip
+import json
+import mmap
+import os
+import sys
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, '..'))
+sys.path.insert(0, BENCHMARKS)
+
+from bench_correlation import import_rule_class, parse_option, peak_rss_mb  # noqa: E402
+from generators import load_rule_file  # noqa: E402
+
+# orjson parses JSON several times faster, if it is installed
+loads = orjson.loads if orjson is not None else json.loads
+
+
+def read_lines(path):
+    """
+    Yields the lines of a file as bytes: decompressed if it is gzipped,
+    memory-mapped if it is a regular file, from stdin if path is -.
+    """
+    if path == '-':
+        yield from sys.stdin.buffer
+        return
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as lines:
+            yield from lines
+        return
+    with open(path, 'rb') as lines:
+        if not os.fstat(lines.fileno()).st_size:
+            return
+        with mmap.mmap(lines.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield from iter(mapped.readline, b'')
+
+
+class EventReader(object):
+    """
+    Reads the events of NDJSON files, converting their timestamp to a
+    datetime and tacking the _id and _index of hits into them, like
+    ElastAlert2 does with the hits of its queries. Counts the lines that are
+    not JSON objects and the events without a timestamp, which are skipped.
+    """
+
+    def __init__(self, paths, get_timestamp, set_timestamp, to_datetime):
+        self.paths = paths
+        self.get_timestamp = get_timestamp
+        self.set_timestamp = set_timestamp
+        self.to_datetime = to_datetime
+        self.invalid_lines = 0
+        self.missing_timestamps = 0
+
+    def __iter__(self):
+        for path in self.paths:
+            for line in read_lines(path):
+                if not line.strip():
+                    continue
+                try:
+                    document = loads(line)
+                except ValueError:
+                    self.invalid_lines += 1
+                    continue
+                if not isinstance(document, dict):
+                    self.invalid_lines += 1
+                    continue
+                if isinstance(document.get('_source'), dict):
+                    event = document['_source']
+                    for field in ('_id', '_index'):
+                        if field in document:
+                            event[field] = document[field]
+                else:
+                    event = document
+                timestamp = self.get_timestamp(event)
+                if timestamp is None:
+                    self.missing_timestamps += 1
+                    continue
+                try:
+                    timestamp = self.to_datetime(timestamp)
+                except (ValueError, TypeError, OverflowError):
+                    self.missing_timestamps += 1
+                    continue
+                self.set_timestamp(event, timestamp)
+                yield timestamp, event
+
+
+def make_iso_parser(ts_to_dt):
+    """
+    Returns a function converting ISO 8601 timestamps to datetimes with
+    datetime.fromisoformat, which is much faster than the dateutil parser of
+    ElastAlert2's ts_to_dt, falling back to ts_to_dt for the other formats.
+    Naive timestamps are taken as UTC, like ts_to_dt does.
+    """
+    def to_datetime(timestamp):
+        if not isinstance(timestamp, str):
+            return ts_to_dt(timestamp)
+        try:
+            dt = datetime.datetime.fromisoformat(timestamp)
+        except ValueError:
+            return ts_to_dt(timestamp)
+        return dt if dt.tzinfo is not None else dt.replace(tzinfo=datetime.timezone.utc)
+    return to_datetime
+
+
+def make_timestamp_setter(field):
+    """
+    Returns a function setting a field path of an event, the nested objects
+    of a dotted path being created if the event has no literal key for it.
+    """
+    parts = field.split('.')
+
+    def set_timestamp(event, value):
+        if field in event or len(parts) == 1:
+            event[field] = value
+            return
+        for part in parts[:-1]:
+            event = event.setdefault(part, {})
+        event[parts[-1]] = value
+    return set_timestamp
+
+
+class Replay(object):
+    """
+    Runs a rule over a stream of (timestamp, event) pairs in queries of
+    interval, see the module documentation, and collects the matches and the
+    time spent in the rule.
+    """
+
+    def __init__(self, rule, interval, max_query_size):
+        self.rule = rule
+        self.interval = interval
+        self.max_query_size = max_query_size
+        self.matches = []
+        self.num_events = 0
+        self.num_queries = 0
+        self.num_pages = 0
+        self.late_events = 0
+        self.rule_seconds = 0.0
+        self.first_timestamp = None
+        self.last_timestamp = None
+
+    def run(self, events):
+        query = []
+        query_start = query_end = None
+        for timestamp, event in events:
+            if query_end is None:
+                query_start, query_end = timestamp, timestamp + self.interval
+                self.first_timestamp = timestamp
+            if timestamp >= query_end:
+                self.run_query(query, query_end)
+                query = []
+                # Queries without events only collect garbage, at the end of
+                # the last one before the event
+                skipped = (timestamp - query_end) // self.interval
+                if skipped:
+                    query_end += skipped * self.interval
+                    self.collect(query_end)
+                query_start, query_end = query_end, query_end + self.interval
+            elif timestamp < query_start:
+                # Older than the current query: ElastAlert2 would only see it
+                # if it was indexed late
+                self.late_events += 1
+            query.append((timestamp, event))
+            self.num_events += 1
+        if query:
+            self.run_query(query, query_end)
+
+    def run_query(self, query, end):
+        """
+        Passes the events of a query to the rule, in timestamp order and in
+        pages of max_query_size events, then collects the garbage.
+        """
+        query.sort(key=lambda item: item[0])
+        events = [event for _, event in query]
+        if self.last_timestamp is None or query[-1][0] > self.last_timestamp:
+            self.last_timestamp = query[-1][0]
+        self.num_queries += 1
+        start = time.perf_counter()
+        for page in range(0, len(events), self.max_query_size):
+            self.rule.add_data(events[page:page + self.max_query_size])
+            self.num_pages += 1
+        self.rule_seconds += time.perf_counter() - start
+        self.collect(end)
+
+    def collect(self, end):
+        start = time.perf_counter()
+        self.rule.garbage_collect(end)
+        self.rule_seconds += time.perf_counter() - start
+        # ElastAlert2 pops the matches after each run
+        self.matches.extend(self.rule.matches)
+        self.rule.matches = []
+
+
+def get_rule_metrics(rule):
+    """
+    Returns the metrics of a CorrelationRule, summed over its workers if it
+    has any, or over the rules of a CorrelationRuleGroup, or None for other
+    rules.
+    """
+    from elastalert_modules.metrics import merge_metrics
+    if hasattr(rule, 'correlation_rules'):
+        return merge_metrics(correlation_rule.get_metrics() for correlation_rule in rule.correlation_rules)
+    if not hasattr(rule, 'get_metrics'):
+        return None
+    return rule.get_metrics()
+
+
+def summarize(replay, reader, rule, rules, elapsed):
+    span = (replay.last_timestamp - replay.first_timestamp).total_seconds() if replay.num_events else 0
+    report = {
+        'events': replay.num_events,
+        'invalid_lines': reader.invalid_lines,
+        'missing_timestamps': reader.missing_timestamps,
+        'late_events': replay.late_events,
+        'first_timestamp': replay.first_timestamp.isoformat() if replay.first_timestamp else None,
+        'last_timestamp': replay.last_timestamp.isoformat() if replay.last_timestamp else None,
+        'queries': replay.num_queries,
+        'pages': replay.num_pages,
+        'matches': len(replay.matches),
+        'elapsed_seconds': elapsed,
+        'rule_seconds': replay.rule_seconds,
+        'events_per_sec': replay.num_events / elapsed if elapsed else 0,
+        'rule_events_per_sec': replay.num_events / replay.rule_seconds if replay.rule_seconds else 0,
+        'speedup': span / elapsed if elapsed else 0,
+        'peak_rss_mb': peak_rss_mb(),
+        'metrics': get_rule_metrics(rule),
+    }
+    if rules.get('query_key'):
+        from elastalert_modules.fields import compile_field
+        get_key = compile_field(rules['query_key'])
+        keys = collections.Counter(str(get_key(match)) for match in replay.matches)
+        report['top_query_keys'] = keys.most_common(10)
+    if hasattr(rule, 'correlation_rules'):
+        report['matches_by_rule'] = collections.Counter(match['correlation_rule'] for match in replay.matches)
+    return report
+
+
+def print_report(report, matches, ts_field):
+    for match in matches[:20]:
+        related = match.get('related_events')
+        print('match %s %s%s' % (match.get(ts_field), match.get('_id', ''),
+                                 ' (%d related events)' % len(related) if isinstance(related, list) else ''))
+    if len(matches) > 20:
+        print('... %d more matches' % (len(matches) - 20))
+    print('\n%d events from %s to %s in %d queries (%d pages): %d matches' % (
+        report['events'], report['first_timestamp'], report['last_timestamp'], report['queries'], report['pages'],
+        report['matches']))
+    print('%.1f s, %.0f events/sec (%.0f in the rule), %.0fx real time, peak RSS %.1f MB' % (
+        report['elapsed_seconds'], report['events_per_sec'], report['rule_events_per_sec'], report['speedup'],
+        report['peak_rss_mb']))
+    if report.get('matches_by_rule'):
+        print('matches by rule: %s' % ', '.join('%s (%d)' % item for item in report['matches_by_rule'].most_common()))
+    if report.get('top_query_keys'):
+        print('top query keys: %s' % ', '.join('%s (%d)' % item for item in report['top_query_keys']))
+    if report['invalid_lines']:
+        print('warning: skipped %d lines that are not JSON objects' % report['invalid_lines'])
+    if report['missing_timestamps']:
+        print('warning: skipped %d events without a valid timestamp' % report['missing_timestamps'])
+    if report['late_events']:
+        print('warning: %d events were older than their query, the files are not in timestamp order (see --sort)' %
+              report['late_events'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('rule', help='rule file (YAML)')
+    parser.add_argument('files', nargs='*', default=['-'], help='NDJSON files, .gz for gzipped ones, - for stdin')
+    parser.add_argument('--interval', type=float, help='seconds of events per query (default: run_every or 60)')
+    parser.add_argument('--max-query-size', type=int, default=10000, help='events per add_data call')
+    parser.add_argument('--sort', action='store_true', help='load and sort all the events first')
+    parser.add_argument('--option', action='append', default=[], help='rule option, as NAME=VALUE')
+    parser.add_argument('--stub', action='store_true', help='use the stand-in of ElastAlert2')
+    parser.add_argument('--matches', help='NDJSON file to save the matches to')
+    parser.add_argument('--output', help='JSON file to save the report to')
+    args = parser.parse_args()
+
+    rule_class, _ = import_rule_class(args.stub)
+    from elastalert.util import ts_to_dt, unix_to_dt, unixms_to_dt
+    from elastalert_modules.fields import compile_field
+
+    rules = load_rule_file(args.rule)
+    rules.pop('checkpoint_file', None)
+    rules.update(dict(parse_option(option) for option in args.option))
+    if args.interval:
+        interval = datetime.timedelta(seconds=args.interval)
+    elif isinstance(rules.get('run_every'), dict):
+        interval = datetime.timedelta(**rules['run_every'])
+    else:
+        interval = datetime.timedelta(seconds=60)
+    # Defaults ElastAlert2's rule loader sets
+    ts_field = rules.setdefault('timestamp_field', '@timestamp')
+    rules.setdefault('name', os.path.splitext(os.path.basename(args.rule))[0])
+    to_datetime = {'unix': unix_to_dt, 'unix_ms': unixms_to_dt}.get(rules.get('timestamp_type', 'iso'),
+                                                                    make_iso_parser(ts_to_dt))
+    if str(rules.get('type', '')).endswith('CorrelationRuleGroup'):
+        from elastalert_modules.rule_group import CorrelationRuleGroup as rule_class
+    rule = rule_class(rules)
+
+    reader = EventReader(args.files, compile_field(ts_field), make_timestamp_setter(ts_field), to_datetime)
+    replay = Replay(rule, interval, args.max_query_size)
+    start = time.perf_counter()
+    try:
+        replay.run(sorted(reader, key=lambda item: item[0]) if args.sort else reader)
+        elapsed = time.perf_counter() - start
+        report = summarize(replay, reader, rule, rules, elapsed)
+    finally:
+        if getattr(rule, 'shards', None):
+            rule.shards.shutdown()
+
+    print_report(report, replay.matches, ts_field)
+    if args.matches:
+        with open(args.matches, 'w') as matches_file:
+            for match in replay.matches:
+                matches_file.write(json.dumps(match, default=str) + '\n')
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# Makes the elastalert_modules package importable by the tests when they are
+# run with pytest from the repository root, and provides the builders of the
+# rules and events the tests share.
+import datetime
+
+import pytest
+
+from elastalert_modules.custom_rule_types import CorrelationRule
+
+# Time of the events built with make_event at 0 seconds
+T0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+# Options of the rules built with make_rule, unless overridden
+BASE_RULE = {
+    'name': 'Test Rule',
+    'timestamp_field': '@timestamp',
+    'num_events': 1,
+    'timeframe': datetime.timedelta(minutes=10),
+    'attach_related': False,
+}
+
+
+@pytest.fixture
+def t0():
+    return T0
+
+
+@pytest.fixture
+def rule_options():
+    """
+    Returns a function building the options of a rule, BASE_RULE with the
+    given correlated_events and options.
+    """
+    def build(correlated_events, **options):
+        rules = dict(BASE_RULE, correlated_events=correlated_events)
+        rules.update(options)
+        return rules
+    return build
+
+
+@pytest.fixture
+def make_rule(rule_options):
+    """
+    Returns a function building a CorrelationRule, see rule_options.
+    """
+    def build(correlated_events, **options):
+        return CorrelationRule(rule_options(correlated_events, **options))
+    return build
+
+
+@pytest.fixture
+def make_event():
+    """
+    Returns a function building an event at the given number of seconds
+    after T0, with the given fields.
+    """
+    def build(seconds, **fields):
+        return dict(fields, **{'@timestamp': T0 + datetime.timedelta(seconds=seconds)})
+    return build
+
+
+@pytest.fixture
+def run_batches():
+    """
+    Returns a function passing batches of events to a rule as ElastAlert2
+    does, each followed by garbage_collect at the time of its last event,
+    and returning the matches of the rule. The rule gets copies of the
+    events.
+    """
+    def run(rule, batches):
+        for batch in batches:
+            rule.add_data([dict(event) for event in batch])
+            rule.garbage_collect(max(event['@timestamp'] for event in batch))
+        return rule.matches
+    return run
@@ -0,0 +1,465 @@
+import collections
+import hashlib
+import heapq
+import math
+from array import array
+from functools import partial
+
+from sortedcontainers import SortedList
+
+
+class WindowAggregation(object):
+    """
+    Running aggregation over the events of a window that match the query of
+    an aggregation position.
+
+    Events are added with their ordinal as they enter the window, and expire()
+    retracts the events whose ordinal is below the first live ordinal, so the
+    aggregation always covers the events currently in the window and value()
+    is available in constant time.
+    """
+    # Whether the aggregation reads the aggregation_field of the events
+    uses_field = True
+
+    @classmethod
+    def parse_config(cls, aggregation_config):
+        """
+        Returns the arguments of the aggregations of a correlated event, from
+        its configuration. Raises ValueError if the configuration is invalid.
+        """
+        return {}
+
+    def __init__(self):
+        # (ordinal, value) of the events counted in the aggregation
+        self.events = collections.deque()
+
+    def add(self, ordinal, value):
+        """
+        Adds an event matching the query. Returns True if the event was
+        counted in the aggregation, False if it was ignored (for instance
+        because it has no value for the aggregation field).
+        """
+        if self.uses_field:
+            value = self.convert(value)
+            if value is None:
+                return False
+        self.events.append((ordinal, value))
+        self.insert(value)
+        return True
+
+    def expire(self, first_ordinal):
+        """
+        Retracts the events whose ordinal is lower than first_ordinal.
+        """
+        events = self.events
+        while events and events[0][0] < first_ordinal:
+            self.retract(events.popleft()[1])
+
+    def get_state(self):
+        """
+        Returns the attributes of the aggregation, for checkpoints.
+        """
+        return dict(vars(self))
+
+    def set_state(self, state):
+        self.__dict__.update(state)
+
+    def convert(self, value):
+        """
+        Converts a field value to the value that is aggregated, or returns
+        None if the event should be ignored.
+        """
+        return value
+
+    def insert(self, value):
+        raise NotImplementedError()
+
+    def retract(self, value):
+        raise NotImplementedError()
+
+    def value(self):
+        raise NotImplementedError()
+
+
+def to_number(value):
+    """
+    Returns value as an int or a float, or None if it is not a number. Integers
+    stay integers, so that running sums of counters are exact.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CountAggregation(WindowAggregation):
+    """
+    Number of events matching the query.
+    """
+    uses_field = False
+
+    def __init__(self):
+        super(CountAggregation, self).__init__()
+        self.count = 0
+
+    def insert(self, value):
+        self.count += 1
+
+    def retract(self, value):
+        self.count -= 1
+
+    def value(self):
+        return self.count
+
+
+class CardinalityAggregation(WindowAggregation):
+    """
+    Number of distinct values of the aggregation field, kept as a multiset of
+    value -> number of events in the window having it.
+    """
+
+    def __init__(self):
+        super(CardinalityAggregation, self).__init__()
+        self.value_counts = {}
+
+    def convert(self, value):
+        return None if value is None else str(value)
+
+    def insert(self, value):
+        self.value_counts[value] = self.value_counts.get(value, 0) + 1
+
+    def retract(self, value):
+        count = self.value_counts[value] - 1
+        if count:
+            self.value_counts[value] = count
+        else:
+            del self.value_counts[value]
+
+    def value(self):
+        return len(self.value_counts)
+
+
+class DistinctRatioAggregation(CardinalityAggregation):
+    """
+    Number of distinct values of the aggregation field divided by the number
+    of events having it, from 0 (always the same value) to 1 (all different).
+    """
+
+    def value(self):
+        if not self.events:
+            return 0.0
+        return len(self.value_counts) / float(len(self.events))
+
+
+class SumAggregation(WindowAggregation):
+    """
+    Sum of the numeric values of the aggregation field. Integers are summed
+    exactly. Floats are summed with Neumaier's compensated summation, which
+    keeps the rounding errors of the running total in compensation, so that
+    adding and retracting values for as long as the rule runs does not make
+    the sum drift. The sum restarts from 0 when the window has no value left.
+    """
+
+    def __init__(self):
+        super(SumAggregation, self).__init__()
+        self.total = 0
+        self.compensation = 0.0
+
+    def convert(self, value):
+        return to_number(value)
+
+    def insert(self, value):
+        self.accumulate(value)
+
+    def retract(self, value):
+        if self.events:
+            self.accumulate(-value)
+        else:
+            self.total = 0
+            self.compensation = 0.0
+
+    def accumulate(self, value):
+        total = self.total
+        new_total = total + value
+        if isinstance(new_total, float):
+            if abs(total) >= abs(value):
+                self.compensation += (total - new_total) + value
+            else:
+                self.compensation += (value - new_total) + total
+        self.total = new_total
+
+    def value(self):
+        if self.compensation:
+            return self.total + self.compensation
+        return self.total
+
+
+class AvgAggregation(SumAggregation):
+    """
+    Mean of the numeric values of the aggregation field.
+    """
+
+    def value(self):
+        if not self.events:
+            return 0.0
+        return super(AvgAggregation, self).value() / float(len(self.events))
+
+
+class MaxAggregation(WindowAggregation):
+    """
+    Highest numeric value of the aggregation field, kept with a monotonic
+    deque: values are stored in window order and a new value drops the older
+    ones that are not higher, as they can never be the maximum again. The
+    oldest value is the maximum.
+    """
+
+    def convert(self, value):
+        return to_number(value)
+
+    def add(self, ordinal, value):
+        value = self.convert(value)
+        if value is None:
+            return False
+        events = self.events
+        while events and not self.keeps(events[-1][1], value):
+            events.pop()
+        events.append((ordinal, value))
+        return True
+
+    def expire(self, first_ordinal):
+        events = self.events
+        while events and events[0][0] < first_ordinal:
+            events.popleft()
+
+    def keeps(self, older, newer):
+        return older > newer
+
+    def value(self):
+        return self.events[0][1] if self.events else 0
+
+
+class MinAggregation(MaxAggregation):
+    """
+    Lowest numeric value of the aggregation field, see MaxAggregation.
+    """
+
+    def keeps(self, older, newer):
+        return older < newer
+
+
+class PercentileAggregation(WindowAggregation):
+    """
+    Percentile of the numeric values of the aggregation field, given as
+    aggregation_percentile (0 to 100, default 50). The values are kept in a
+    sorted list, so adding, retracting and reading the percentile cost
+    O(log n). The percentile is interpolated between the closest ranks.
+    """
+
+    @classmethod
+    def parse_config(cls, aggregation_config):
+        percentile = aggregation_config.get('aggregation_percentile', 50)
+        if isinstance(percentile, bool) or not isinstance(percentile, (int, float)) or not 0 <= percentile <= 100:
+            raise ValueError('aggregation_percentile must be between 0 and 100, got %r' % (percentile,))
+        return {'percentile': percentile}
+
+    def __init__(self, percentile=50):
+        super(PercentileAggregation, self).__init__()
+        self.percentile = percentile
+        self.values = SortedList()
+
+    def convert(self, value):
+        return to_number(value)
+
+    def insert(self, value):
+        self.values.add(value)
+
+    def retract(self, value):
+        self.values.remove(value)
+
+    def value(self):
+        values = self.values
+        if not values:
+            return 0
+        rank = (len(values) - 1) * self.percentile / 100.0
+        lower = int(rank)
+        if lower + 1 >= len(values):
+            return values[lower]
+        return values[lower] + (values[lower + 1] - values[lower]) * (rank - lower)
+
+
+class ApproxCardinalityAggregation(WindowAggregation):
+    """
+    Approximate number of distinct values of the aggregation field, using a
+    sliding window HyperLogLog.
+
+    Values are hashed into 2 ** precision registers. Instead of the highest
+    rank seen, each register keeps the entries that can still become its
+    highest rank as older events expire: (ordinal, rank) pairs with ranks
+    decreasing from the oldest entry to the newest one, at most DEPTH of
+    them. The register value is the rank of its oldest entry. Memory is fixed
+    by the precision, about 2 ** precision * (DEPTH * 8 + 40) bytes, however
+    many values or events are aggregated, and the relative standard error is
+    about 1.04 / sqrt(2 ** precision). A register with DEPTH entries that
+    gets a new one drops its newest, see add.
+    """
+    DEPTH = 6
+    DEFAULT_PRECISION = 8
+    MIN_PRECISION = 4
+    MAX_PRECISION = 16
+
+    @classmethod
+    def parse_config(cls, aggregation_config):
+        """
+        Reads aggregation_precision (number of index bits, 4 to 16) or
+        aggregation_error (target relative standard error, e.g. 0.05).
+        """
+        precision = aggregation_config.get('aggregation_precision')
+        error = aggregation_config.get('aggregation_error')
+        if precision is None and error is not None:
+            if not 0 < error < 1:
+                raise ValueError('aggregation_error must be between 0 and 1, got %r' % (error,))
+            precision = max(cls.MIN_PRECISION, int(math.ceil(math.log2((1.04 / error) ** 2))))
+        if precision is None:
+            precision = cls.DEFAULT_PRECISION
+        if not cls.MIN_PRECISION <= precision <= cls.MAX_PRECISION:
+            raise ValueError('aggregation_precision must be between %d and %d, got %r' % (
+                cls.MIN_PRECISION, cls.MAX_PRECISION, precision))
+        return {'precision': precision}
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        # Values are not kept, so the events deque of the base class is unused
+        self.precision = precision
+        self.num_registers = 1 << precision
+        # Register entries packed as ordinal << 8 | rank, DEPTH slots per
+        # register, oldest entry first
+        self.slots = array('Q', bytes(8 * self.DEPTH * self.num_registers))
+        self.depths = bytearray(self.num_registers)
+        # Min-heap of ordinal << precision | register, one item per non-empty
+        # register, with an ordinal no greater than that of its oldest entry
+        self.expiries = []
+        # Sum of 2 ** (64 - register value), kept as an exact integer
+        self.inverse_sum = self.num_registers << 64
+        self.empty_registers = self.num_registers
+        if self.num_registers == 16:
+            alpha = 0.673
+        elif self.num_registers == 32:
+            alpha = 0.697
+        elif self.num_registers == 64:
+            alpha = 0.709
+        else:
+            alpha = 0.7213 / (1 + 1.079 / self.num_registers)
+        self.raw_factor = alpha * self.num_registers * self.num_registers * (1 << 64)
+
+    def add(self, ordinal, value):
+        if value is None:
+            return False
+        hashed = int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+        rank_bits = 64 - self.precision
+        register = hashed >> rank_bits
+        rank = rank_bits - (hashed & ((1 << rank_bits) - 1)).bit_length() + 1
+
+        slots = self.slots
+        base = register * self.DEPTH
+        depth = self.depths[register]
+        old_rank = slots[base] & 0xFF if depth else 0
+        # Older entries with a rank no higher than the new one can no longer
+        # become the register value
+        while depth and slots[base + depth - 1] & 0xFF <= rank:
+            depth -= 1
+        if depth == self.DEPTH:
+            # Replace the newest entry, whose rank is the lowest of the kept
+            # ones, with the new one. Dropping the oldest would lower the
+            # register value at once, for good as long as the list stays full.
+            # The newest entry would only become the register value once all
+            # the older ones expired, and with the lowest rank it is the one
+            # a later value is most likely to supersede before that.
+            depth -= 1
+        slots[base + depth] = ordinal << 8 | rank
+        self.depths[register] = depth + 1
+
+        if not old_rank:
+            heapq.heappush(self.expiries, ordinal << self.precision | register)
+        self.set_register(old_rank, slots[base] & 0xFF)
+        return True
+
+    def expire(self, first_ordinal):
+        slots = self.slots
+        expiries = self.expiries
+        while expiries and expiries[0] >> self.precision < first_ordinal:
+            register = heapq.heappop(expiries) & (self.num_registers - 1)
+            base = register * self.DEPTH
+            depth = self.depths[register]
+            old_rank = slots[base] & 0xFF
+            expired = 0
+            while expired < depth and slots[base + expired] >> 8 < first_ordinal:
+                expired += 1
+            if expired:
+                slots[base:base + depth - expired] = slots[base + expired:base + depth]
+                depth -= expired
+                self.depths[register] = depth
+            if depth:
+                heapq.heappush(expiries, (slots[base] >> 8) << self.precision | register)
+                self.set_register(old_rank, slots[base] & 0xFF)
+            else:
+                self.set_register(old_rank, 0)
+
+    def set_state(self, state):
+        super(ApproxCardinalityAggregation, self).set_state(state)
+        # Checkpoints decode the bytearray as bytes
+        self.depths = bytearray(self.depths)
+
+    def set_register(self, old_rank, new_rank):
+        if old_rank != new_rank:
+            self.inverse_sum += (1 << (64 - new_rank)) - (1 << (64 - old_rank))
+            self.empty_registers += (not new_rank) - (not old_rank)
+
+    def value(self):
+        estimate = self.raw_factor / self.inverse_sum
+        if estimate <= 2.5 * self.num_registers and self.empty_registers:
+            # Small range correction (linear counting)
+            estimate = self.num_registers * math.log(self.num_registers / self.empty_registers)
+        return estimate
+
+
+AGGREGATION_TYPES = {
+    'cardinality': CardinalityAggregation,
+    'count': CountAggregation,
+    'approx_cardinality': ApproxCardinalityAggregation,
+    'distinct_ratio': DistinctRatioAggregation,
+    'sum': SumAggregation,
+    'avg': AvgAggregation,
+    'min': MinAggregation,
+    'max': MaxAggregation,
+    'percentile': PercentileAggregation,
+}
+
+
+def compile_aggregation(aggregation_config):
+    """
+    Returns a function creating new aggregations for the configuration of an
+    aggregation-type correlated event, which is only parsed once. Raises
+    ValueError if the aggregation_type is unknown or its options are invalid.
+    """
+    aggregation_type = aggregation_config.get('aggregation_type', 'cardinality')
+    try:
+        aggregation_class = AGGREGATION_TYPES[aggregation_type]
+    except KeyError:
+        raise ValueError('Unknown aggregation_type %r, expected one of: %s' % (
+            aggregation_type, ', '.join(sorted(AGGREGATION_TYPES))))
+    return partial(aggregation_class, **aggregation_class.parse_config(aggregation_config))
+
+
+def make_aggregation(aggregation_config):
+    """
+    Returns a new aggregation for the configuration of an aggregation-type
+    correlated event, see compile_aggregation.
+    """
+    return compile_aggregation(aggregation_config)()
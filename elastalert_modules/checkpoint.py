@@ -0,0 +1,115 @@
+import collections
+import datetime
+import os
+import tempfile
+from array import array
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from sortedcontainers import SortedList
+
+# msgpack extension types of the Python values it has no type for
+DATETIME = 1
+TUPLE = 2
+DEQUE = 3
+ARRAY = 4
+SORTED_LIST = 5
+BIG_INT = 6
+
+
+def encode(value):
+    """
+    msgpack default hook. Tuples are encoded as an extension (the packer is
+    strict about types) so that they are not decoded as lists: query_keys,
+    sequences and captured values are tuples. Integers beyond 64 bits are
+    encoded as text. bytes and bytearray are both packed as binary, and
+    decoded as bytes.
+    """
+    if isinstance(value, datetime.datetime):
+        return msgpack.ExtType(DATETIME, value.isoformat().encode('utf-8'))
+    if isinstance(value, tuple):
+        return msgpack.ExtType(TUPLE, pack(list(value)))
+    if isinstance(value, collections.deque):
+        return msgpack.ExtType(DEQUE, pack(list(value)))
+    if isinstance(value, array):
+        return msgpack.ExtType(ARRAY, value.typecode.encode('ascii') + value.tobytes())
+    if isinstance(value, SortedList):
+        return msgpack.ExtType(SORTED_LIST, pack(list(value)))
+    if isinstance(value, int):
+        return msgpack.ExtType(BIG_INT, str(value).encode('ascii'))
+    raise TypeError('Cannot checkpoint a value of type %s' % type(value).__name__)
+
+
+def decode(code, data):
+    """ msgpack ext_hook, the reverse of encode. """
+    if code == DATETIME:
+        return datetime.datetime.fromisoformat(data.decode('utf-8'))
+    if code == TUPLE:
+        return tuple(unpack(data))
+    if code == DEQUE:
+        return collections.deque(unpack(data))
+    if code == ARRAY:
+        values = array(data[:1].decode('ascii'))
+        values.frombytes(data[1:])
+        return values
+    if code == SORTED_LIST:
+        return SortedList(unpack(data))
+    if code == BIG_INT:
+        return int(data)
+    return msgpack.ExtType(code, data)
+
+
+def pack(value):
+    return msgpack.packb(value, default=encode, strict_types=True, use_bin_type=True)
+
+
+def unpack(data):
+    return msgpack.unpackb(data, ext_hook=decode, raw=False, strict_map_key=False)
+
+
+def write_checkpoint(path, state):
+    """
+    Writes a state to a file atomically, see write_atomically. Returns the
+    size of the checkpoint in bytes.
+    """
+    data = pack(state)
+    write_atomically(path, data)
+    return len(data)
+
+
+def write_atomically(path, data, mode=None):
+    """
+    Writes bytes to a file atomically: they are written to a temporary file
+    in the same directory, flushed to disk, and renamed over the file, so
+    the file is always complete. The file is only readable by its owner,
+    unless a mode is given.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temporary_path = tempfile.mkstemp(dir=directory, prefix='.%s.' % os.path.basename(path))
+    try:
+        if mode is not None:
+            os.chmod(temporary_path, mode)
+        with os.fdopen(handle, 'wb') as temporary_file:
+            temporary_file.write(data)
+            temporary_file.flush()
+            os.fsync(temporary_file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def read_checkpoint(path):
+    """
+    Returns the state written to a file by write_checkpoint, or None if the
+    file does not exist.
+    """
+    try:
+        with open(path, 'rb') as checkpoint_file:
+            data = checkpoint_file.read()
+    except FileNotFoundError:
+        return None
+    return unpack(data)
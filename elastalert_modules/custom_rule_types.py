@@ -1,59 +1,990 @@
-import copy
-import re
+import collections
+import datetime
+import itertools
+import json
+import math
+import time
+import zlib
+from operator import itemgetter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from elastalert.ruletypes import EventWindow
 from elastalert.ruletypes import RuleType
 
-from elastalert.util import (dt_to_ts, elastalert_logger, hashable,
-                             lookup_es_key, new_get_event_ts, pretty_ts,
-                             ts_to_dt)
+from elastalert.util import (dt_to_ts, EAException, elastalert_logger,
+                             hashable, lookup_es_key, pretty_ts, ts_to_dt)
+from sortedcontainers import SortedList
+
+from elastalert_modules.aggregations import make_aggregation
+from elastalert_modules.checkpoint import msgpack, read_checkpoint, write_checkpoint
+from elastalert_modules.event_store import (MICROSECOND, ColumnarEventWindow, ExpiryIndex, estimate_size, from_micros,
+                                             to_micros)
+from elastalert_modules.fields import compile_field
+from elastalert_modules.metrics import (DEFAULT_METRICS_INTERVAL, LatencyProfiler, Timers, WindowHistogram, make_sink,
+                                        merge_metrics, window_histogram)
+from elastalert_modules.positions import AGGREGATION_CONDITIONS, Comparison, compile_positions
+from elastalert_modules.query import QuerySyntaxError, compile_query
+from elastalert_modules.sequence import SequenceMatcher, count_sequences
+from elastalert_modules.sharding import ShardPool
+
+
+class CorrelationState(object):
+    """
+    Incremental match state for the events of a single query_key.
+
+    Every event appended to the window of the query_key gets an ordinal,
+    a number that increases by one per event. Events leave the window oldest
+    first, so the event at index i of the window has ordinal
+    first_ordinal + i. The events are fed to a SequenceMatcher along with the
+    positions they matched, which also tracks the values captured by each
+    sequence (matcher_options configures its captures and comparisons).
+    Aggregation positions have a running aggregation of the events in the
+    window, created by their compiled Position. CorrelationRule only inspects
+    the newly appended event to update them, and expire() drops the sequences
+    and aggregated values of events that the window removed.
+
+    With on_match: consume, the events of the completed sequences are removed
+    from the middle of the window after a match (see consume()). Their
+    ordinals are kept in consumed until they fall behind first_ordinal, and
+    the event at index i of the window is then the i-th event with an
+    ordinal that was not consumed.
+    """
+
+    def __init__(self, positions, matcher_options=None):
+        self.positions = positions
+        self.num_positions = len(positions)
+        self.matcher_options = matcher_options or {}
+        self.reset()
+
+    def reset(self):
+        self.first_ordinal = 0
+        self.next_ordinal = 0
+        self.consumed = SortedList()
+        # Partial and completed sequences of correlated events
+        self.matcher = SequenceMatcher(self.num_positions, **self.matcher_options)
+        # Running aggregations of the aggregation positions, by position index
+        self.aggregations = {}
+        for position in self.positions:
+            if position.is_aggregation:
+                self.aggregations[position.index] = position.new_aggregation()
+
+    def expire(self):
+        """
+        on_removed callback of the window. The window always removes its
+        oldest event, which is the one with the lowest live ordinal.
+        """
+        self.first_ordinal += 1
+        self.skip_consumed()
+        self.matcher.expire(self.first_ordinal)
+        for aggregation in self.aggregations.values():
+            aggregation.expire(self.first_ordinal)
+
+    def skip_consumed(self):
+        """
+        Moves first_ordinal past the consumed events, which are no longer in
+        the window, and forgets the consumed ordinals behind it.
+        """
+        consumed = self.consumed
+        while consumed and consumed[0] <= self.first_ordinal:
+            if consumed.pop(0) == self.first_ordinal:
+                self.first_ordinal += 1
+
+    def index(self, ordinal):
+        """
+        Returns the index in the window of the event with an ordinal, or None
+        if the event was consumed.
+        """
+        consumed_before = self.consumed.bisect_left(ordinal)
+        if consumed_before < len(self.consumed) and self.consumed[consumed_before] == ordinal:
+            return None
+        return ordinal - self.first_ordinal - consumed_before
+
+    def consume(self):
+        """
+        Removes the completed sequences from the matcher, and returns the
+        indexes of their events in the window, which the window must remove.
+        The partial sequences and the aggregations are kept as they are: an
+        event consumed by a match may still be part of a partial sequence (if
+        it matched several positions), and stays aggregated until it would
+        have left the window. Requires a matcher that tracks the events of the
+        sequences.
+        """
+        indexes = []
+        ordinals = []
+        for ordinal in sorted(set(ordinal for sequence in self.matcher.consume() for ordinal in sequence[2])):
+            index = self.index(ordinal)
+            if index is not None:
+                indexes.append(index)
+                ordinals.append(ordinal)
+        self.consumed.update(ordinals)
+        first_ordinal = self.first_ordinal
+        self.skip_consumed()
+        if self.first_ordinal != first_ordinal:
+            self.matcher.expire(self.first_ordinal)
+            for aggregation in self.aggregations.values():
+                aggregation.expire(self.first_ordinal)
+        return indexes
+
+    def get_state(self):
+        """
+        Returns the ordinals, sequences and aggregations, for checkpoints.
+        """
+        return [self.first_ordinal, self.next_ordinal, self.matcher.get_state(),
+                [[position, aggregation.get_state()] for position, aggregation in self.aggregations.items()],
+                self.consumed]
+
+    def set_state(self, state):
+        self.first_ordinal, self.next_ordinal, matcher_state, aggregations, self.consumed = state
+        self.matcher.set_state(matcher_state)
+        for position, aggregation_state in aggregations:
+            self.aggregations[position].set_state(aggregation_state)
+
+
+# Options passed to the rules of the worker processes when sharding
+SHARD_OPTIONS = ('name', 'num_events', 'timeframe', 'correlated_events', 'query_key', 'timestamp_field',
+                 'attach_related', 'related_events', 'max_related_events', 'on_match', 'match_cooldown', 'max_keys',
+                 'max_events_per_key', 'max_memory_mb', 'checkpoint_interval', 'profile_threshold_ms',
+                 'profile_interval', 'profile_dir')
+# Field of the stand-ins of the documents sent to the shards, see
+# add_sharded_data
+SHARD_REF = '_shard_ref'
+# Options a checkpoint is only valid for, and version of its layout
+CHECKPOINT_OPTIONS = ('correlated_events', 'timeframe', 'query_key', 'timestamp_field', 'attach_related',
+                      'related_events', 'on_match')
+CHECKPOINT_VERSION = 4
+# Minimum seconds between two checkpoints, as writing one costs time
+# proportional to the size of the state
+DEFAULT_CHECKPOINT_INTERVAL = 60
+# Values of the related_events option, see get_related_events
+RELATED_EVENTS_MODES = ('window', 'sequences', 'ids')
+# Values of the on_match option, see check_for_match
+ON_MATCH_MODES = ('reset', 'consume')
+# Estimated memory used by the window and the match state of a query_key,
+# besides its events, in bytes
+KEY_OVERHEAD_BYTES = 3072
+# Number of events between two samples of the memory used by an event
+MEMORY_SAMPLE_INTERVAL = 256
+# Query_key of a run of add_data that kept no event. None is a valid
+# query_key value.
+NO_KEY = object()
+# Methods timed when the rule has metrics
+TIMED_METHODS = ('add_data', 'check_for_match', 'update_correlation_state', 'rebuild_correlation_state',
+                 'garbage_collect')
+
+
+def lookup_values(table, values):
+    """
+    Returns the entries of a pre-filter table, {field index: {value: entry}},
+    for the values of a projection: one entry per field index whose value is
+    in the table.
+    """
+    entries = []
+    for field_index, entries_by_value in table.items():
+        try:
+            entry = entries_by_value.get(values[field_index])
+        except TypeError:
+            # Unhashable values (lists, objects) never equal a position value
+            continue
+        if entry:
+            entries.append(entry)
+    return entries
+
+
+def query_key_fields(rules):
+    """
+    Returns the fields of the query_key of a rule: those of its
+    compound_query_key, which ElastAlert2 sets when query_key is a list of
+    several fields, or its query_key, or none.
+    """
+    if 'compound_query_key' in rules:
+        return list(rules['compound_query_key'])
+    return [rules['query_key']] if 'query_key' in rules else []
+
+
+def compile_query_key(rules):
+    """
+    Returns an accessor for the query_key value of the events of a rule, or
+    None if it has no query_key. The value of a compound_query_key is built
+    from its fields, as ElastAlert2 does: rules that do not run their own
+    query, such as those of a CorrelationRuleGroup, do not get the field
+    ElastAlert2 writes it to.
+    """
+    if 'compound_query_key' not in rules:
+        return compile_field(rules['query_key']) if 'query_key' in rules else None
+    accessors = [compile_field(field) for field in rules['compound_query_key']]
+
+    def accessor(event):
+        return ', '.join([str(get_field(event)) for get_field in accessors])
+    return accessor
+
+
+def push_down_query(rule, fields):
+    """
+    Optionally has Elasticsearch apply the pre-filter of a rule
+    (push_down_filter) and only return the fields it reads
+    (limit_source_fields). ElastAlert2 builds the query of each run from the
+    filter and include options of the rule.
+    """
+    if rule.rules.get('push_down_filter', False):
+        rule.rules.setdefault('filter', []).append(rule.get_push_down_filter())
+    if rule.rules.get('limit_source_fields', False):
+        include = [field for field in rule.rules.get('include', []) if field != '*']
+        include.extend(fields)
+        rule.rules['include'] = sorted(set(include))
+
+
+def resume_query(rule, restored_until):
+    """
+    Has ElastAlert2 query a restored rule from the time of its checkpoint,
+    restored_until (in microseconds), rather than from the end of its last
+    run, as the events in between are not part of the restored state.
+    ElastAlert2 starts from minimum_starttime when the rule has a
+    starttime, or from previous_endtime if it is older than buffer_time.
+    """
+    rule.resumed_from = from_micros(restored_until)
+    for option in ('starttime', 'minimum_starttime', 'previous_endtime'):
+        rule.rules[option] = rule.resumed_from
+
+
+def warn_resume_gap(rule):
+    """
+    Called by the first run of a restored rule: warns if ElastAlert2 still
+    queried from after the checkpoint, as it does when it reloads a changed
+    rule file or runs with --start, since the events in between are missed.
+    """
+    starttime = rule.rules.get('original_starttime')
+    if starttime is not None and starttime > rule.resumed_from:
+        elastalert_logger.warning(
+            'Rule %s restored its state up to %s but queried from %s: the sequences of the events of the %s in '
+            'between are missed' % (rule.rules.get('name'), rule.resumed_from, starttime,
+                                    starttime - rule.resumed_from))
+    rule.resumed_from = None
+
+
+def make_metrics_sinks(rules):
+    """
+    Returns the sinks of the metrics option of a rule, a sink or a list of
+    sinks (see make_sink). Raises EAException if a sink is invalid.
+    """
+    sinks = rules.get('metrics') or []
+    metrics_sinks = []
+    for sink in [sinks] if isinstance(sinks, str) else sinks:
+        try:
+            metrics_sinks.append(make_sink(sink, rules))
+        except ValueError as e:
+            raise EAException('Invalid metrics in rule %s: %s' % (rules.get('name'), e))
+    return metrics_sinks
+
+
+def profile_slow_runs(rule, threshold):
+    """
+    Wraps the add_data method of a rule to profile the runs slower than
+    threshold milliseconds, see LatencyProfiler.
+    """
+    profiler = LatencyProfiler(rule.rules.get('name'), threshold / 1000.0, rule.rules.get('profile_interval', 300),
+                               rule.rules.get('profile_dir'))
+    rule.add_data = profiler.wrap(rule.add_data)
+
 
 class CorrelationRule(RuleType):
     """
     A rule that matches if num_events sequences of correlated_events (in order
     of configured position) occur within a timeframe.
 
-    Supports two types of event matching:
+    Supports three types of event matching:
     1. Regular key-value matching: Match events where a specific field has a specific value
     2. Aggregation-based matching: Match events based on aggregations (cardinality, count, etc.)
        across events matching a query
+    3. Field comparison matching: Compare field values captured at earlier positions
     """
     required_options = set(['num_events', 'timeframe', 'correlated_events'])
 
     def __init__(self, *args):
         super(CorrelationRule, self).__init__(*args)
         self.ts_field = self.rules.get('timestamp_field', '@timestamp')
-        self.get_ts = new_get_event_ts(self.ts_field)
+        self.get_timestamp = compile_field(self.ts_field)
+        self.get_query_key = compile_query_key(self.rules)
         self.attach_related = self.rules.get('attach_related', True)
+        self.related_events = self.rules.get('related_events', 'window')
+        if self.related_events not in RELATED_EVENTS_MODES:
+            raise EAException('Invalid related_events in rule %s: expected one of %s, got %r' % (
+                self.rules.get('name'), ', '.join(RELATED_EVENTS_MODES), self.related_events))
+        self.max_related_events = self.get_limit('max_related_events')
+        # What a match does to the state of its query_key, and the time
+        # before the query_key can match again, in microseconds
+        on_match = self.rules.get('on_match', 'reset')
+        if on_match not in ON_MATCH_MODES:
+            raise EAException('Invalid on_match in rule %s: expected one of %s, got %r' % (
+                self.rules.get('name'), ', '.join(ON_MATCH_MODES), on_match))
+        self.consume_matches = on_match == 'consume'
+        # Whether a match is a copy of the newest document of its window
+        # rather than the document itself, for documents still in use after
+        # the match
+        self.copy_matches = self.consume_matches
+        self.match_cooldown = self.get_duration('match_cooldown')
+        # End of the cooldown of the query_keys that matched, in microseconds,
+        # oldest match first
+        self.cooldowns = collections.OrderedDict()
+        # The windows keep the full documents only if they are attached to
+        # the matches
+        self.keep_documents = self.attach_related and self.related_events != 'ids'
+        # Optional memory bounds, see enforce_memory_limit
+        self.max_keys = self.get_limit('max_keys')
+        self.max_events_per_key = self.get_limit('max_events_per_key')
+        self.max_memory_mb = self.get_limit('max_memory_mb')
+        # The memory used by the events is sampled for max_memory_mb, and
+        # for the state_bytes metric
+        self.sample_memory = bool(self.max_memory_mb) or 'metrics' in self.rules
+        # Windows in least recently updated first order, for eviction
+        self.occurrences = collections.OrderedDict()
+        # Number of events in all the windows, and memory estimate per event
+        self.num_events = 0
+        self.num_added_events = 0
+        self.num_sampled_events = 0
+        self.sampled_event_bytes = 0
+        # Histogram of the number of events per window, kept up to date for
+        # the metrics, so that reporting them does not scan the windows
+        self.window_sizes = WindowHistogram() if 'metrics' in self.rules else None
+        # Number of query_keys and events dropped to stay within the bounds
+        self.evicted_keys = 0
+        self.evicted_events = 0
+        # Incremental match state (indices and captured fields) per query_key
+        self.correlation_states = {}
+        # Windows by newest timestamp, for garbage_collect
+        self.expiry_index = ExpiryIndex(self.rules['timeframe'])
+        # Compiled query predicates, by query string
+        self.compiled_queries = {}
+        # The correlated events are validated and compiled once, in position
+        # order, so that matching events never reads their configuration
+        try:
+            self.compiled_positions = compile_positions(self.rules['correlated_events'], self.get_query_predicate)
+        except ValueError as e:
+            raise EAException('Invalid correlated_events in rule %s: %s' % (self.rules.get('name'), e))
+        # Fields stored in the windows, the only ones the rule reads. Each
+        # event is projected on them once, with precompiled accessors, when
+        # it enters the window, and positions read the projection by index.
+        self.projected_fields = self.get_projected_fields()
+        self.field_accessors = [compile_field(field) for field in self.projected_fields]
+        self.field_indexes = dict((field, index) for index, field in enumerate(self.projected_fields))
+        # Query predicates reading the projection instead of the document
+        self.projected_queries = {}
+        for query, predicate in self.compiled_queries.items():
+            self.projected_queries[query] = predicate.bind(
+                dict((field, itemgetter(self.field_indexes[field])) for field in predicate.fields()))
+        # Values of the fields compared by compare_fields, coerced to the type
+        # of their conditions, as (field index, coerce) pairs. They are
+        # appended to the projection of the events fed to the matcher, once
+        # per event, so the captured values and the joins are already typed.
+        self.coercions = []
+        self.coerced_indexes = {}
+        for position in self.compiled_positions:
+            for comparison in position.comparisons:
+                self.add_coercion(comparison.field, comparison)
+                for field, alias in self.get_captures(comparison.to):
+                    self.add_coercion(field, comparison)
+        # Captures and comparisons of the positions, for the SequenceMatcher
+        self.matcher_options = self.get_matcher_options()
+        # Pre-filter of the events: the key/value positions by key field index
+        # and value, and the aggregation positions with their query
+        self.positions_by_value = {}
+        self.aggregation_queries = []
+        for position in self.compiled_positions:
+            if position.is_aggregation:
+                self.aggregation_queries.append((position.index, self.projected_queries[position.query]))
+            else:
+                positions = self.positions_by_value.setdefault(self.field_indexes[position.key], {})
+                positions[position.value] = positions.get(position.value, ()) + (position.index,)
+        # Aggregation positions, with the index of their aggregation_field in
+        # the projection, or None, their threshold and its test
+        self.aggregation_thresholds = dict(
+            (position.index, (self.field_indexes[position.aggregation_field] if position.uses_field else None,
+                              position.count, position.test))
+            for position in self.compiled_positions if position.is_aggregation)
+        # Number of events passed to the rule, dropped by the pre-filter, and
+        # matches found
+        self.ingested_events = 0
+        self.filtered_events = 0
+        self.num_matches = 0
+        # Optional sharding of the query_keys across worker processes, see
+        # add_sharded_data
+        self.shards = None
+        workers = self.get_limit('workers')
+        if workers and int(workers) > 1 and 'query_key' in self.rules:
+            self.shards = ShardPool(type(self), self.get_shard_rules(int(workers)))
+            # References of the documents sent to the shards, unique across
+            # restarts as the shards checkpoint them, the reference of the
+            # newest document and the newest timestamp of the window of each
+            # query_key, and those documents by reference
+            self.shard_refs = itertools.count(time.time_ns())
+            self.shard_newest = {}
+            self.shard_documents = {}
+        # Optional checkpoints of the state, see write_state_checkpoint. The
+        # workers of sharded rules checkpoint their own shard.
+        self.checkpoint_file = self.rules.get('checkpoint_file')
+        self.checkpoint_interval = self.rules.get('checkpoint_interval', DEFAULT_CHECKPOINT_INTERVAL)
+        self.next_checkpoint = 0
+        # Time of the restored checkpoint, events up to it are already in the
+        # state, and as a datetime until the first run, see resume_query
+        self.restored_until = None
+        self.resumed_from = None
+        if self.checkpoint_file and msgpack is None:
+            elastalert_logger.warning('Rule %s: checkpoint_file requires msgpack, the state will not be saved' %
+                                      self.rules.get('name'))
+            self.checkpoint_file = None
+        if self.checkpoint_file and not self.shards:
+            self.restore_state_checkpoint()
+        elif self.checkpoint_file:
+            # The workers restore the checkpoints of their shards, and the
+            # rule resumes from the oldest
+            restored = [until for until in self.shards.get_restored_until() if until is not None]
+            if restored:
+                resume_query(self, min(restored))
+        # Optional batch mode, see add_batch. Candidate positions are packed
+        # in 64 bit masks.
+        self.batch_mode = self.rules.get('batch_mode', False)
+        if self.batch_mode and numpy is None:
+            elastalert_logger.warning('Rule %s: batch_mode requires NumPy, processing events one at a time' %
+                                      self.rules.get('name'))
+            self.batch_mode = False
+        if self.max_keys or self.max_memory_mb or len(self.compiled_positions) > 63:
+            self.batch_mode = False
+        if self.batch_mode:
+            # The fields the pre-filter reads, projected before the others,
+            # with the pre-filter reading them by index in filter_fields
+            filter_fields = set()
+            for position in self.compiled_positions:
+                if position.is_aggregation:
+                    filter_fields.update(position.predicate.fields())
+                else:
+                    filter_fields.add(position.key)
+            self.filter_fields = [field for field in self.projected_fields if field in filter_fields]
+            self.filter_accessors = [compile_field(field) for field in self.filter_fields]
+            filter_indexes = dict((field, index) for index, field in enumerate(self.filter_fields))
+            self.filter_values = [(filter_indexes[self.projected_fields[field_index]], positions_by_value)
+                                  for field_index, positions_by_value in self.positions_by_value.items()]
+            self.filter_queries = []
+            for position in self.compiled_positions:
+                if position.is_aggregation:
+                    predicate = position.predicate
+                    self.filter_queries.append((position.index, predicate.bind(
+                        dict((field, itemgetter(filter_indexes[field])) for field in predicate.fields()))))
+            # Candidate positions by bitmask, see get_mask_positions
+            self.mask_positions = {}
+        # Optionally have Elasticsearch apply the pre-filter and only return
+        # the fields the rule reads. ElastAlert2 builds the query of each run
+        # from the filter and include options of the rule.
+        query_fields = self.projected_fields + [self.ts_field] + query_key_fields(self.rules)
+        push_down_query(self, query_fields)
+        # Optional metrics, reported to the metrics sinks by garbage_collect,
+        # and timers of the main methods, which wrap them on the instance.
+        # The shards of sharded rules collect their own metrics, and the rule
+        # reports their sum.
+        self.timers = None
+        self.metrics_sinks = make_metrics_sinks(self.rules)
+        self.metrics_interval = self.rules.get('metrics_interval', DEFAULT_METRICS_INTERVAL)
+        self.next_metrics_report = 0
+        if 'metrics' in self.rules and not self.shards:
+            self.timers = Timers()
+            for method in TIMED_METHODS:
+                setattr(self, method, self.timers.timed(method, getattr(self, method)))
+        # Optional profiling of the runs slower than profile_threshold_ms
+        profile_threshold = self.get_limit('profile_threshold_ms')
+        if profile_threshold and not self.shards:
+            profile_slow_runs(self, profile_threshold)
+
+    def get_shard_rules(self, num_shards):
+        """
+        Returns the options of the rules the worker processes run, one per
+        shard: the options of this rule that CorrelationRule reads, with the
+        max_keys and max_memory_mb bounds split between the shards, and a
+        checkpoint_file per shard. The shards collect metrics without sinks.
+        """
+        rules = dict((option, self.rules[option]) for option in SHARD_OPTIONS if option in self.rules)
+        if 'metrics' in self.rules:
+            rules['metrics'] = []
+        if self.max_keys:
+            rules['max_keys'] = int(math.ceil(self.max_keys / float(num_shards)))
+        if self.max_memory_mb:
+            rules['max_memory_mb'] = self.max_memory_mb / float(num_shards)
+        shard_rules = []
+        for shard in range(num_shards):
+            shard_rules.append(dict(rules))
+            if self.rules.get('checkpoint_file'):
+                shard_rules[-1]['checkpoint_file'] = '%s.%d-of-%d' % (self.rules['checkpoint_file'], shard, num_shards)
+        return shard_rules
+
+    def get_projected_fields(self):
+        """
+        Returns the fields the correlated events read, in a stable order: the
+        key of key/value positions, the fields of the queries and the
+        aggregation_field of aggregation positions, and the capture_fields and
+        compare_fields fields, and _id when it is what related_events holds.
+        The timestamp is stored separately, and the query_key is the same for
+        all the events of a window.
+        """
+        fields = []
+        for position in self.compiled_positions:
+            fields.extend(position.fields())
+        if self.attach_related and self.related_events == 'ids':
+            fields.append('_id')
+        return list(collections.OrderedDict.fromkeys(fields))
+
+    def get_limit(self, option):
+        """
+        Returns the value of an optional positive limit of the rule, or None
+        if it is not set. Raises EAException if it is invalid.
+        """
+        limit = self.rules.get(option)
+        if limit is not None and (isinstance(limit, bool) or not isinstance(limit, (int, float)) or limit <= 0):
+            raise EAException('Invalid %s in rule %s: expected a positive number, got %r' % (
+                option, self.rules.get('name'), limit))
+        return limit
+
+    def get_duration(self, option):
+        """
+        Returns the value of an optional duration of the rule, given like
+        timeframe, in microseconds, or None if it is not set. Raises
+        EAException if it is invalid.
+        """
+        duration = self.rules.get(option)
+        if duration is None:
+            return None
+        try:
+            if not isinstance(duration, datetime.timedelta):
+                duration = datetime.timedelta(**duration)
+        except TypeError:
+            raise EAException('Invalid %s in rule %s: expected a duration such as {minutes: 5}, got %r' % (
+                option, self.rules.get('name'), duration))
+        return duration // MICROSECOND
+
+    def get_captures(self, alias):
+        """
+        Returns the (field, alias) captures of the positions that capture a
+        capture_fields alias.
+        """
+        return [capture for position in self.compiled_positions for capture in position.captures
+                if capture[1] == alias]
+
+    def add_coercion(self, field, comparison):
+        """
+        Adds the value of a field coerced for a comparison to the coerced
+        values, unless it is already there.
+        """
+        if (field, comparison.coercion) not in self.coerced_indexes:
+            self.coerced_indexes[field, comparison.coercion] = len(self.projected_fields) + len(self.coercions)
+            self.coercions.append((self.field_indexes[field], comparison.coerce))
+
+    def get_matcher_options(self):
+        """
+        Returns the captures and comparisons of the correlated events in the
+        form SequenceMatcher takes them. Each capture_fields alias gets a slot
+        in the captured values of the sequences per type it is compared as,
+        holding the coerced value, and the values are referred to by their
+        index in the projection of the events followed by the coerced values.
+        Aliases that are never compared are not captured. equal and
+        same_subnet comparisons are hash joins, the other conditions are
+        tested with the test function of their condition, see
+        COMPARISON_CONDITIONS.
+        """
+        slots = {}
+        for position in self.compiled_positions:
+            for comparison in position.comparisons:
+                slots.setdefault((comparison.to, comparison.coercion), len(slots))
+        captures = []
+        equal_joins = []
+        joins = []
+        for position in self.compiled_positions:
+            captures.append(tuple(
+                (slot, self.coerced_indexes[field, coercion])
+                for field, alias in position.captures
+                for (to, coercion), slot in sorted(slots.items(), key=itemgetter(1)) if to == alias))
+            position_equal_joins = []
+            position_joins = []
+            for comparison in position.comparisons:
+                slot = slots[comparison.to, comparison.coercion]
+                value_index = self.coerced_indexes[comparison.field, comparison.coercion]
+                if comparison.equal:
+                    position_equal_joins.append((slot, value_index))
+                else:
+                    position_joins.append((slot, value_index, comparison.test))
+            equal_joins.append(tuple(position_equal_joins))
+            joins.append(tuple(position_joins))
+        return {'num_slots': len(slots), 'captures': captures, 'equal_joins': equal_joins, 'joins': joins,
+                'track_events': self.consume_matches or (self.attach_related and self.related_events != 'window')}
 
     def add_data(self, data):
         """
         This function is called each time Elasticsearch is queried. It will
         check for the configured correlation of events each time it loops over
         an event in the passed in data. It is mostly identical to the add_data
-        function from the FrequencyRule class.
+        function from the FrequencyRule class. With batch_mode, the events are
+        processed by add_batch instead, and with workers by the worker
+        processes, see add_sharded_data.
         """
-        if 'query_key' in self.rules:
-            qk = self.rules['query_key']
+        if self.resumed_from is not None:
+            warn_resume_gap(self)
+        if self.shards:
+            self.add_sharded_data(data)
+            return
+        self.ingested_events += len(data)
+        if self.restored_until is not None:
+            # Events up to the restored checkpoint are already in the state
+            data = [event for event in data if to_micros(self.get_timestamp(event)) > self.restored_until]
+
+        evicted_keys = self.evicted_keys
+        evicted_events = self.evicted_events
+        if self.batch_mode:
+            key = self.add_batch(data)
         else:
-            qk = None
+            key = NO_KEY
+            for event in data:
+                # Drop the events that match no position before they reach a window
+                values = tuple([accessor(event) for accessor in self.field_accessors])
+                positions = self.get_candidate_positions(values)
+                if not positions:
+                    self.filtered_events += 1
+                    continue
+                key = self.get_event_key(event)
+                self.add_event(key, event, values, positions)
+        self.end_run(key, evicted_keys, evicted_events)
 
-        for event in data:
-            if qk:
-                key = hashable(lookup_es_key(event, qk))
-            else:
-                # If no query_key, we use the key 'all' for all events
-                key = 'all'
+    def add_routed_events(self, num_events, routed_events):
+        """
+        Variant of add_data for the rules of a CorrelationRuleGroup, which
+        projects the events of a run and finds their candidate positions for
+        all its rules at once. routed_events are the (event, projection,
+        candidate positions) of the events, out of the num_events of the run,
+        that can match a position of this rule, in order.
+        """
+        self.add_keyed_events(num_events, [(self.get_event_key(event), event, values, positions)
+                                           for event, values, positions in routed_events])
 
-            # Store occurrences in EventWindow objects, ordered by timestamp
-            self.occurrences.setdefault(key, EventWindow(self.rules['timeframe'], getTimestamp=self.get_ts)).append((event, 1))
-            # Check for correlation of events
-            self.check_for_match(key, end=False)
+    def add_keyed_events(self, num_events, keyed_events):
+        """
+        Adds the (query_key, event, projection, candidate positions) of the
+        events, out of the num_events of a run, that can match a position of
+        this rule, in order.
+        """
+        self.ingested_events += num_events
+        self.filtered_events += num_events - len(keyed_events)
+        evicted_keys = self.evicted_keys
+        evicted_events = self.evicted_events
+        key = NO_KEY
+        for key, event, values, positions in keyed_events:
+            if self.restored_until is not None and to_micros(self.get_timestamp(event)) <= self.restored_until:
+                # Already in the restored state
+                continue
+            self.add_event(key, event, values, positions)
+        self.end_run(key, evicted_keys, evicted_events)
 
+    def end_run(self, key, evicted_keys, evicted_events):
+        """
+        Ends a run of add_data: checks for a match the query_key of its last
+        event, and warns if query_keys or events were evicted during the run,
+        given the number evicted before it.
+        """
         if key in self.occurrences:
             # Check for correlation of the events with the specified query_key
             self.check_for_match(key, end=True)
 
+        if self.evicted_keys > evicted_keys or self.evicted_events > evicted_events:
+            elastalert_logger.warning(
+                'Rule %s evicted %d query_key values and %d events to stay within max_keys, max_events_per_key '
+                'and max_memory_mb (%d and %d since it was loaded)' % (
+                    self.rules.get('name'), self.evicted_keys - evicted_keys, self.evicted_events - evicted_events,
+                    self.evicted_keys, self.evicted_events))
+
+    def add_sharded_data(self, data):
+        """
+        Sharded mode of add_data. The query_keys are hash-partitioned across
+        the worker processes, which each keep the windows and match state of
+        their shard: the events are split by shard, the batches are processed
+        in parallel, and the matches of the shards are merged in timestamp
+        order. The partition uses a CRC of the key rather than hash(), which
+        is randomized per process, so it is stable across restarts.
+
+        The pre-filter, the projection and the query_key of the events are
+        computed here, and only the events that can match a position are
+        sent, as (query_key, document, projection, candidate positions).
+        Unless the documents are attached to the matches, the shards get a
+        stand-in of each document instead, with its timestamp, _id and a
+        SHARD_REF reference, and the stand-ins of the matches are replaced by
+        their documents. The stand-in of the newest document of a window can
+        be matched in a later run, so those documents are kept here until
+        their window expires, see garbage_collect.
+        """
+        batches = [[] for _ in range(self.shards.num_shards)]
+        documents = {}
+        for event in data:
+            values = tuple([accessor(event) for accessor in self.field_accessors])
+            positions = self.get_candidate_positions(values)
+            if not positions:
+                continue
+            key = self.get_event_key(event)
+            document = event
+            if not self.keep_documents:
+                timestamp = self.get_timestamp(event)
+                ref = next(self.shard_refs)
+                document = {self.ts_field: timestamp, SHARD_REF: ref}
+                if '_id' in event:
+                    document['_id'] = event['_id']
+                documents[ref] = event
+            batches[zlib.crc32(repr(key).encode('utf-8')) % self.shards.num_shards].append(
+                (key, document, values, positions))
+        # The shards count the events they are sent, and the rule the others
+        num_filtered = len(data) - sum(len(batch) for batch in batches)
+        self.ingested_events += num_filtered
+        self.filtered_events += num_filtered
+
+        matches = []
+        newest_refs = {}
+        for result in self.shards.add_data(batches):
+            if result:
+                matches.extend(result[0])
+                newest_refs.update(result[1])
+        # The matches were added, and their timestamps converted, by the shards
+        matches.sort(key=self.get_match_timestamp)
+        for match in matches:
+            if SHARD_REF not in match:
+                self.matches.append(match)
+                continue
+            ref = match[SHARD_REF]
+            document = documents[ref] if ref in documents else self.shard_documents.get(ref)
+            if document is None:
+                # Stand-in restored from the checkpoint of a shard, from
+                # before the documents kept here
+                del match[SHARD_REF]
+                self.matches.append(match)
+                continue
+            document = dict(document)
+            if 'related_events' in match:
+                document['related_events'] = match['related_events']
+            self.add_match(document)
+        for key, (ref, last_timestamp) in newest_refs.items():
+            previous = self.shard_newest.get(key, (None,))[0]
+            if previous != ref:
+                self.shard_documents.pop(previous, None)
+                if ref in documents:
+                    self.shard_documents[ref] = documents[ref]
+            self.shard_newest[key] = (ref, last_timestamp)
+
+    def add_shard_events(self, shard_events):
+        """
+        Worker side of add_sharded_data: adds the (query_key, document,
+        projection, candidate positions) of the events of a run. Returns the
+        matches they triggered, and unless the windows keep the documents,
+        the SHARD_REF of the newest document and the newest timestamp of the
+        windows of their query_keys. After a match consumed the newest event
+        of a window, it has no newest document until the next event.
+        """
+        self.add_keyed_events(len(shard_events), shard_events)
+        matches = self.matches
+        self.matches = []
+        newest_refs = {}
+        if not self.keep_documents:
+            for key, _, _, _ in shard_events:
+                window = self.occurrences.get(key)
+                if window is not None:
+                    newest = window.newest_document
+                    newest_refs[key] = (newest[SHARD_REF] if newest else None, window.last_timestamp())
+        return matches, newest_refs
+
+    def get_match_timestamp(self, match):
+        timestamp = lookup_es_key(match, self.ts_field)
+        return ts_to_dt(timestamp) if isinstance(timestamp, str) else timestamp
+
+    def get_event_key(self, event):
+        if self.get_query_key:
+            return hashable(self.get_query_key(event))
+        # If no query_key, we use the key 'all' for all events
+        return 'all'
+
+    def add_event(self, key, event, values, positions):
+        """
+        Adds an event to the window of its query_key, given its projection and
+        its candidate positions, updates the match state and checks for a
+        match.
+        """
+        new_window = key not in self.occurrences
+        if new_window:
+            if self.max_keys and len(self.occurrences) >= self.max_keys:
+                self.evict_key(next(iter(self.occurrences)))
+            window = self.create_window(key)
+        else:
+            self.occurrences.move_to_end(key)
+            window = self.occurrences[key]
+
+        # Store the fields of the event in the window, ordered by
+        # timestamp. An event older than the newest one is inserted in the
+        # middle of the window.
+        if self.sample_memory:
+            if not self.num_added_events % MEMORY_SAMPLE_INTERVAL:
+                self.sample_event_size(event, values)
+            self.num_added_events += 1
+        num_events = window.count()
+        in_order = window.append(self.get_timestamp(event), values, event)
+        if self.max_events_per_key:
+            # Drop the oldest events beyond the cap, like expired events
+            while window.count() > self.max_events_per_key:
+                window.popleft()
+                self.correlation_states[key].expire()
+                self.evicted_events += 1
+        self.num_events += window.count() - num_events
+        if self.window_sizes:
+            self.window_sizes.resize(num_events, window.count())
+        if in_order:
+            self.update_correlation_state(key, values, positions)
+        else:
+            self.rebuild_correlation_state(key)
+        if new_window:
+            self.expiry_index.add(key, window)
+        # Check for correlation of events
+        self.check_for_match(key, end=False)
+        if self.max_memory_mb:
+            self.enforce_memory_limit()
+
+    def create_window(self, key):
+        """
+        Creates the window and the match state of a new query_key.
+        """
+        state = CorrelationState(self.compiled_positions, self.matcher_options)
+        self.correlation_states[key] = state
+        window = self.occurrences[key] = ColumnarEventWindow(self.rules['timeframe'], self.projected_fields,
+                                                             keep_documents=self.keep_documents,
+                                                             on_removed=state.expire)
+        return window
+
+    def add_batch(self, data):
+        """
+        Batch mode of add_data. The events of a run are first projected on
+        the fields the pre-filter reads only, and their candidate positions
+        are computed as NumPy bitmasks (bit i set if the event can match
+        position i). The events that can match a position are then fully
+        projected and grouped by query_key with a stable argsort, so that the
+        events of a query_key are fed to its window and matcher in one go, in
+        their original order.
+
+        Events of different query_keys never interact, so this gives the same
+        state as add_data, and the matches found are reordered to the order of
+        the events that triggered them. Eviction of query_keys (max_keys and
+        max_memory_mb) depends on the interleaving of the keys, so those rules
+        never use batch mode. Returns the query_key of the last kept event, or
+        NO_KEY.
+        """
+        columns = [[accessor(event) for event in data] for accessor in self.filter_accessors]
+        masks = self.get_position_masks(columns, len(data))
+        selected = numpy.flatnonzero(masks).tolist()
+        self.filtered_events += len(data) - len(selected)
+        if not selected:
+            return NO_KEY
+
+        keys = [self.get_event_key(data[index]) for index in selected]
+        codes = {}
+        key_codes = numpy.fromiter((codes.setdefault(key, len(codes)) for key in keys),
+                                   dtype=numpy.int64, count=len(keys))
+        accessors = self.field_accessors
+        first_match = len(self.matches)
+        match_indexes = []
+        for rank in numpy.argsort(key_codes, kind='stable').tolist():
+            index = selected[rank]
+            event = data[index]
+            num_matches = len(self.matches)
+            self.add_event(keys[rank], event, tuple([accessor(event) for accessor in accessors]),
+                           self.get_mask_positions(int(masks[index])))
+            match_indexes.extend([index] * (len(self.matches) - num_matches))
+        if match_indexes:
+            order = sorted(range(len(match_indexes)), key=match_indexes.__getitem__)
+            matches = self.matches[first_match:]
+            self.matches[first_match:] = [matches[match] for match in order]
+        return keys[-1]
+
+    def get_position_masks(self, columns, num_events):
+        """
+        Returns the candidate positions of a batch of events as an array of
+        bitmasks, see get_candidate_positions. columns are the values of the
+        filter_fields for the events of the batch. Each key field is compared
+        with each of its position values over the whole batch at once.
+        """
+        masks = numpy.zeros(num_events, dtype=numpy.int64)
+        for column_index, positions_by_value in self.filter_values:
+            column = numpy.fromiter(columns[column_index], dtype=object, count=num_events)
+            for value, positions in positions_by_value.items():
+                bits = sum(1 << position for position in positions)
+                numpy.bitwise_or(masks, bits, out=masks, where=column == value)
+        if self.filter_queries:
+            rows = list(zip(*columns))
+            for position, predicate in self.filter_queries:
+                matched = numpy.fromiter((bool(predicate(row)) for row in rows), dtype=bool, count=num_events)
+                numpy.bitwise_or(masks, 1 << position, out=masks, where=matched)
+        return masks
+
+    def get_mask_positions(self, mask):
+        """
+        Returns the positions of the bits set in a candidate position mask, in
+        increasing order. The tuples are cached by mask.
+        """
+        positions = self.mask_positions.get(mask)
+        if positions is None:
+            positions = self.mask_positions[mask] = tuple(
+                position for position in range(len(self.compiled_positions)) if mask >> position & 1)
+        return positions
+
+    def remove_key(self, key):
+        """
+        Drops the window and the match state of a query_key.
+        """
+        window = self.occurrences.pop(key)
+        self.correlation_states.pop(key)
+        self.expiry_index.discard(key)
+        self.num_events -= window.count()
+        if self.window_sizes:
+            self.window_sizes.resize(window.count(), 0)
+        return window
+
+    def evict_key(self, key):
+        """
+        Drops a query_key to stay within max_keys or max_memory_mb.
+        """
+        window = self.remove_key(key)
+        self.evicted_keys += 1
+        self.evicted_events += window.count()
+
+    def sample_event_size(self, event, values):
+        """
+        Adds the estimated memory used by an event in a window to the sample
+        that max_memory_mb is checked against: its timestamp and column slots,
+        and its document if the window keeps it, or its projected values.
+        """
+        size = 8 + 8 * len(values)
+        if self.keep_documents:
+            size += 8 + estimate_size(event)
+        else:
+            size += sum(estimate_size(value) for value in values)
+        self.sampled_event_bytes += size
+        self.num_sampled_events += 1
+
+    def estimate_memory(self):
+        """
+        Returns the estimated memory used by the windows and match states, in
+        bytes, from the number of query_keys and events and the sampled size of
+        the events.
+        """
+        event_bytes = self.sampled_event_bytes / float(self.num_sampled_events) if self.num_sampled_events else 0
+        return len(self.occurrences) * KEY_OVERHEAD_BYTES + self.num_events * event_bytes
+
+    def enforce_memory_limit(self):
+        """
+        Evicts the least recently updated query_keys until the estimated
+        memory is within max_memory_mb. The most recently updated query_key is
+        never evicted.
+        """
+        limit = self.max_memory_mb * 1024 * 1024
+        while len(self.occurrences) > 1 and self.estimate_memory() > limit:
+            self.evict_key(next(iter(self.occurrences)))
+
     def get_num_correlations(self, correlated_indices):
         """
         Finds the maximum number of sequential integers in a set of nested lists.
@@ -64,108 +995,76 @@ class CorrelationRule(RuleType):
         [[0, 5], [2, 10], [1, 7]]   returns 1 match (0->2->7)
 
         Returns an integer that is the number of matches.
+
+        The lists are fed to a SequenceMatcher in index order, instead of being
+        rescanned for every sequence found.
         """
-        # Deep copy the passed in list of lists, to avoid modifying it
-        positions_list = copy.deepcopy(correlated_indices)
-        num_matches = 0
-        # Sort nested lists so we can inspect positions in sequential order
-        # (guarantees that the position in the first nested list that we start a
-        # potentially valid sequence from is the smallest, so if no valid sequence
-        # is found, there are no valid sequences left)
-        for positions in positions_list:
-            positions.sort()
-        # Iterate at most number of positions for first event (max number matches)
-        initial_positions_len = len(positions_list[0])
-        for i in range(initial_positions_len):
-            # A list to hold any matching positions that are part of a potentially
-            # valid sequence of events. If a valid sequence is found, these
-            # positions will be removed from the positions list before another
-            # iteration of the loop.
-            matching_positions = []
-            # Check if there are any positions for the first event left
-            if len(positions_list[0]) > 0:
-                # Set our previous position to the first occurrence of the first
-                # event, and add it to the list of matching positions
-                previous_position = positions_list[0][0]
-                matching_positions.append(positions_list[0][0])
-                # Loop over each list in the positions_list list, skipping the
-                # first one since it has no previous position
-                for positions in positions_list[1:]:
-                    # Assume an invalid sequence until we find a position greater
-                    # than the previous position in the sequence found
-                    valid_sequence = False
-                    for position in positions:
-                        if position > previous_position:
-                            valid_sequence = True
-                            previous_position = position
-                            matching_positions.append(position)
-                            # We can stop checking this list of positions and move
-                            # on to the next one
-                            break
-                        else:
-                            continue
-                # Finished checking each nested list. If we found a valid sequence,
-                # increment num_matches, remove all matched positions from the
-                # positions list, and move on to the next loop iteration.
-                if valid_sequence:
-                    num_matches += 1
-                    for i, position in enumerate(matching_positions):
-                        del positions_list[i][positions_list[i].index(position)]
-                # If there was no valid sequence, we've found all possible matches
-                else:
-                    return num_matches
-        return num_matches
+        return count_sequences(correlated_indices)
 
     def parse_query_and_match(self, event, query):
         """
-        Parse a simple Lucene-style query and check if the event matches.
-        Supports basic queries like:
-        - field:value
+        Check if the event matches a Lucene-style query. Supports:
+        - field:value and field:"quoted phrase"
         - field:(value1 OR value2 OR value3)
-        - Multiple conditions with AND/OR
+        - AND, OR and NOT (also &&, || and !), grouped with parentheses
+        - Wildcards (field:val*, field:v?lue) and field:* for existence
+        - Ranges (field:[1 TO 5], field:{a TO *}, field:>=10)
+
+        Queries are compiled into predicates once, when the rule is loaded
+        (see get_query_predicate), so matching an event does not parse the query.
 
         Returns True if the event matches the query, False otherwise.
         """
-        # Handle queries with parentheses (e.g., field:(value1 OR value2))
-        match = re.match(r'(\w+):\(([^)]+)\)', query)
-        if match:
-            field_name = match.group(1)
-            values_str = match.group(2)
-            # Split by OR and clean up spaces
-            values = [v.strip() for v in values_str.split('OR')]
+        return self.get_query_predicate(query)(event)
 
-            # Get the field value from the event
-            event_value = lookup_es_key(event, field_name)
-            if event_value is None:
-                return False
-
-            # Convert event value to string for comparison
-            event_value_str = str(event_value)
-
-            # Check if event value matches any of the values in the query
-            return event_value_str in values
+    def get_query_predicate(self, query):
+        """
+        Returns the compiled predicate of a query, compiling and caching it for
+        this rule the first time. Raises EAException if the query is not
+        supported.
+        """
+        predicate = self.compiled_queries.get(query)
+        if predicate is None:
+            try:
+                predicate = compile_query(query)
+            except QuerySyntaxError as e:
+                raise EAException('Invalid query in correlated_events of rule %s: %s' % (self.rules.get('name'), e))
+            self.compiled_queries[query] = predicate
+        return predicate
 
-        # Handle simple field:value queries
-        match = re.match(r'(\w+):(.+)', query)
-        if match:
-            field_name = match.group(1)
-            query_value = match.group(2).strip()
+    def compare_field_values(self, value1, value2, condition):
+        """
+        Compare two field values based on the specified condition.
 
-            # Get the field value from the event
-            event_value = lookup_es_key(event, field_name)
-            if event_value is None:
-                return False
+        Parameters:
+        - value1: First value to compare
+        - value2: Second value to compare
+        - condition: Comparison condition (equal, not_equal, greater_than, less_than, etc.)
 
-            return str(event_value) == query_value
+        Returns True if the condition is met, False otherwise.
 
-        # If query format is not recognized, log a warning and return False
-        elastalert_logger.warning(f"Unrecognized query format: {query}")
-        return False
+        The rule itself compiles each comparison once, when it is loaded, and
+        compares values coerced when they are captured, see Comparison. This
+        does the same for a single pair of values, with the default options
+        of the condition.
+        """
+        try:
+            comparison = Comparison({'field': 'value1', 'to': 'value2', 'condition': condition})
+        except ValueError as e:
+            elastalert_logger.warning(f"Invalid comparison condition: {e}")
+            return False
+        value1 = comparison.coerce(value1)
+        value2 = comparison.coerce(value2)
+        if comparison.equal:
+            return value1 is not None and value2 is not None and value1 == value2
+        return comparison.test(value1, value2)
 
     def get_aggregation_indices(self, events, aggregation_config):
         """
         For an aggregation-type correlated event, find all indices where the
-        aggregation threshold is met.
+        aggregation threshold is met, aggregating from the first event.
+        CorrelationRule itself keeps a running aggregation per query_key
+        instead, see update_correlation_state.
 
         Parameters:
         - events: List of (event, count) tuples from EventWindow
@@ -175,57 +1074,40 @@ class CorrelationRule(RuleType):
         - List of indices where the aggregation threshold was met
         """
         indices = []
-        query = aggregation_config.get('query', '')
-        agg_type = aggregation_config.get('aggregation_type', 'cardinality')
+        predicate = self.get_query_predicate(aggregation_config.get('query', ''))
+        aggregation = make_aggregation(aggregation_config)
         agg_field = aggregation_config.get('aggregation_field')
         agg_count = aggregation_config.get('aggregation_count', 1)
+        reached = AGGREGATION_CONDITIONS[aggregation_config.get('aggregation_condition', 'above')]
 
-        # Track unique values and their first occurrence for cardinality
-        if agg_type == 'cardinality':
-            unique_values = set()
-            for index, event_tuple in enumerate(events):
-                event = event_tuple[0]  # 0th index contains event data
-
-                # Check if event matches the query
-                if self.parse_query_and_match(event, query):
-                    # Get the aggregation field value
-                    field_value = lookup_es_key(event, agg_field)
-                    if field_value is not None:
-                        # Add to unique values
-                        unique_values.add(str(field_value))
-
-                        # Check if we've reached the threshold
-                        if len(unique_values) >= agg_count:
-                            indices.append(index)
-
-        # Could add other aggregation types here (count, sum, etc.)
-        elif agg_type == 'count':
-            matching_count = 0
-            for index, event_tuple in enumerate(events):
-                event = event_tuple[0]
-
-                if self.parse_query_and_match(event, query):
-                    matching_count += 1
-
-                    if matching_count >= agg_count:
-                        indices.append(index)
+        for index, event_tuple in enumerate(events):
+            event = event_tuple[0]  # 0th index contains event data
+            # Check if event matches the query, then aggregate it
+            if predicate(event):
+                field_value = lookup_es_key(event, agg_field) if aggregation.uses_field else None
+                # Check if we've reached the threshold
+                if aggregation.add(index, field_value) and reached(aggregation.value(), agg_count):
+                    indices.append(index)
 
         return indices
 
     def check_for_match(self, key, end=False):
         """
-        Constructs a list of lists, checks for number of matches, and alerts.
-        The outer list is in order of the position defined in the rule
-        configuration file. The inner lists are the positions or order in the
-        stream of events at which the configured correlated_events were found.
-        This is passed to a function to determine the maximum possible
-        correlations (ordered sequences of items from each inner list, i.e., the
-        number of separate times the correlated events happened in the order
-        specified by their configured positions.
+        Checks the number of sequences found for a query_key, and alerts.
+        Conceptually, events are tracked as a list of lists. The outer list is
+        in order of the position defined in the rule configuration file. The
+        inner lists are the positions or order in the stream of events at which
+        the configured correlated_events were found. The number of correlations
+        is the maximum number of ordered sequences of items from each inner
+        list, i.e., the number of separate times the correlated events happened
+        in the order specified by their configured positions. Rather than
+        building the lists, update_correlation_state feeds each event to a
+        SequenceMatcher, which counts the sequences as the events arrive.
 
-        Supports two types of correlated events:
+        Supports three types of correlated events:
         1. Regular key-value matching (original functionality)
         2. Aggregation-based matching (enhanced functionality)
+        3. Field comparison matching (allows comparing fields between positions)
 
         Example 1 - Regular key-value matching:
         If 6 events are present at self.occurrences[key], in the
@@ -247,8 +1129,7 @@ class CorrelationRule(RuleType):
           key: eventName
           value: StartInstances
 
-        The resulting list (correlated_event_indices) passed to the
-        get_num_correlations function will be:
+        The resulting list of lists (correlated_event_indices) will be:
 
         [[0, 2], [1, 4], [3, 5]]
 
@@ -272,56 +1153,362 @@ class CorrelationRule(RuleType):
         Position 1 will match at indices where 4 unique resultType values
         have been observed in events matching the query. Position 2 will
         match at indices where resultSignature equals SUCCESS.
+
+        Example 3 - Field comparison matching:
+        If the rule configuration specifies:
+
+        correlated_events:
+        - position: 1
+          key: resultType
+          value: "50074"
+          capture_fields:
+            - field: country
+              as: position1_country
+        - position: 2
+          key: resultType
+          value: "0"
+          compare_fields:
+            - field: country
+              to: position1_country
+              condition: not_equal
+
+        Position 1 will capture the country field value. Position 2 will only
+        match if resultType is "0" AND the country is different from position 1.
         """
-        correlated_event_indices = []
+        window = self.occurrences[key]
+        state = self.correlation_states[key]
         # Check if there are enough events for a correlation to be found
-        if self.occurrences[key].count() >= len(self.rules['correlated_events']):
-            # Sort events by their positions defined in rule configuration
-            correlated_events = sorted(self.rules['correlated_events'], key=lambda d: d['position'])
-            # For each event we're looking for, find the indices at which it
-            # occurs and store them as a nested list inside the
-            # correlated_event_indices list
-            for correlated_event in correlated_events:
-                indices = []
-
-                # Check if this is an aggregation-type event
-                if correlated_event.get('type') == 'aggregation':
-                    # Use aggregation logic to find matching indices
-                    indices = self.get_aggregation_indices(
-                        self.occurrences[key].data,
-                        correlated_event
-                    )
-                else:
-                    # Regular key-value matching
-                    for index, event in enumerate(self.occurrences[key].data):
-                        # 0th index of event contains event data
-                        event_data = event[0]
-                        event_value = lookup_es_key(event_data, correlated_event['key'])
-                        if event_value == correlated_event['value']:
-                            indices.append(index)
-
-                correlated_event_indices.append(indices)
+        if window.count() >= len(self.compiled_positions):
             # Check if the number of sequences of events is greater than or
             # equal to the number of events (our threshold for sending an alert)
-            # defined in the rule configuration
-            if self.get_num_correlations(correlated_event_indices) >= self.rules['num_events']:
-                # Get data of last event in sequence and attach related events
-                last_event_data = self.occurrences[key].data[-1][0]
-                last_event_data['related_events'] = [data[0] for data in self.occurrences[key].data[:-1]]
-                # Add match and pop this query_key's occurrences from list
+            # defined in the rule configuration. The sequences are counted as
+            # events are fed to the matcher by update_correlation_state.
+            if state.matcher.count() >= self.rules['num_events']:
+                # Query_keys in their cooldown keep their state, and match
+                # once it is over
+                if self.match_cooldown and window.last_timestamp() < self.cooldowns.get(key, 0):
+                    return
+                # Get data of last event in sequence and attach related events.
+                # Consumed matches leave the other documents in the window, and
+                # the rules of a group share the documents, so the match is
+                # then a copy.
+                last_event_data = window.newest_document
+                if self.attach_related:
+                    related_events = self.get_related_events(window, state, last_event_data)
+                if self.copy_matches:
+                    last_event_data = dict(last_event_data)
+                if self.attach_related:
+                    last_event_data['related_events'] = related_events
+                if self.match_cooldown:
+                    self.cooldowns.pop(key, None)
+                    self.cooldowns[key] = window.last_timestamp() + self.match_cooldown
+                # Add match, and either consume its sequences or pop this
+                # query_key's occurrences from list
                 self.add_match(last_event_data)
-                self.occurrences.pop(key)
+                self.num_matches += 1
+                if self.consume_matches:
+                    self.consume_sequences(key)
+                else:
+                    self.remove_key(key)
+
+    def consume_sequences(self, key):
+        """
+        on_match: consume. Removes the events of the completed sequences of a
+        query_key from its window, keeping the other events and the partial
+        sequences, and drops the query_key if no event is left.
+        """
+        window = self.occurrences[key]
+        indexes = self.correlation_states[key].consume()
+        num_events = window.count()
+        window.remove(indexes)
+        self.num_events -= len(indexes)
+        if self.window_sizes:
+            self.window_sizes.resize(num_events, window.count())
+        if not window.count():
+            self.remove_key(key)
+
+    def get_related_events(self, window, state, match):
+        """
+        Returns the related_events of a match, the other events of the window
+        of its query_key, in timestamp order, depending on the related_events
+        option:
+        - window: the documents of all the events of the window
+        - sequences: the documents of the events of the completed sequences
+        - ids: the _id of the events of the completed sequences
+        and at most the newest max_related_events of them. The events of the
+        sequences are tracked by the matcher, so the cost of the sequences and
+        ids modes depends on the length of the sequences, not of the window.
+        """
+        if self.related_events == 'window':
+            end = window.count() - 1
+            start = max(0, end - int(self.max_related_events)) if self.max_related_events else 0
+            return [window.document(index) for index in range(start, end)]
+
+        indexes = set(state.index(ordinal) for sequence in state.matcher.completed() for ordinal in sequence[2])
+        indexes.discard(None)
+        indexes = sorted(indexes)
+        if self.related_events == 'ids':
+            id_index = self.field_indexes['_id']
+            related = [window.value(index, id_index) for index in indexes]
+            related = [event_id for event_id in related if event_id != match.get('_id')]
+        else:
+            related = [window.document(index) for index in indexes]
+            related = [document for document in related if document is not match]
+        if self.max_related_events:
+            related = related[-int(self.max_related_events):]
+        return related
+
+    def get_push_down_filter(self):
+        """
+        Returns the pre-filter of the rule as an Elasticsearch filter: a
+        bool/should with a term (or terms) query per key field of the
+        key/value positions, and the translation of the query of each
+        aggregation position. Elasticsearch then only returns the events that
+        can match a position.
+
+        term queries compare the exact value, so the key fields must be
+        keyword (or numeric, boolean...) fields for the filter to be
+        equivalent to the matching done by the rule.
+        """
+        should = []
+        values_by_field = collections.OrderedDict()
+        for position in self.compiled_positions:
+            if position.is_aggregation:
+                should.append(position.predicate.to_query())
+            else:
+                values = values_by_field.setdefault(position.key, [])
+                if position.value not in values:
+                    values.append(position.value)
+        for field, values in values_by_field.items():
+            if len(values) == 1:
+                should.insert(0, {'term': {field: values[0]}})
+            else:
+                should.insert(0, {'terms': {field: values}})
+        return {'bool': {'should': should, 'minimum_should_match': 1}}
+
+    def get_candidate_positions(self, values):
+        """
+        Returns the positions an event can match, given its projection, in
+        increasing order: the key/value positions whose value it has, found
+        with one dictionary lookup per key field, and the aggregation
+        positions whose query it matches. Events with no candidate position
+        cannot change the match state, so they are not stored.
+        """
+        positions = []
+        for matched in lookup_values(self.positions_by_value, values):
+            positions.extend(matched)
+        for position, predicate in self.aggregation_queries:
+            if predicate(values):
+                positions.append(position)
+        positions.sort()
+        return positions
+
+    def update_correlation_state(self, key, values, positions):
+        """
+        Feeds the newest event of the window of a query_key to its
+        SequenceMatcher, along with the positions it matches. values is the
+        projection of the event on projected_fields, and positions its
+        candidate positions (see get_candidate_positions). Only that event is
+        inspected, so the cost per event depends on the number of configured
+        positions rather than on the number of events in the window.
+
+        compare_fields are not checked here: they are joins between the event
+        and the sequences it can extend, evaluated by the matcher against the
+        values captured by the events of each sequence.
+        """
+        state = self.correlation_states[key]
+        ordinal = state.next_ordinal
+        state.next_ordinal += 1
+
+        aggregation_thresholds = self.aggregation_thresholds
+        if not aggregation_thresholds:
+            # Regular key-value matching, done by the pre-filter
+            matched_positions = positions
+        else:
+            matched_positions = []
+            for position in positions:
+                threshold = aggregation_thresholds.get(position)
+                if threshold is None:
+                    matched_positions.append(position)
+                    continue
+                # The event matches the query, so it is added to the running
+                # aggregation of the window, and it matches the position if
+                # the aggregation threshold is met once it has been added
+                field_index, count, test = threshold
+                aggregation = state.aggregations[position]
+                if aggregation.add(ordinal, None if field_index is None else values[field_index]) and \
+                        test(aggregation.value(), count):
+                    matched_positions.append(position)
+
+        if matched_positions:
+            if self.coercions:
+                values = values + tuple([coerce(values[field_index]) for field_index, coerce in self.coercions])
+            state.matcher.feed(ordinal, matched_positions, values)
+
+    def rebuild_correlation_state(self, key):
+        """
+        Recomputes the match state of a query_key from all the events in its
+        window. Only needed when an event arrives out of timestamp order and is
+        inserted in the middle of the window, which shifts the index of every
+        later event.
+
+        The events are replayed from their projections stored in the window.
+        """
+        self.correlation_states[key].reset()
+        for values in self.occurrences[key].rows():
+            self.update_correlation_state(key, values, self.get_candidate_positions(values))
 
     def garbage_collect(self, timestamp):
         """
-        Remove all occurrence data that is beyond the timeframe away. Copied
-        from the FrequencyRule class.
+        Remove all occurrence data that is beyond the timeframe away, along
+        with the match state (sequences, captures and aggregations) of the
+        same query_keys. The stale keys are popped from the expiry index
+        rather than found by scanning every window. Sharded rules have their
+        worker processes collect their own shards.
+        """
+        if self.shards:
+            self.shards.garbage_collect(timestamp)
+            # Forget the documents of the windows the shards expired, see
+            # ExpiryIndex.pop_expired
+            oldest = to_micros(timestamp - self.rules['timeframe'])
+            for key, (ref, last_timestamp) in list(self.shard_newest.items()):
+                if last_timestamp < oldest:
+                    del self.shard_newest[key]
+                    self.shard_documents.pop(ref, None)
+            if self.metrics_sinks and time.time() >= self.next_metrics_report:
+                self.report_metrics(self.get_metrics())
+            return
+        for key in self.expiry_index.pop_expired(self.occurrences, timestamp):
+            self.remove_key(key)
+        # Cooldowns are over once an event newer than their end arrives, so
+        # they are only forgotten for the query_keys with no window left
+        now = to_micros(timestamp)
+        expired = []
+        for key, until in self.cooldowns.items():
+            if until > now:
+                break
+            if key not in self.occurrences:
+                expired.append(key)
+        for key in expired:
+            del self.cooldowns[key]
+        if self.restored_until is not None and to_micros(timestamp - self.rules['timeframe']) > self.restored_until:
+            self.restored_until = None
+        if self.checkpoint_file and time.time() >= self.next_checkpoint:
+            self.write_state_checkpoint(timestamp)
+            self.next_checkpoint = time.time() + self.checkpoint_interval
+        if self.metrics_sinks and time.time() >= self.next_metrics_report:
+            self.report_metrics(self.get_metrics())
+
+    def get_metrics(self):
+        """
+        Returns the metrics of the rule: the counters of events and matches
+        since it was loaded, the number of query_keys and events it holds and
+        their estimated memory, the histogram of the number of events of the
+        windows (see WINDOW_BUCKETS), and the number of calls and time spent
+        in TIMED_METHODS. Rules without metrics do not keep the histogram up
+        to date, it is then computed from the windows. Sharded rules return
+        the sum of the metrics of their shards.
+        """
+        if self.window_sizes:
+            window_events = self.window_sizes.snapshot()
+        else:
+            window_events = window_histogram(window.count() for window in self.occurrences.values())
+        metrics = {
+            'events_ingested': self.ingested_events,
+            'events_filtered': self.filtered_events,
+            'matches': self.num_matches,
+            'keys_evicted': self.evicted_keys,
+            'events_evicted': self.evicted_events,
+            'keys': len(self.occurrences),
+            'events': self.num_events,
+            'state_bytes': int(self.estimate_memory()),
+            'window_events': window_events,
+            'timers': self.timers.snapshot() if self.timers else {},
+        }
+        if self.shards:
+            # The events dropped by the pre-filter are only counted here
+            return merge_metrics([metrics] + self.shards.get_metrics())
+        return metrics
+
+    def report_metrics(self, metrics):
         """
-        stale_keys = []
-        for key, window in self.occurrences.items():
-            if timestamp - lookup_es_key(window.data[-1][0], self.ts_field) > self.rules['timeframe']:
-                stale_keys.append(key)
-        list(map(self.occurrences.pop, stale_keys))
+        Sends metrics to the sinks of the rule, at most every metrics_interval
+        seconds.
+        """
+        for sink in self.metrics_sinks:
+            sink.emit(self.rules.get('name'), metrics)
+        self.next_metrics_report = time.time() + self.metrics_interval
+
+    def get_checkpoint_fingerprint(self):
+        """
+        Returns a checksum of the options the state depends on, so that a
+        checkpoint is not restored after the rule changed.
+        """
+        options = dict((option, self.rules.get(option)) for option in CHECKPOINT_OPTIONS)
+        return zlib.crc32(json.dumps(options, sort_keys=True, default=str).encode('utf-8'))
+
+    def write_state_checkpoint(self, timestamp):
+        """
+        Saves the windows and match states of all the query_keys to
+        checkpoint_file, as msgpack, along with the time the rule has
+        processed events up to (the end of the last query). Called by
+        garbage_collect, at most every checkpoint_interval seconds.
+        """
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'fingerprint': self.get_checkpoint_fingerprint(),
+            'timestamp': to_micros(timestamp),
+            'keys': [[key, window.get_state(), self.correlation_states[key].get_state()]
+                     for key, window in self.occurrences.items()],
+            'cooldowns': list(self.cooldowns.items()),
+            'counters': [self.num_added_events, self.num_sampled_events, self.sampled_event_bytes,
+                         self.evicted_keys, self.evicted_events, self.filtered_events],
+        }
+        try:
+            size = write_checkpoint(self.checkpoint_file, state)
+        except (OSError, TypeError, ValueError) as e:
+            elastalert_logger.error('Rule %s could not write its checkpoint to %s: %s' % (
+                self.rules.get('name'), self.checkpoint_file, e))
+            return
+        elastalert_logger.debug('Rule %s wrote a checkpoint of %d query_key values (%d bytes) to %s' % (
+            self.rules.get('name'), len(state['keys']), size, self.checkpoint_file))
+
+    def restore_state_checkpoint(self):
+        """
+        Restores the windows and match states saved by
+        write_state_checkpoint, if checkpoint_file exists and was written for
+        the same options. The next query starts from the time of the
+        checkpoint, see resume_query, and the events it returns that are not
+        newer are dropped, as they are already part of the state.
+        """
+        try:
+            state = read_checkpoint(self.checkpoint_file)
+        except (OSError, TypeError, ValueError) as e:
+            elastalert_logger.warning('Rule %s could not read its checkpoint %s: %r' % (
+                self.rules.get('name'), self.checkpoint_file, e))
+            return
+        if state is None:
+            return
+        if state.get('version') != CHECKPOINT_VERSION or state.get('fingerprint') != self.get_checkpoint_fingerprint():
+            elastalert_logger.warning('Rule %s ignored its checkpoint %s, written for other rule options' % (
+                self.rules.get('name'), self.checkpoint_file))
+            return
+
+        for key, window_state, correlation_state in state['keys']:
+            window = self.create_window(key)
+            window.set_state(window_state)
+            self.correlation_states[key].set_state(correlation_state)
+            self.expiry_index.add(key, window)
+            self.num_events += window.count()
+            if self.window_sizes:
+                self.window_sizes.resize(0, window.count())
+        self.cooldowns.update(state['cooldowns'])
+        (self.num_added_events, self.num_sampled_events, self.sampled_event_bytes,
+         self.evicted_keys, self.evicted_events, self.filtered_events) = state['counters']
+        self.restored_until = state['timestamp']
+        resume_query(self, self.restored_until)
+        elastalert_logger.info('Rule %s restored %d query_key values and %d events from %s' % (
+            self.rules.get('name'), len(self.occurrences), self.num_events, self.checkpoint_file))
 
     def get_match_str(self, match):
         lt = self.rules.get('use_local_time')
@@ -0,0 +1,349 @@
+import datetime
+import heapq
+import itertools
+import sys
+from array import array
+
+MICROSECOND = datetime.timedelta(microseconds=1)
+EPOCH = datetime.datetime(1970, 1, 1)
+UTC_EPOCH = EPOCH.replace(tzinfo=datetime.timezone.utc)
+
+
+def to_micros(timestamp):
+    """
+    Converts a datetime to integer microseconds since the epoch. Naive
+    datetimes are taken as UTC, like ElastAlert does.
+    """
+    return (timestamp - (EPOCH if timestamp.tzinfo is None else UTC_EPOCH)) // MICROSECOND
+
+
+def from_micros(micros):
+    """
+    Converts microseconds since the epoch to a UTC datetime.
+    """
+    return UTC_EPOCH + micros * MICROSECOND
+
+
+def estimate_size(value):
+    """
+    Returns an estimate of the memory used by a value decoded from JSON, in
+    bytes, counting the items of dictionaries and lists.
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += sys.getsizeof(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
+
+class ColumnarEventWindow(object):
+    """
+    Time window of the events of one query_key, stored by column in a ring
+    buffer instead of as full Elasticsearch documents.
+
+    It behaves like ElastAlert's EventWindow for what CorrelationRule needs:
+    events are kept ordered by timestamp, and appending an event removes the
+    oldest ones, calling on_removed() for each, until the window spans less
+    than timeframe. For each event it only stores the timestamp (as integer
+    microseconds in an array) and the values of the fields the rule reads,
+    one list per field. The full documents are only kept, by reference, when
+    keep_documents is set, and the newest document is available for the
+    match.
+    """
+    __slots__ = ('timeframe', 'on_removed', 'fields', 'keep_documents', 'timestamps', 'columns',
+                 'documents', 'head', 'size', 'newest_document')
+
+    MIN_CAPACITY = 8
+
+    def __init__(self, timeframe, fields, keep_documents=False, on_removed=None):
+        self.timeframe = timeframe // MICROSECOND
+        self.on_removed = on_removed
+        self.fields = tuple(fields)
+        self.keep_documents = keep_documents
+        self.newest_document = None
+        self.allocate(self.MIN_CAPACITY)
+
+    def allocate(self, capacity):
+        self.timestamps = array('q', bytes(8 * capacity))
+        self.columns = [[None] * capacity for _ in self.fields]
+        self.documents = [None] * capacity if self.keep_documents else None
+        self.head = 0
+        self.size = 0
+
+    def resize(self, capacity):
+        """
+        Moves the events to buffers of the given capacity, starting at index 0.
+        """
+        timestamps = list(self.timestamps_in_order())
+        columns = [self.column_in_order(column) for column in range(len(self.fields))]
+        documents = list(self.documents_in_order()) if self.keep_documents else None
+        self.allocate(capacity)
+        self.size = len(timestamps)
+        self.timestamps[:self.size] = array('q', timestamps)
+        for column, values in zip(self.columns, columns):
+            column[:self.size] = values
+        if self.keep_documents:
+            self.documents[:self.size] = documents
+
+    def slot(self, index):
+        return (self.head + index) % len(self.timestamps)
+
+    def append(self, timestamp, values, document):
+        """
+        Adds an event, given its timestamp (datetime), the values of the fields
+        of the window, in order, and the event document. Returns True if the
+        event is the newest of the window (it was appended at the end), False
+        if it was inserted before newer events.
+        """
+        micros = to_micros(timestamp)
+        if self.size == len(self.timestamps):
+            self.resize(2 * self.size)
+
+        newest = not self.size or micros >= self.timestamps[self.slot(self.size - 1)]
+        if newest:
+            slot = self.slot(self.size)
+            self.timestamps[slot] = micros
+            for column, value in zip(self.columns, values):
+                column[slot] = value
+            if self.keep_documents:
+                self.documents[slot] = document
+            self.size += 1
+            self.newest_document = document
+        else:
+            self.insert(micros, values, document)
+            if self.newest_document is None:
+                self.newest_document = document
+
+        # Remove the oldest events until the window is shorter than timeframe
+        while self.timestamps[self.slot(self.size - 1)] - self.timestamps[self.head] >= self.timeframe:
+            self.popleft()
+            if self.on_removed:
+                self.on_removed()
+        return newest
+
+    def insert(self, micros, values, document):
+        """
+        Inserts an event older than the newest one at its place, after the
+        events with the same timestamp. Linear in the size of the window, but
+        only needed for events arriving out of order.
+        """
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.timestamps[self.slot(middle)] <= micros:
+                low = middle + 1
+            else:
+                high = middle
+        # Linearize the buffers so the event can be inserted with list.insert
+        self.resize(len(self.timestamps))
+        self.timestamps.insert(low, micros)
+        self.timestamps.pop()
+        for column, value in zip(self.columns, values):
+            column.insert(low, value)
+            column.pop()
+        if self.keep_documents:
+            self.documents.insert(low, document)
+            self.documents.pop()
+        self.size += 1
+
+    def popleft(self):
+        head = self.head
+        for column in self.columns:
+            column[head] = None
+        if self.keep_documents:
+            self.documents[head] = None
+        self.head = (head + 1) % len(self.timestamps)
+        self.size -= 1
+        if self.size * 4 < len(self.timestamps) and len(self.timestamps) > self.MIN_CAPACITY:
+            self.resize(max(self.MIN_CAPACITY, len(self.timestamps) // 2))
+
+    def count(self):
+        """ Count the number of events in the window. """
+        return self.size
+
+    def __len__(self):
+        return self.size
+
+    def last_timestamp(self):
+        """
+        Returns the timestamp of the newest event, in microseconds since the
+        epoch.
+        """
+        return self.timestamps[self.slot(self.size - 1)]
+
+    def document(self, index):
+        """
+        Returns the document of the event at index, in timestamp order, or
+        None if the window does not keep documents.
+        """
+        if not self.keep_documents:
+            return None
+        return self.documents[self.slot(index)]
+
+    def value(self, index, column):
+        """ Returns the value of a field of the event at index. """
+        return self.columns[column][self.slot(index)]
+
+    def timestamps_in_order(self):
+        for index in range(self.size):
+            yield self.timestamps[self.slot(index)]
+
+    def column_in_order(self, column):
+        values = self.columns[column]
+        return [values[self.slot(index)] for index in range(self.size)]
+
+    def documents_in_order(self):
+        """
+        Returns the documents of the events in timestamp order, or None for
+        each event if the window does not keep documents.
+        """
+        if not self.keep_documents:
+            return [None] * self.size
+        return [self.documents[self.slot(index)] for index in range(self.size)]
+
+    def get_state(self):
+        """
+        Returns the events of the window as plain lists, for checkpoints: the
+        timestamps, the columns and the documents in timestamp order, and the
+        newest document (its index in the documents when they are kept).
+        """
+        documents = None
+        newest_document = self.newest_document
+        if self.keep_documents:
+            documents = self.documents_in_order()
+            for index in range(self.size - 1, -1, -1):
+                if documents[index] is newest_document:
+                    newest_document = index
+                    break
+        return [list(self.timestamps_in_order()), [self.column_in_order(column) for column in range(len(self.fields))],
+                documents, newest_document]
+
+    def set_state(self, state):
+        """
+        Replaces the events of the window with those of a state returned by
+        get_state.
+        """
+        timestamps, columns, documents, newest_document = state
+        self.load(timestamps, columns, documents)
+        if self.keep_documents:
+            newest_document = documents[newest_document]
+        self.newest_document = newest_document
+
+    def load(self, timestamps, columns, documents):
+        """
+        Replaces the events of the window, given as lists in timestamp order,
+        in buffers of the smallest capacity that holds them.
+        """
+        capacity = self.MIN_CAPACITY
+        while capacity < len(timestamps):
+            capacity *= 2
+        self.allocate(capacity)
+        self.size = len(timestamps)
+        self.timestamps[:self.size] = array('q', timestamps)
+        for column, values in zip(self.columns, columns):
+            column[:self.size] = values
+        if self.keep_documents:
+            self.documents[:self.size] = documents
+
+    def remove(self, indexes):
+        """
+        Removes the events at the given indexes, from anywhere in the window,
+        without calling on_removed. Linear in the size of the window, but only
+        needed for the events consumed by a match. If the newest event is
+        removed and the window does not keep documents, the next event
+        inserted stands for the newest document.
+        """
+        removed = set(indexes)
+        if self.size - 1 in removed:
+            self.newest_document = None
+        kept = [self.slot(index) for index in range(self.size) if index not in removed]
+        documents = [self.documents[slot] for slot in kept] if self.keep_documents else None
+        self.load([self.timestamps[slot] for slot in kept],
+                  [[column[slot] for slot in kept] for column in self.columns], documents)
+        if self.keep_documents and self.size:
+            self.newest_document = documents[-1]
+
+    def rows(self):
+        """
+        Returns the events in timestamp order as tuples of the values of the
+        fields of the window.
+        """
+        columns = [self.column_in_order(column) for column in range(len(self.fields))]
+        if not columns:
+            return [()] * self.size
+        return list(zip(*columns))
+
+
+class ExpiryIndex(object):
+    """
+    Index of the windows of the query_keys by the timestamp of their newest
+    event, so that the windows with no event within timeframe of a given time
+    are found without scanning all of them.
+
+    It is a min-heap of (newest timestamp, entry id, key) entries, with the id
+    of the live entry of each key in entries. An entry is added with add()
+    once the window of a key has its first event, and the timestamps are not
+    updated as events are appended: when an entry comes up as expired, the
+    window is checked and indexed again with its current newest timestamp if
+    it is still live, which happens at most once per timeframe for each
+    window. Entries of keys dropped with discard() are skipped, and the heap
+    is rebuilt without them when they outnumber the live ones.
+    """
+    __slots__ = ('timeframe', 'heap', 'entries', 'counter', 'num_discarded')
+
+    MIN_COMPACTION = 1024
+
+    def __init__(self, timeframe):
+        self.timeframe = timeframe // MICROSECOND
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.num_discarded = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, key, window):
+        entry_id = next(self.counter)
+        self.entries[key] = entry_id
+        heapq.heappush(self.heap, (window.last_timestamp(), entry_id, key))
+
+    def discard(self, key):
+        """
+        Removes a key from the index, if it is indexed.
+        """
+        if self.entries.pop(key, None) is None:
+            return
+        self.num_discarded += 1
+        if self.num_discarded > max(self.MIN_COMPACTION, len(self.entries)):
+            entries = self.entries
+            self.heap = [entry for entry in self.heap if entries.get(entry[2]) == entry[1]]
+            heapq.heapify(self.heap)
+            self.num_discarded = 0
+
+    def pop_expired(self, windows, timestamp):
+        """
+        Returns the keys of windows (a dictionary of key to window) whose
+        newest event is more than timeframe older than timestamp (a
+        datetime), and removes them from the index. Costs O(log n) per expired
+        or re-indexed window.
+        """
+        oldest = to_micros(timestamp) - self.timeframe
+        heap = self.heap
+        entries = self.entries
+        expired = []
+        while heap and heap[0][0] < oldest:
+            _, entry_id, key = heapq.heappop(heap)
+            if entries.get(key) != entry_id:
+                self.num_discarded -= 1
+                continue
+            window = windows[key]
+            if window.last_timestamp() < oldest:
+                del entries[key]
+                expired.append(key)
+            else:
+                self.add(key, window)
+        return expired
@@ -0,0 +1,49 @@
+from functools import partial
+
+from elastalert.util import lookup_es_key
+
+
+def compile_field(path):
+    """
+    Returns an accessor for a field path, a function taking an event and
+    returning the value of the field, or None if the event does not have it.
+
+    The accessor resolves the path like lookup_es_key: at each level the
+    longest literal key is preferred, so user.name matches a literal
+    "user.name" key before the name key of a user object, and resolution stops
+    at the first value that is not an object (which is how a trailing
+    .keyword resolves to the field itself). The candidate keys are joined once
+    here rather than on every lookup. Paths with array indexes (field[0]) are
+    rare and left to lookup_es_key.
+    """
+    if '[' in path:
+        return partial(lookup_es_key, term=path)
+    if '.' not in path:
+        return partial(get_key, key=path)
+
+    subkeys = path.split('.')
+    num_subkeys = len(subkeys)
+    # candidates[start] holds the keys made of subkeys start to end, longest
+    # first, with the subkey the lookup continues from
+    candidates = [tuple(('.'.join(subkeys[start:end]), end) for end in range(num_subkeys, start, -1))
+                  for start in range(num_subkeys)]
+
+    def accessor(event):
+        value = event
+        start = 0
+        while True:
+            for key, end in candidates[start]:
+                if key in value:
+                    value = value[key]
+                    break
+            else:
+                return None
+            if end == num_subkeys or not isinstance(value, dict):
+                return value
+            start = end
+
+    return accessor
+
+
+def get_key(event, key):
+    return event.get(key)
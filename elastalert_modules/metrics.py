@@ -0,0 +1,293 @@
+import bisect
+import cProfile
+import importlib
+import io
+import json
+import os
+import pstats
+import re
+import time
+
+from elastalert.util import elastalert_logger
+
+from elastalert_modules.checkpoint import write_atomically
+
+# Upper bounds of the buckets of the histogram of the number of events in the
+# windows of the query_keys, the last bucket being unbounded
+WINDOW_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+# Counters and gauges of the metrics of a rule, with their Prometheus name,
+# type and help text
+METRICS = (
+    ('events_ingested', 'events_ingested_total', 'counter', 'Events passed to the rule'),
+    ('events_filtered', 'events_filtered_total', 'counter', 'Events dropped by the pre-filter'),
+    ('matches', 'matches_total', 'counter', 'Matches found'),
+    ('keys_evicted', 'keys_evicted_total', 'counter', 'Query keys evicted to stay within the memory bounds'),
+    ('events_evicted', 'events_evicted_total', 'counter', 'Events evicted to stay within the memory bounds'),
+    ('keys', 'keys', 'gauge', 'Query keys with a window'),
+    ('events', 'events', 'gauge', 'Events in the windows'),
+    ('state_bytes', 'state_bytes', 'gauge', 'Estimated memory of the windows and match states'),
+)
+PROMETHEUS_PREFIX = 'elastalert_correlation_'
+# Minimum seconds between two reports of the metrics
+DEFAULT_METRICS_INTERVAL = 60
+
+
+def window_histogram(sizes):
+    """
+    Returns the number of windows in each bucket of WINDOW_BUCKETS, given
+    the number of events of each window.
+    """
+    histogram = [0] * (len(WINDOW_BUCKETS) + 1)
+    for size in sizes:
+        histogram[bisect.bisect_left(WINDOW_BUCKETS, size)] += 1
+    return histogram
+
+
+class WindowHistogram(object):
+    """
+    Number of windows in each bucket of WINDOW_BUCKETS, kept up to date as
+    the windows change size, so that reporting it does not scan the windows.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * (len(WINDOW_BUCKETS) + 1)
+
+    def resize(self, old_size, new_size):
+        """
+        Moves a window of old_size events to the bucket of new_size events.
+        A size of 0 is a window that does not exist.
+        """
+        if old_size == new_size:
+            return
+        if old_size:
+            self.buckets[bisect.bisect_left(WINDOW_BUCKETS, old_size)] -= 1
+        if new_size:
+            self.buckets[bisect.bisect_left(WINDOW_BUCKETS, new_size)] += 1
+
+    def snapshot(self):
+        return list(self.buckets)
+
+
+def merge_metrics(snapshots):
+    """
+    Adds up the metrics of the shards of a rule: the counters, gauges and
+    histogram buckets are summed, and so are the calls and times of the
+    timers, except for their longest call.
+    """
+    merged = dict((name, 0) for name, _, _, _ in METRICS)
+    merged.update({'window_events': [0] * (len(WINDOW_BUCKETS) + 1), 'timers': {}})
+    for snapshot in snapshots:
+        for name, _, _, _ in METRICS:
+            merged[name] += snapshot[name]
+        merged['window_events'] = [total + count for total, count in zip(merged['window_events'],
+                                                                         snapshot['window_events'])]
+        for name, timer in snapshot['timers'].items():
+            total = merged['timers'].setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            total['calls'] += timer['calls']
+            total['seconds'] += timer['seconds']
+            total['max_seconds'] = max(total['max_seconds'], timer['max_seconds'])
+    return merged
+
+
+class Timers(object):
+    """
+    Number of calls, total and longest time of the methods of a rule. The
+    methods are timed by replacing them on the instance with a wrapper (see
+    timed()), so rules without metrics pay nothing.
+    """
+
+    def __init__(self):
+        self.timers = {}
+
+    def timed(self, name, function):
+        timer = self.timers.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        perf_counter = time.perf_counter
+
+        def timed_function(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = perf_counter() - start
+                timer['calls'] += 1
+                timer['seconds'] += elapsed
+                if elapsed > timer['max_seconds']:
+                    timer['max_seconds'] = elapsed
+        return timed_function
+
+    def snapshot(self):
+        return dict((name, dict(timer)) for name, timer in self.timers.items())
+
+
+class LatencyProfiler(object):
+    """
+    Sampling profiler of the batches of a rule. When a call takes longer
+    than threshold seconds, the next call is run under cProfile, at most
+    once per interval seconds, and the functions that took the most time are
+    logged. The profile is also saved to directory, if given, for
+    snakeviz or pstats.
+    """
+
+    def __init__(self, name, threshold, interval, directory=None):
+        self.name = name
+        self.threshold = threshold
+        self.interval = interval
+        self.directory = directory
+        self.triggered = False
+        self.next_profile = 0
+
+    def wrap(self, function):
+        def profiled_function(*args, **kwargs):
+            if self.triggered:
+                self.triggered = False
+                return self.profile(function, *args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            if time.perf_counter() - start > self.threshold and time.time() >= self.next_profile:
+                self.triggered = True
+                self.next_profile = time.time() + self.interval
+            return result
+        return profiled_function
+
+    def profile(self, function, *args, **kwargs):
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats('tottime').print_stats(15)
+            path = None
+            if self.directory:
+                path = os.path.join(self.directory, '%s-%s.prof' % (
+                    re.sub(r'[^\w.-]+', '_', self.name), time.strftime('%Y%m%dT%H%M%S')))
+                try:
+                    profiler.dump_stats(path)
+                except OSError as e:
+                    elastalert_logger.error('Rule %s could not save its profile to %s: %s' % (self.name, path, e))
+                    path = None
+            elastalert_logger.warning('Rule %s was slow, profile of a batch of %.3f seconds%s:\n%s' % (
+                self.name, elapsed, ' saved to %s' % path if path else '', output.getvalue()))
+
+
+class LogSink(object):
+    """ Logs the metrics as JSON, at the info level. """
+
+    def __init__(self, rules):
+        pass
+
+    def emit(self, name, metrics):
+        elastalert_logger.info('Rule %s metrics: %s' % (name, json.dumps(metrics, sort_keys=True)))
+
+
+class PrometheusSink(object):
+    """
+    Writes the metrics to metrics_file in the Prometheus text format, for
+    the textfile collector of the node exporter. The file is replaced
+    atomically at each report.
+    """
+
+    def __init__(self, rules):
+        if not rules.get('metrics_file'):
+            raise ValueError('the prometheus sink requires a metrics_file')
+        self.path = rules['metrics_file']
+
+    def emit(self, name, metrics):
+        try:
+            write_atomically(self.path, format_prometheus(name, metrics).encode('utf-8'), mode=0o644)
+        except OSError as e:
+            elastalert_logger.error('Rule %s could not write its metrics to %s: %s' % (name, self.path, e))
+
+
+class WritebackSink(object):
+    """
+    Writes the metrics to ElastAlert2's status index (writeback_index), as
+    documents with the name of the rule in correlation_rule and the metrics
+    in correlation_metrics. They have no rule_name, so that ElastAlert2
+    does not take them for the status of a run of the rule.
+    """
+
+    def __init__(self, rules):
+        # Only this sink needs the Elasticsearch client of ElastAlert2
+        from elasticsearch.exceptions import ElasticsearchException
+        from elastalert.util import dt_to_ts, elasticsearch_client, ts_now
+        self.rules = rules
+        self.errors = ElasticsearchException
+        self.dt_to_ts = dt_to_ts
+        self.elasticsearch_client = elasticsearch_client
+        self.ts_now = ts_now
+        self.client = None
+
+    def emit(self, name, metrics):
+        try:
+            if self.client is None:
+                self.client = self.elasticsearch_client(self.rules)
+            index = self.client.resolve_writeback_index(self.rules['writeback_index'], 'elastalert_status')
+            self.client.index(index=index, body={'@timestamp': self.dt_to_ts(self.ts_now()),
+                                                 'correlation_rule': name, 'correlation_metrics': metrics})
+        except self.errors as e:
+            elastalert_logger.error('Rule %s could not write its metrics to Elasticsearch: %s' % (name, e))
+
+
+METRICS_SINKS = {
+    'log': LogSink,
+    'prometheus': PrometheusSink,
+    'writeback': WritebackSink,
+}
+
+
+def make_sink(sink, rules):
+    """
+    Returns a new metrics sink, given its name in METRICS_SINKS or the
+    dotted path of a class (module.Class) with the same interface: created
+    with the options of the rule, and with an emit(name, metrics) method.
+    Raises ValueError if the sink is unknown or its options are invalid.
+    """
+    sink_class = METRICS_SINKS.get(sink)
+    if sink_class is None:
+        module_name, _, class_name = sink.rpartition('.')
+        try:
+            sink_class = getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError, ValueError):
+            raise ValueError('Unknown metrics sink %r, expected one of %s or a module.Class path' % (
+                sink, ', '.join(sorted(METRICS_SINKS))))
+    return sink_class(rules)
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_prometheus(name, metrics):
+    """
+    Returns the metrics of a rule in the Prometheus text format, labelled
+    with the rule name.
+    """
+    rule = 'rule="%s"' % escape_label(name)
+    lines = []
+    for key, metric, metric_type, description in METRICS:
+        lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, metric, description))
+        lines.append('# TYPE %s%s %s' % (PROMETHEUS_PREFIX, metric, metric_type))
+        lines.append('%s%s{%s} %s' % (PROMETHEUS_PREFIX, metric, rule, metrics[key]))
+
+    histogram = PROMETHEUS_PREFIX + 'window_size'
+    lines.append('# HELP %s Number of events in the windows of the query keys' % histogram)
+    lines.append('# TYPE %s histogram' % histogram)
+    count = 0
+    for bound, windows in zip(WINDOW_BUCKETS + ('+Inf',), metrics['window_events']):
+        count += windows
+        lines.append('%s_bucket{%s,le="%s"} %d' % (histogram, rule, bound, count))
+    lines.append('%s_sum{%s} %d' % (histogram, rule, metrics['events']))
+    lines.append('%s_count{%s} %d' % (histogram, rule, count))
+
+    for field, metric, metric_type, description in (
+            ('calls', 'calls_total', 'counter', 'Calls of the methods of the rule'),
+            ('seconds', 'seconds_total', 'counter', 'Time spent in the methods of the rule'),
+            ('max_seconds', 'max_seconds', 'gauge', 'Longest call of the methods of the rule')):
+        lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, metric, description))
+        lines.append('# TYPE %s%s %s' % (PROMETHEUS_PREFIX, metric, metric_type))
+        for function, timer in sorted(metrics['timers'].items()):
+            lines.append('%s%s{%s,function="%s"} %s' % (PROMETHEUS_PREFIX, metric, rule, function, timer[field]))
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,314 @@
+import datetime
+import ipaddress
+import operator
+from functools import partial
+
+from elastalert.util import ts_to_dt
+
+from elastalert_modules.aggregations import compile_aggregation
+from elastalert_modules.event_store import MICROSECOND, to_micros
+
+
+def to_text(value):
+    return None if value is None else str(value)
+
+
+def to_casefolded_text(value):
+    return None if value is None else str(value).casefold()
+
+
+def to_float(value):
+    """
+    Returns a value as a float, parsing its text, or None if it is not a
+    number.
+    """
+    if value is None:
+        return None
+    try:
+        return float(str(value))
+    except ValueError:
+        return None
+
+
+def to_timestamp(value):
+    """
+    Returns a timestamp as integer microseconds since the epoch, or None if it
+    is not one. Text is parsed like ElastAlert2 parses timestamps, and
+    numbers are epoch milliseconds, the default format of Elasticsearch dates.
+    """
+    if isinstance(value, datetime.datetime):
+        return to_micros(value)
+    if isinstance(value, str):
+        try:
+            return to_micros(ts_to_dt(value))
+        except (ValueError, OverflowError, TypeError):
+            return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value * 1000)
+    return None
+
+
+def to_subnet(value, ipv4_shift, ipv6_shift):
+    """
+    Returns the network an IP address belongs to, as an integer: its address
+    shifted right by ipv4_shift or ipv6_shift bits, negated for IPv6 so that
+    the networks of the two versions never compare equal. IPv4-mapped IPv6
+    addresses are IPv4 addresses. Returns None if the value is not an IP
+    address.
+    """
+    if value is None:
+        return None
+    try:
+        address = ipaddress.ip_address(str(value))
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    if address.version == 4:
+        return int(address) >> ipv4_shift
+    return -1 - (int(address) >> ipv6_shift)
+
+
+def test_not_equal(value1, value2):
+    return value1 is not None and value2 is not None and value1 != value2
+
+
+def test_greater_than(value1, value2):
+    return value1 is not None and value2 is not None and value1 > value2
+
+
+def test_less_than(value1, value2):
+    return value1 is not None and value2 is not None and value1 < value2
+
+
+def test_contains(value1, value2):
+    return value1 is not None and value2 is not None and value2 in value1
+
+
+def test_not_contains(value1, value2):
+    return value1 is not None and value2 is not None and value2 not in value1
+
+
+def test_time_within(value1, value2, duration):
+    return value1 is not None and value2 is not None and abs(value1 - value2) <= duration
+
+
+def test_time_apart(value1, value2, duration):
+    return value1 is not None and value2 is not None and abs(value1 - value2) > duration
+
+
+# The compare_fields conditions: the type both values are coerced to before
+# they are compared (text, number, ip or timestamp), and the test of the
+# coerced value of the event and captured value, None for the conditions
+# that are equality of the coerced values. A missing value, or one that
+# cannot be coerced, never passes.
+COMPARISON_CONDITIONS = {
+    'equal': ('text', None),
+    'not_equal': ('text', test_not_equal),
+    'greater_than': ('number', test_greater_than),
+    'less_than': ('number', test_less_than),
+    'contains': ('text', test_contains),
+    'not_contains': ('text', test_not_contains),
+    'same_subnet': ('ip', None),
+    'different_subnet': ('ip', test_not_equal),
+    'time_within': ('timestamp', test_time_within),
+    'time_apart': ('timestamp', test_time_apart),
+}
+# Tests of the value of an aggregation against its aggregation_count, by
+# aggregation_condition
+AGGREGATION_CONDITIONS = {
+    'above': operator.ge,
+    'below': operator.le,
+}
+DEFAULT_PREFIX_LENGTH = 24
+DEFAULT_IPV6_PREFIX_LENGTH = 64
+
+
+class Comparison(object):
+    """
+    A compare_fields entry: the field of the event and the capture alias it
+    is compared to, and its condition compiled into:
+    - coercion: a key identifying coerce, for the values to be coerced once
+      per event and per capture rather than per comparison
+    - coerce: the function converting the values to the type of the
+      condition, see COMPARISON_CONDITIONS
+    - test: the test of the coerced values, None for equality, which the
+      matcher does with a hash join
+    """
+    __slots__ = ('field', 'to', 'condition', 'coercion', 'coerce', 'test')
+
+    def __init__(self, config):
+        if not isinstance(config, dict) or not config.get('field') or not config.get('to'):
+            raise ValueError('compare_fields entries require a field and a to, got %r' % (config,))
+        self.field = config['field']
+        self.to = config['to']
+        self.condition = config.get('condition', 'not_equal')
+        if self.condition not in COMPARISON_CONDITIONS:
+            raise ValueError('Unknown condition %r of compare_fields %s, expected one of: %s' % (
+                self.condition, self.field, ', '.join(sorted(COMPARISON_CONDITIONS))))
+        value_type, self.test = COMPARISON_CONDITIONS[self.condition]
+        if value_type == 'text' and config.get('ignore_case', False):
+            self.coercion, self.coerce = 'casefolded', to_casefolded_text
+        elif value_type == 'text':
+            self.coercion, self.coerce = 'text', to_text
+        elif value_type == 'number':
+            self.coercion, self.coerce = 'number', to_float
+        elif value_type == 'timestamp':
+            self.coercion, self.coerce = 'timestamp', to_timestamp
+            self.test = partial(self.test, duration=parse_duration(config.get('duration'), self.condition))
+        else:
+            prefix_length = config.get('prefix_length', DEFAULT_PREFIX_LENGTH)
+            ipv6_prefix_length = config.get('ipv6_prefix_length', DEFAULT_IPV6_PREFIX_LENGTH)
+            for option, value, bits in (('prefix_length', prefix_length, 32),
+                                        ('ipv6_prefix_length', ipv6_prefix_length, 128)):
+                if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= bits:
+                    raise ValueError('%s of compare_fields %s must be between 0 and %d, got %r' % (
+                        option, self.field, bits, value))
+            self.coercion = ('subnet', prefix_length, ipv6_prefix_length)
+            self.coerce = partial(to_subnet, ipv4_shift=32 - prefix_length, ipv6_shift=128 - ipv6_prefix_length)
+
+    @property
+    def equal(self):
+        return self.test is None
+
+
+def parse_duration(duration, condition):
+    """
+    Returns a duration given like timeframe ({minutes: 5}) in microseconds.
+    Raises ValueError if it is missing or invalid.
+    """
+    try:
+        if not isinstance(duration, datetime.timedelta):
+            duration = datetime.timedelta(**duration)
+    except TypeError:
+        raise ValueError('the %s condition requires a duration such as {minutes: 5}, got %r' % (condition, duration))
+    return duration // MICROSECOND
+
+
+class Position(object):
+    """
+    A correlated event of a rule, validated and compiled when the rule is
+    loaded, so that matching events does not read its configuration:
+    - index: index of the position, in position order
+    - position: its configured position number
+    - captures: (field, alias) pairs of its capture_fields
+    - comparisons: its compare_fields, as Comparison objects
+    """
+    __slots__ = ('index', 'position', 'captures', 'comparisons')
+    is_aggregation = False
+
+    def __init__(self, index, config):
+        self.index = index
+        self.position = config['position']
+        captures = config.get('capture_fields') or []
+        comparisons = config.get('compare_fields') or []
+        if not isinstance(captures, list) or not isinstance(comparisons, list):
+            raise ValueError('capture_fields and compare_fields of position %s must be lists' % self.position)
+        for capture in captures:
+            if not isinstance(capture, dict) or not capture.get('field') or not capture.get('as'):
+                raise ValueError('capture_fields entries require a field and an as, got %r' % (capture,))
+        self.captures = tuple((capture['field'], capture['as']) for capture in captures)
+        self.comparisons = tuple(Comparison(comparison) for comparison in comparisons)
+
+    def fields(self):
+        """
+        Returns the fields the position reads, in a stable order.
+        """
+        return [field for field, _ in self.captures] + [comparison.field for comparison in self.comparisons]
+
+
+class KeyValuePosition(Position):
+    """
+    A position matched by the events whose key field has value.
+    """
+    __slots__ = ('key', 'value')
+
+    def __init__(self, index, config):
+        super(KeyValuePosition, self).__init__(index, config)
+        if not config.get('key') or 'value' not in config:
+            raise ValueError('position %s requires a key and a value, or type: aggregation' % self.position)
+        self.key = config['key']
+        self.value = config['value']
+
+    def fields(self):
+        return [self.key] + super(KeyValuePosition, self).fields()
+
+
+class AggregationPosition(Position):
+    """
+    A position matched by the events that match query once the aggregation
+    of those events reaches count: test(value, count) is true, with the test
+    of aggregation_condition (at least count when above, at most count when
+    below). new_aggregation creates the running aggregation of a window, and
+    predicate is the compiled query.
+    """
+    __slots__ = ('query', 'predicate', 'aggregation_field', 'count', 'test', 'new_aggregation', 'uses_field')
+    is_aggregation = True
+
+    def __init__(self, index, config, predicate):
+        super(AggregationPosition, self).__init__(index, config)
+        self.query = config.get('query', '')
+        self.predicate = predicate
+        self.aggregation_field = config.get('aggregation_field')
+        self.count = parse_number(config.get('aggregation_count', 1), 'aggregation_count')
+        condition = config.get('aggregation_condition', 'above')
+        if condition not in AGGREGATION_CONDITIONS:
+            raise ValueError('Unknown aggregation_condition %r of position %s, expected one of: %s' % (
+                condition, self.position, ', '.join(sorted(AGGREGATION_CONDITIONS))))
+        self.test = AGGREGATION_CONDITIONS[condition]
+        self.new_aggregation = compile_aggregation(config)
+        self.uses_field = self.new_aggregation.func.uses_field
+        if self.uses_field and not self.aggregation_field:
+            raise ValueError('position %s requires an aggregation_field' % self.position)
+
+    def fields(self):
+        fields = sorted(self.predicate.fields())
+        if self.aggregation_field:
+            fields.append(self.aggregation_field)
+        return fields + super(AggregationPosition, self).fields()
+
+
+def parse_number(value, option):
+    """
+    Returns a numeric option, given as a number or as the text of a number.
+    Raises ValueError if it is neither.
+    """
+    if isinstance(value, str):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+        else:
+            return int(value) if value.is_integer() else value
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError('%s must be a number, got %r' % (option, value))
+    return value
+
+
+def compile_positions(correlated_events, get_predicate):
+    """
+    Returns the correlated events of a rule compiled into Position objects, in
+    position order. get_predicate returns the compiled predicate of a query.
+    Raises ValueError if the configuration is invalid, including comparisons
+    with a value that no earlier position captures.
+    """
+    if not isinstance(correlated_events, list) or not correlated_events:
+        raise ValueError('correlated_events must be a non-empty list')
+    for config in correlated_events:
+        if not isinstance(config, dict) or isinstance(config.get('position'), bool) or \
+                not isinstance(config.get('position'), (int, float)):
+            raise ValueError('correlated_events entries require a numeric position, got %r' % (config,))
+    positions = []
+    captured = set()
+    for index, config in enumerate(sorted(correlated_events, key=lambda d: d['position'])):
+        if config.get('type') == 'aggregation':
+            position = AggregationPosition(index, config, get_predicate(config.get('query', '')))
+        else:
+            position = KeyValuePosition(index, config)
+        for comparison in position.comparisons:
+            if comparison.to not in captured:
+                raise ValueError('compare_fields of position %s compares %s to %s, which no earlier position '
+                                 'captures' % (position.position, comparison.field, comparison.to))
+        captured.update(alias for _, alias in position.captures)
+        positions.append(position)
+    return positions
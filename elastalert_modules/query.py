@@ -0,0 +1,591 @@
+import copy
+import re
+
+from elastalert_modules.fields import compile_field
+
+
+class QuerySyntaxError(ValueError):
+    """
+    Raised when a query of a correlated event cannot be compiled.
+    """
+    pass
+
+
+def value_to_text(value):
+    """
+    Converts an event value to the text it is matched against: its str(),
+    like the key/value positions compare it, so booleans are True and False.
+    """
+    return str(value)
+
+
+def value_to_number(text):
+    """
+    Returns text as a float, or None if it is not a number.
+    """
+    try:
+        return float(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class Predicate(object):
+    """
+    Base class of the nodes of a compiled query. Calling a predicate with an
+    event returns True if the event matches it.
+    """
+    __slots__ = ()
+
+    def __call__(self, event):
+        raise NotImplementedError()
+
+    def fields(self):
+        """
+        Returns the set of the fields the predicate reads.
+        """
+        raise NotImplementedError()
+
+    def bind(self, accessors):
+        """
+        Returns a copy of the predicate that reads fields with the given
+        accessors, a dictionary of field name to a function returning the
+        value of the field from what the predicate is called with. CorrelationRule
+        uses it to match the projection of an event instead of its document.
+        """
+        raise NotImplementedError()
+
+    def to_query(self):
+        """
+        Returns the predicate as an Elasticsearch query DSL clause.
+        """
+        raise NotImplementedError()
+
+
+class FieldPredicate(Predicate):
+    """
+    Base class of the predicates testing the value of a single field. If the
+    field holds a list, the predicate matches if any item matches, like
+    Elasticsearch does.
+    """
+    __slots__ = ('field', 'get_value')
+
+    def __init__(self, field):
+        self.field = field
+        self.get_value = compile_field(field)
+
+    def __call__(self, event):
+        value = self.get_value(event)
+        if value is None:
+            return False
+        if isinstance(value, list):
+            return any(item is not None and self.match_value(item) for item in value)
+        return self.match_value(value)
+
+    def fields(self):
+        return {self.field}
+
+    def bind(self, accessors):
+        bound = copy.copy(self)
+        bound.get_value = accessors[self.field]
+        return bound
+
+    def match_value(self, value):
+        raise NotImplementedError()
+
+
+class Term(FieldPredicate):
+    """ field:value or field:"quoted phrase" """
+    __slots__ = ('value',)
+
+    def __init__(self, field, value):
+        super(Term, self).__init__(field)
+        self.value = value
+
+    def match_value(self, value):
+        return value_to_text(value) == self.value
+
+    def to_query(self):
+        return {'term': {self.field: self.value}}
+
+    def __repr__(self):
+        return 'Term(%r, %r)' % (self.field, self.value)
+
+
+class Terms(FieldPredicate):
+    """ field:(value1 OR value2 OR ...) """
+    __slots__ = ('values',)
+
+    def __init__(self, field, values):
+        super(Terms, self).__init__(field)
+        self.values = frozenset(values)
+
+    def match_value(self, value):
+        return value_to_text(value) in self.values
+
+    def to_query(self):
+        return {'terms': {self.field: sorted(self.values)}}
+
+    def __repr__(self):
+        return 'Terms(%r, %r)' % (self.field, sorted(self.values))
+
+
+class Wildcard(FieldPredicate):
+    """ field:val*e? """
+    __slots__ = ('pattern', 'regex')
+
+    def __init__(self, field, pattern):
+        super(Wildcard, self).__init__(field)
+        self.pattern = pattern
+        regex = []
+        escaped = False
+        for char in pattern:
+            if escaped or char not in '*?\\':
+                regex.append(re.escape(char))
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            else:
+                regex.append('.*' if char == '*' else '.')
+        self.regex = re.compile(''.join(regex) + r'\Z', re.DOTALL)
+
+    def match_value(self, value):
+        return self.regex.match(value_to_text(value)) is not None
+
+    def to_query(self):
+        return {'wildcard': {self.field: {'value': self.pattern}}}
+
+    def __repr__(self):
+        return 'Wildcard(%r, %r)' % (self.field, self.pattern)
+
+
+class Exists(FieldPredicate):
+    """ field:* """
+    __slots__ = ()
+
+    def match_value(self, value):
+        return True
+
+    def to_query(self):
+        return {'exists': {'field': self.field}}
+
+    def __repr__(self):
+        return 'Exists(%r)' % (self.field,)
+
+
+class Range(FieldPredicate):
+    """
+    field:[low TO high], field:{low TO high}, field:>low, field:<=high, ...
+
+    Bounds that are numbers are compared numerically with the event value,
+    other bounds are compared as text. None is an unbounded side.
+    """
+    __slots__ = ('lower', 'upper', 'include_lower', 'include_upper', 'numeric')
+
+    def __init__(self, field, lower, upper, include_lower=True, include_upper=True):
+        super(Range, self).__init__(field)
+        bounds = [bound for bound in (lower, upper) if bound is not None]
+        self.numeric = all(value_to_number(bound) is not None for bound in bounds)
+        if self.numeric:
+            lower = value_to_number(lower)
+            upper = value_to_number(upper)
+        self.lower = lower
+        self.upper = upper
+        self.include_lower = include_lower
+        self.include_upper = include_upper
+
+    def match_value(self, value):
+        if self.numeric:
+            value = value if isinstance(value, (int, float)) and not isinstance(value, bool) else \
+                value_to_number(value)
+            if value is None:
+                return False
+        else:
+            value = value_to_text(value)
+        if self.lower is not None:
+            if value < self.lower or (value == self.lower and not self.include_lower):
+                return False
+        if self.upper is not None:
+            if value > self.upper or (value == self.upper and not self.include_upper):
+                return False
+        return True
+
+    def to_query(self):
+        bounds = {}
+        if self.lower is not None:
+            bounds['gte' if self.include_lower else 'gt'] = self.lower
+        if self.upper is not None:
+            bounds['lte' if self.include_upper else 'lt'] = self.upper
+        return {'range': {self.field: bounds}}
+
+    def __repr__(self):
+        return 'Range(%r, %r, %r, %r, %r)' % (self.field, self.lower, self.upper,
+                                              self.include_lower, self.include_upper)
+
+
+class And(Predicate):
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def __call__(self, event):
+        for child in self.children:
+            if not child(event):
+                return False
+        return True
+
+    def fields(self):
+        return set().union(*(child.fields() for child in self.children))
+
+    def bind(self, accessors):
+        return And(child.bind(accessors) for child in self.children)
+
+    def to_query(self):
+        return {'bool': {'filter': [child.to_query() for child in self.children]}}
+
+    def __repr__(self):
+        return 'And(%r)' % (list(self.children),)
+
+
+class Or(Predicate):
+    __slots__ = ('children',)
+
+    def __init__(self, children):
+        self.children = tuple(children)
+
+    def __call__(self, event):
+        for child in self.children:
+            if child(event):
+                return True
+        return False
+
+    def fields(self):
+        return set().union(*(child.fields() for child in self.children))
+
+    def bind(self, accessors):
+        return Or(child.bind(accessors) for child in self.children)
+
+    def to_query(self):
+        return {'bool': {'should': [child.to_query() for child in self.children], 'minimum_should_match': 1}}
+
+    def __repr__(self):
+        return 'Or(%r)' % (list(self.children),)
+
+
+class Not(Predicate):
+    __slots__ = ('child',)
+
+    def __init__(self, child):
+        self.child = child
+
+    def __call__(self, event):
+        return not self.child(event)
+
+    def fields(self):
+        return self.child.fields()
+
+    def bind(self, accessors):
+        return Not(self.child.bind(accessors))
+
+    def to_query(self):
+        return {'bool': {'must_not': [self.child.to_query()]}}
+
+    def __repr__(self):
+        return 'Not(%r)' % (self.child,)
+
+
+# Token types
+PHRASE = 'phrase'
+WORD = 'word'
+SYMBOL = 'symbol'
+
+OPERATORS = {'AND': 'AND', '&&': 'AND', 'OR': 'OR', '||': 'OR', 'NOT': 'NOT', '!': 'NOT', '-': 'NOT'}
+SYMBOLS = ('>=', '<=', '&&', '||', '(', ')', '[', ']', '{', '}', ':', '>', '<', '!')
+# Prefixes of a word or group making it a required (+) or prohibited (-)
+# clause, tokenized as symbols
+MODIFIERS = ('+', '-')
+
+# How a clause of an or_expr takes part in the match, like the occur of the
+# clauses of a Lucene boolean query
+SHOULD = 'should'
+MUST = 'must'
+MUST_NOT = 'must_not'
+
+
+def tokenize(query):
+    """
+    Splits a query into (type, text) tokens. Words keep their wildcards, and
+    backslash escapes are resolved in words and phrases.
+    """
+    tokens = []
+    position = 0
+    length = len(query)
+    while position < length:
+        char = query[position]
+        if char.isspace():
+            position += 1
+        elif char == '"':
+            text = []
+            position += 1
+            while position < length and query[position] != '"':
+                if query[position] == '\\' and position + 1 < length:
+                    position += 1
+                text.append(query[position])
+                position += 1
+            if position >= length:
+                raise QuerySyntaxError('Unterminated quoted phrase in query: %s' % query)
+            tokens.append((PHRASE, ''.join(text)))
+            position += 1
+        elif char in MODIFIERS and position + 1 < length and not query[position + 1].isspace():
+            tokens.append((SYMBOL, char))
+            position += 1
+        else:
+            for symbol in SYMBOLS:
+                if query.startswith(symbol, position):
+                    tokens.append((SYMBOL, symbol))
+                    position += len(symbol)
+                    break
+            else:
+                text = []
+                while position < length:
+                    char = query[position]
+                    if char == '\\' and position + 1 < length:
+                        # Escaped wildcards are kept escaped, see word_to_predicate
+                        if query[position + 1] in '*?':
+                            text.append('\\')
+                        text.append(query[position + 1])
+                        position += 2
+                        continue
+                    if char.isspace() or char == '"' or any(query.startswith(symbol, position) for symbol in SYMBOLS):
+                        break
+                    text.append(char)
+                    position += 1
+                tokens.append((WORD, ''.join(text)))
+    return tokens
+
+
+class QueryParser(object):
+    """
+    Recursive descent parser for the subset of the Lucene query syntax
+    supported by correlated events:
+
+    query      := or_expr
+    or_expr    := clause (('OR' | '||')? clause)*
+    clause     := '+'? and_expr
+    and_expr   := not_expr (('AND' | '&&') not_expr)*
+    not_expr   := ('NOT' | '!' | '-' | '+') not_expr | '(' or_expr ')' | field ':' value
+    value      := term | phrase | range | ('>' | '>=' | '<' | '<=') term
+                | '(' value_or ')'
+
+    Inside parentheses after a field, value_or follows the same rules as
+    or_expr, with bare terms bound to that field. Terms default to OR when no
+    operator separates them, like query_string's default_operator. As in
+    Lucene, the clauses of an or_expr are optional (should), but a clause
+    that is only a negation is prohibited (must_not) and one prefixed with +
+    is required (must): a:1 NOT b:2 means a:1 AND NOT b:2, and the optional
+    clauses are ignored when there are required ones.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = tokenize(query)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise QuerySyntaxError('Empty query')
+        predicate = self.parse_or(None)
+        if self.position < len(self.tokens):
+            self.error('Unexpected %r' % (self.tokens[self.position][1],))
+        return predicate
+
+    def error(self, message):
+        raise QuerySyntaxError('%s in query: %s' % (message, self.query))
+
+    def peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            self.error('Unexpected end')
+        self.position += 1
+        return token
+
+    def next_value(self):
+        """
+        Returns the next token, a value, which keeps its leading + or -:
+        field:-5 is the value -5.
+        """
+        token = self.next()
+        if token[0] == SYMBOL and token[1] in MODIFIERS and self.peek()[0] == WORD:
+            return (WORD, token[1] + self.next()[1])
+        return token
+
+    def operator(self):
+        token_type, text = self.peek()
+        if token_type in (WORD, SYMBOL):
+            return OPERATORS.get(text)
+        return None
+
+    def at_group_end(self):
+        return self.peek() in ((None, None), (SYMBOL, ')'))
+
+    def parse_or(self, field):
+        clauses = {SHOULD: [], MUST: [], MUST_NOT: []}
+        occur, predicate = self.parse_clause(field)
+        clauses[occur].append(predicate)
+        while not self.at_group_end():
+            if self.operator() == 'OR':
+                self.position += 1
+            elif self.operator() == 'AND':
+                self.error('Unexpected AND')
+            occur, predicate = self.parse_clause(field)
+            clauses[occur].append(predicate)
+        if clauses[MUST]:
+            children = clauses[MUST]
+        elif len(clauses[SHOULD]) > 1:
+            children = [merge_terms(Or(clauses[SHOULD]))]
+        else:
+            children = clauses[SHOULD]
+        children = children + [Not(predicate) for predicate in clauses[MUST_NOT]]
+        if len(children) == 1:
+            return children[0]
+        return And(children)
+
+    def parse_clause(self, field):
+        """
+        Returns the occur of a clause of an or_expr and its predicate, which
+        for a prohibited clause is the predicate it negates.
+        """
+        if self.peek() == (SYMBOL, '+'):
+            self.position += 1
+            return MUST, self.parse_and(field)
+        predicate = self.parse_and(field)
+        if isinstance(predicate, Not):
+            return MUST_NOT, predicate.child
+        return SHOULD, predicate
+
+    def parse_and(self, field):
+        children = [self.parse_not(field)]
+        while self.operator() == 'AND':
+            self.position += 1
+            children.append(self.parse_not(field))
+        if len(children) == 1:
+            return children[0]
+        return And(children)
+
+    def parse_not(self, field):
+        if self.operator() == 'NOT':
+            self.position += 1
+            return Not(self.parse_not(field))
+        if self.peek() == (SYMBOL, '+'):
+            self.position += 1
+            return self.parse_not(field)
+        token_type, text = self.peek()
+        if (token_type, text) == (SYMBOL, '('):
+            self.position += 1
+            predicate = self.parse_or(field)
+            if self.next() != (SYMBOL, ')'):
+                self.error('Missing )')
+            return predicate
+        if field is not None:
+            return self.parse_value(field)
+        token_type, field = self.next()
+        if token_type != WORD or self.peek() != (SYMBOL, ':'):
+            self.error('Expected field:value, got %r' % (field,))
+        self.position += 1
+        if self.peek() == (SYMBOL, '('):
+            self.position += 1
+            predicate = self.parse_or(field)
+            if self.next() != (SYMBOL, ')'):
+                self.error('Missing )')
+            return predicate
+        return self.parse_value(field)
+
+    def parse_value(self, field):
+        token_type, text = self.next_value()
+        if token_type == PHRASE:
+            return Term(field, text)
+        if token_type == WORD:
+            return word_to_predicate(field, text)
+        if text in ('[', '{'):
+            lower = self.parse_bound()
+            if self.next() != (WORD, 'TO'):
+                self.error('Expected TO in range')
+            upper = self.parse_bound()
+            closing = self.next()
+            if closing not in ((SYMBOL, ']'), (SYMBOL, '}')):
+                self.error('Missing ] or } in range')
+            return Range(field, lower, upper, include_lower=text == '[', include_upper=closing[1] == ']')
+        if text in ('>', '>=', '<', '<='):
+            bound = self.parse_bound()
+            if text.startswith('>'):
+                return Range(field, bound, None, include_lower=text == '>=')
+            return Range(field, None, bound, include_upper=text == '<=')
+        self.error('Unexpected %r' % (text,))
+
+    def parse_bound(self):
+        token_type, text = self.next_value()
+        if token_type not in (WORD, PHRASE):
+            self.error('Expected range bound, got %r' % (text,))
+        if token_type == WORD and text == '*':
+            return None
+        return text
+
+
+def word_to_predicate(field, word):
+    """
+    Returns the predicate for an unquoted value: Exists for *, Wildcard if it
+    has unescaped wildcards, Term otherwise.
+    """
+    if word == '*':
+        return Exists(field)
+    text = []
+    wildcard = False
+    escaped = False
+    for char in word:
+        if escaped:
+            text.append(char)
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        else:
+            wildcard = wildcard or char in '*?'
+            text.append(char)
+    if wildcard:
+        return Wildcard(field, word)
+    return Term(field, ''.join(text))
+
+
+def merge_terms(predicate):
+    """
+    Merges the Term children of an Or that test the same field into a single
+    Terms, so that OR lists are matched with one set lookup.
+    """
+    values_by_field = {}
+    others = []
+    for child in predicate.children:
+        if isinstance(child, Term):
+            values_by_field.setdefault(child.field, []).append(child.value)
+        elif isinstance(child, Terms):
+            values_by_field.setdefault(child.field, []).extend(child.values)
+        else:
+            others.append(child)
+    children = [Terms(field, values) if len(values) > 1 else Term(field, values[0])
+                for field, values in values_by_field.items()] + others
+    if len(children) == 1:
+        return children[0]
+    return Or(children)
+
+
+def compile_query(query):
+    """
+    Compiles a Lucene-style query into a predicate. The predicate is called
+    with an event and returns True if the event matches the query.
+
+    Raises QuerySyntaxError if the query is not supported.
+    """
+    return QueryParser(query).parse()
@@ -0,0 +1,266 @@
+import collections
+import datetime
+import json
+import os
+import time
+from operator import itemgetter
+
+import yaml
+from elastalert.ruletypes import RuleType
+from elastalert.util import EAException, elastalert_logger
+
+from elastalert_modules.custom_rule_types import (CorrelationRule, lookup_values, make_metrics_sinks,
+                                                  profile_slow_runs, push_down_query, query_key_fields, resume_query,
+                                                  warn_resume_gap)
+from elastalert_modules.fields import compile_field
+from elastalert_modules.metrics import DEFAULT_METRICS_INTERVAL, merge_metrics
+
+# Options of the group passed on to its rules, which they can override
+GROUP_OPTIONS = ('num_events', 'timeframe', 'query_key', 'attach_related', 'related_events', 'max_related_events',
+                 'on_match', 'match_cooldown', 'max_keys', 'max_events_per_key', 'max_memory_mb',
+                 'checkpoint_interval', 'use_local_time', 'custom_pretty_ts_format')
+# Options of the rules that only apply to a rule running its own query, and
+# that the group ignores
+IGNORED_RULE_OPTIONS = ('workers', 'batch_mode', 'push_down_filter', 'limit_source_fields', 'profile_threshold_ms')
+# Field of the matches holding their rule and query_key value, which is the
+# query_key of the group, so that realert silences each rule separately
+MATCH_KEY_FIELD = 'correlation_key'
+
+
+def make_projection(indexes):
+    """
+    Returns a function returning the values at indexes of a tuple, as a
+    tuple.
+    """
+    if len(indexes) > 1:
+        return itemgetter(*indexes)
+    if indexes:
+        index = indexes[0]
+        return lambda values: (values[index],)
+    return lambda values: ()
+
+
+class CorrelationRuleGroup(RuleType):
+    """
+    Several correlation rules evaluated in one pass over the events of a
+    single query, for rules that read the same index. The rules, given in
+    correlation_rules inline or as the paths of their rule files, keep their
+    own windows and match state, but the group:
+    - projects each event once, on the fields read by any of its rules
+    - finds the rules and positions an event can match with one dispatch
+      table, the merged pre-filters of the rules: the key/value positions of
+      all the rules by key field and value, and the aggregation queries, each
+      evaluated once however many rules use it
+    - passes each rule only the events it can match, with their candidate
+      positions (see CorrelationRule.add_routed_events)
+    The matches name their rule in correlation_rule, and their rule and
+    query_key value in correlation_key, the query_key of the group.
+    """
+    required_options = set(['correlation_rules'])
+
+    def __init__(self, *args):
+        super(CorrelationRuleGroup, self).__init__(*args)
+        self.ts_field = self.rules.get('timestamp_field', '@timestamp')
+        configs = self.rules['correlation_rules']
+        if not isinstance(configs, list) or not configs:
+            raise EAException('Invalid correlation_rules in rule %s: expected a non-empty list' %
+                              self.rules.get('name'))
+        self.correlation_rules = [CorrelationRule(self.get_rule_options(index, config))
+                                  for index, config in enumerate(configs)]
+        names = [rule.rules['name'] for rule in self.correlation_rules]
+        if len(set(names)) < len(names):
+            raise EAException('Invalid correlation_rules in rule %s: the names of the rules must be unique' %
+                              self.rules.get('name'))
+        self.rules_by_name = dict(zip(names, self.correlation_rules))
+        # The query of the group resumes from the oldest checkpoint of the
+        # rules, see CorrelationRule.restore_state_checkpoint
+        self.resumed_from = None
+        restored = [rule.restored_until for rule in self.correlation_rules if rule.restored_until is not None]
+        if restored:
+            resume_query(self, min(restored))
+        # The rules share the documents of the events, which their matches
+        # must not modify
+        for rule in self.correlation_rules:
+            rule.copy_matches = True
+        # Fields read by any of the rules, in a stable order. Each event is
+        # projected on them once, and the projection of each rule is taken
+        # from this one.
+        fields = []
+        for rule in self.correlation_rules:
+            fields.extend(rule.projected_fields)
+        self.projected_fields = list(collections.OrderedDict.fromkeys(fields))
+        self.field_accessors = [compile_field(field) for field in self.projected_fields]
+        self.field_indexes = dict((field, index) for index, field in enumerate(self.projected_fields))
+        self.projections = [make_projection([self.field_indexes[field] for field in rule.projected_fields])
+                            for rule in self.correlation_rules]
+        # Dispatch table: the key/value positions of the rules, as (rule
+        # index, positions) pairs by key field index and value, and the
+        # aggregation queries with the (rule index, position) pairs using them
+        self.positions_by_value = {}
+        queries = collections.OrderedDict()
+        for rule_index, rule in enumerate(self.correlation_rules):
+            for field_index, positions_by_value in rule.positions_by_value.items():
+                table = self.positions_by_value.setdefault(self.field_indexes[rule.projected_fields[field_index]], {})
+                for value, positions in positions_by_value.items():
+                    table[value] = table.get(value, ()) + ((rule_index, positions),)
+            for position in rule.compiled_positions:
+                if position.is_aggregation:
+                    predicate = rule.compiled_queries[position.query]
+                    queries.setdefault(position.query, (predicate, []))[1].append((rule_index, position.index))
+        self.aggregation_queries = []
+        for predicate, positions in queries.values():
+            self.aggregation_queries.append((predicate.bind(
+                dict((field, itemgetter(self.field_indexes[field])) for field in predicate.fields())),
+                tuple(positions)))
+        # push_down_filter and limit_source_fields apply to the query of the
+        # group, with the pre-filters and fields of all the rules
+        query_fields = self.projected_fields + [self.ts_field]
+        for rule in self.correlation_rules:
+            query_fields.extend(query_key_fields(rule.rules))
+        push_down_query(self, query_fields)
+        # ElastAlert2 silences the matches of a rule by its query_key value,
+        # which is that of the rule of the group that matched and its own
+        # query_key value, see add_data. The query_key of the group is only
+        # the default of its rules, which build compound values themselves.
+        self.rules['query_key'] = MATCH_KEY_FIELD
+        self.rules.pop('compound_query_key', None)
+        # Optional metrics, the sum of the metrics of the rules, see
+        # garbage_collect. The rules collect them without sinks.
+        self.metrics_sinks = make_metrics_sinks(self.rules)
+        self.metrics_interval = self.rules.get('metrics_interval', DEFAULT_METRICS_INTERVAL)
+        self.next_metrics_report = 0
+        if 'metrics' in self.rules:
+            for rule in self.correlation_rules:
+                if rule.timers:
+                    rule.add_routed_events = rule.timers.timed('add_routed_events', rule.add_routed_events)
+        profile_threshold = self.rules.get('profile_threshold_ms')
+        if profile_threshold:
+            profile_slow_runs(self, profile_threshold)
+
+    def get_rule_options(self, index, config):
+        """
+        Returns the options of a rule of the group, given its configuration
+        or the path of its rule file, relative to the rule file of the group:
+        the GROUP_OPTIONS of the group, overridden by those of the rule, with
+        the timestamp_field of the group. Raises EAException if the rule
+        cannot be read, has a filter or misses a required option.
+        """
+        if isinstance(config, str):
+            path = os.path.join(os.path.dirname(self.rules.get('rule_file', '')), config)
+            try:
+                with open(path) as rule_file:
+                    config = yaml.safe_load(rule_file)
+            except (OSError, yaml.YAMLError) as e:
+                raise EAException('Invalid correlation_rules in rule %s: could not read %s: %s' % (
+                    self.rules.get('name'), path, e))
+        if not isinstance(config, dict):
+            raise EAException('Invalid correlation_rules in rule %s: expected rule options or a rule file, got %r' % (
+                self.rules.get('name'), config))
+        options = dict((option, self.rules[option]) for option in GROUP_OPTIONS if option in self.rules)
+        if 'compound_query_key' in self.rules:
+            options['query_key'] = list(self.rules['compound_query_key'])
+        if 'metrics' in self.rules:
+            options['metrics'] = []
+        if self.rules.get('checkpoint_file'):
+            options['checkpoint_file'] = '%s.%d' % (self.rules['checkpoint_file'], index)
+        options.update(config)
+        options['name'] = options.get('name') or '%s #%d' % (self.rules.get('name'), index + 1)
+        options['timestamp_field'] = self.ts_field
+        if options.pop('filter', None):
+            raise EAException('Invalid correlation_rules in rule %s: rule %s has a filter, which the query of the '
+                              'group would not apply: move it to the filter of the group, or match the events with '
+                              'its correlated_events' % (self.rules.get('name'), options['name']))
+        ignored = [option for option in IGNORED_RULE_OPTIONS if options.pop(option, None)]
+        if ignored:
+            elastalert_logger.warning('Rule %s ignores the %s options of its rule %s, which only apply to rules '
+                                      'running their own query' % (self.rules.get('name'), ', '.join(ignored),
+                                                                   options['name']))
+        missing = CorrelationRule.required_options - set(options)
+        if missing:
+            raise EAException('Invalid correlation_rules in rule %s: rule %s is missing %s' % (
+                self.rules.get('name'), options['name'], ', '.join(sorted(missing))))
+        # ElastAlert2 only converts the query_key and timeframe of the rules
+        # it loads
+        query_key = options.get('query_key')
+        if isinstance(query_key, list):
+            if len(query_key) > 1:
+                options['compound_query_key'] = query_key
+                options['query_key'] = ','.join(query_key)
+            elif query_key:
+                options['query_key'] = query_key[0]
+            else:
+                del options['query_key']
+        if isinstance(options['timeframe'], dict):
+            try:
+                options['timeframe'] = datetime.timedelta(**options['timeframe'])
+            except TypeError:
+                raise EAException('Invalid correlation_rules in rule %s: invalid timeframe of rule %s: %r' % (
+                    self.rules.get('name'), options['name'], options['timeframe']))
+        return options
+
+    def add_data(self, data):
+        """
+        Dispatches the events of a run to the rules of the group: each event
+        is projected once, its candidate positions in all the rules are found
+        with the dispatch table, and each rule then processes the events it
+        can match, in order. The matches are added in the order of the rules.
+        """
+        if self.resumed_from is not None:
+            warn_resume_gap(self)
+        routed_events = [[] for _ in self.correlation_rules]
+        projections = self.projections
+        for event in data:
+            values = tuple([accessor(event) for accessor in self.field_accessors])
+            candidates = {}
+            for matched in lookup_values(self.positions_by_value, values):
+                for rule_index, positions in matched:
+                    candidates.setdefault(rule_index, []).extend(positions)
+            for predicate, positions in self.aggregation_queries:
+                if predicate(values):
+                    for rule_index, position in positions:
+                        candidates.setdefault(rule_index, []).append(position)
+            for rule_index, positions in candidates.items():
+                positions.sort()
+                routed_events[rule_index].append((event, projections[rule_index](values), positions))
+
+        for rule, events in zip(self.correlation_rules, routed_events):
+            rule.add_routed_events(len(data), events)
+            name = rule.rules['name']
+            for match in rule.matches:
+                match['correlation_rule'] = name
+                match[MATCH_KEY_FIELD] = '%s.%s' % (name, rule.get_query_key(match)) if rule.get_query_key else name
+            self.matches.extend(rule.matches)
+            rule.matches = []
+
+    def get_push_down_filter(self):
+        """
+        Returns the pre-filters of the rules as one Elasticsearch filter, a
+        bool/should of the clauses of the push-down filter of each rule (see
+        CorrelationRule.get_push_down_filter), without duplicates.
+        """
+        should = []
+        clauses = set()
+        for rule in self.correlation_rules:
+            for clause in rule.get_push_down_filter()['bool']['should']:
+                text = json.dumps(clause, sort_keys=True, default=str)
+                if text not in clauses:
+                    clauses.add(text)
+                    should.append(clause)
+        return {'bool': {'should': should, 'minimum_should_match': 1}}
+
+    def garbage_collect(self, timestamp):
+        """
+        Has the rules remove their expired events and write their
+        checkpoints, and reports the sum of their metrics.
+        """
+        for rule in self.correlation_rules:
+            rule.garbage_collect(timestamp)
+        if self.metrics_sinks and time.time() >= self.next_metrics_report:
+            metrics = merge_metrics(rule.get_metrics() for rule in self.correlation_rules)
+            for sink in self.metrics_sinks:
+                sink.emit(self.rules.get('name'), metrics)
+            self.next_metrics_report = time.time() + self.metrics_interval
+
+    def get_match_str(self, match):
+        rule = self.rules_by_name[match['correlation_rule']]
+        return 'Correlation rule: %s\n%s' % (rule.rules['name'], rule.get_match_str(match))
@@ -0,0 +1,375 @@
+import collections
+import heapq
+from bisect import bisect_left
+
+NO_CAPTURES = ()
+
+
+def join_key(value):
+    """
+    Returns the key equal comparisons are partitioned on: values compare
+    equal when their text is equal. None never compares equal.
+    """
+    return None if value is None else str(value)
+
+
+class SequenceQueue(object):
+    """
+    Sequences that matched the same positions, as (start ordinal, captured
+    values) tuples in increasing start order.
+
+    joins are the comparisons the next position makes with the captured
+    values, as (slot, value_index, test) tuples: a sequence can only be
+    extended by an event if test(event values[value_index], captured
+    values[slot]) is true for every join.
+
+    The sequences are kept in a list, with their starts in a parallel list
+    that is bisected to insert sequences extended out of start order and to
+    expire them. Expired sequences are dropped from the head of the lists
+    once they make up more than half of them.
+    """
+    __slots__ = ('starts', 'sequences', 'head', 'joins')
+
+    def __init__(self, joins=()):
+        self.starts = []
+        self.sequences = []
+        self.head = 0
+        self.joins = joins
+
+    def __len__(self):
+        return len(self.starts) - self.head
+
+    def add(self, sequence):
+        start = sequence[0]
+        starts = self.starts
+        if len(starts) == self.head or starts[-1] < start:
+            starts.append(start)
+            self.sequences.append(sequence)
+        else:
+            index = bisect_left(starts, start, self.head)
+            starts.insert(index, start)
+            self.sequences.insert(index, sequence)
+
+    def passes(self, sequence, values):
+        captured = sequence[1]
+        for slot, value_index, test in self.joins:
+            if not test(values[value_index], captured[slot]):
+                return False
+        return True
+
+    def matching(self, values):
+        """
+        Returns the sequences that pass the joins with the event values,
+        oldest start first, without removing them.
+        """
+        sequences = self.sequences[self.head:]
+        if not self.joins:
+            return sequences
+        return [sequence for sequence in sequences if self.passes(sequence, values)]
+
+    def take(self, values):
+        """
+        Removes and returns the sequence with the latest start that passes the
+        joins with the event values, or None if there is none.
+        """
+        starts = self.starts
+        sequences = self.sequences
+        if not self.joins:
+            if len(starts) == self.head:
+                return None
+            starts.pop()
+            return sequences.pop()
+        for index in range(len(starts) - 1, self.head - 1, -1):
+            if self.passes(sequences[index], values):
+                sequence = sequences[index]
+                del starts[index]
+                del sequences[index]
+                return sequence
+        return None
+
+    def expire(self, first_ordinal):
+        starts = self.starts
+        head = self.head
+        if head == len(starts) or starts[head] >= first_ordinal:
+            return
+        head = bisect_left(starts, first_ordinal, head)
+        if head * 2 > len(starts):
+            del starts[:head]
+            del self.sequences[:head]
+            head = 0
+        self.head = head
+
+    def clear(self):
+        self.starts = []
+        self.sequences = []
+        self.head = 0
+
+    def get_state(self):
+        return [self.starts[self.head:], self.sequences[self.head:]]
+
+    def set_state(self, state):
+        self.starts, self.sequences = state
+        self.head = 0
+
+
+class PartitionedSequences(object):
+    """
+    Sequences awaiting a position with equal comparisons, hash-partitioned on
+    the captured values those comparisons read, so that the sequences an
+    event can extend are found with a dictionary lookup instead of a scan.
+
+    equal_joins are (slot, value_index) pairs. Each partition is a
+    SequenceQueue checking the other joins. A heap of (start, partition key)
+    finds the partitions holding expired sequences.
+    """
+    __slots__ = ('partitions', 'equal_joins', 'joins', 'expiries', 'size')
+
+    def __init__(self, equal_joins, joins=()):
+        self.partitions = {}
+        self.equal_joins = equal_joins
+        self.joins = joins
+        self.expiries = []
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, sequence):
+        captured = sequence[1]
+        key = tuple([join_key(captured[slot]) for slot, _ in self.equal_joins])
+        if None in key:
+            # Missing captures never compare equal, the sequence is dead
+            return
+        partition = self.partitions.get(key)
+        if partition is None:
+            partition = self.partitions[key] = SequenceQueue(self.joins)
+        partition.add(sequence)
+        heapq.heappush(self.expiries, (sequence[0], key))
+        self.size += 1
+
+    def matching(self, values):
+        partition = self.partitions.get(tuple([join_key(values[value_index]) for _, value_index in self.equal_joins]))
+        return partition.matching(values) if partition is not None else []
+
+    def take(self, values):
+        key = tuple([join_key(values[value_index]) for _, value_index in self.equal_joins])
+        partition = self.partitions.get(key)
+        if partition is None:
+            return None
+        sequence = partition.take(values)
+        if sequence is not None:
+            self.size -= 1
+            if not partition:
+                del self.partitions[key]
+        return sequence
+
+    def expire(self, first_ordinal):
+        expiries = self.expiries
+        while expiries and expiries[0][0] < first_ordinal:
+            key = heapq.heappop(expiries)[1]
+            partition = self.partitions.get(key)
+            if partition is not None:
+                size = len(partition)
+                partition.expire(first_ordinal)
+                self.size -= size - len(partition)
+                if not partition:
+                    del self.partitions[key]
+
+    def get_state(self):
+        return [[[key, partition.get_state()] for key, partition in self.partitions.items()],
+                self.expiries, self.size]
+
+    def set_state(self, state):
+        partitions, self.expiries, self.size = state
+        self.partitions = {}
+        for key, partition_state in partitions:
+            partition = self.partitions[key] = SequenceQueue(self.joins)
+            partition.set_state(partition_state)
+
+
+class SequenceMatcher(object):
+    """
+    Streaming matcher that counts the ordered sequences of correlated events
+    found in a stream of events.
+
+    Events are fed one at a time, in stream order, with the ordinal of the
+    event (a number increasing with each event) and the correlated event
+    positions it matched. The matcher does not keep the events or their
+    indices, only the partial sequences that are in progress. A sequence is
+    identified by the ordinal of the event that started it, which is its
+    oldest event, so expiring events from the start of the stream is a matter
+    of dropping the sequences that started before the first live ordinal.
+
+    When an event can extend several partial sequences, the one that started
+    last is extended. That keeps the longest-lived sequences progressing, so
+    the number of completed sequences after any expiry is the same as the
+    number get_num_correlations would find in the remaining events (when the
+    positions have no comparisons).
+
+    Sequences also carry the values captured by their events, in slots, and
+    field comparisons are joins between an event and the sequence it would
+    extend, so an event is compared with the captures of the very sequence it
+    joins. Which sequence an event extends then matters when a later position
+    compares with the values captured so far: the sequence the event does not
+    extend, or the one it would have captured other values in, might be the
+    only one a later event can complete. At those positions, the branching
+    positions, an event extends every sequence it passes the comparisons of
+    and the sequences stay in their stage, so that each of their branches can
+    be extended further. A start completes at most once: the other branches
+    of a start that completed are dropped when an event would extend them.
+    Parameters, lists with one item per position:
+    - captures: (slot, value_index) pairs, the event values captured into the
+      sequence by the events matching the position
+    - equal_joins: (slot, value_index) pairs, event values that must be equal
+      to captured values for an event to extend a sequence at the position
+    - joins: (slot, value_index, test) tuples, other comparisons, see
+      SequenceQueue
+    The first position has no sequence to compare with, so if it has
+    comparisons no sequence ever starts.
+
+    With track_events, sequences also carry the ordinals of their events, as
+    a third item, so that the events of the completed sequences are known
+    (see completed()).
+    """
+
+    def __init__(self, num_positions, num_slots=0, captures=None, equal_joins=None, joins=None, track_events=False):
+        self.num_positions = num_positions
+        self.num_slots = num_slots
+        self.captures = captures or [()] * num_positions
+        self.track_events = track_events
+        self.starts = not (equal_joins and equal_joins[0]) and not (joins and joins[0])
+        # A position branches if a later position compares with a slot
+        # captured at or before it
+        first_captures = {}
+        for position, position_captures in enumerate(self.captures):
+            for slot, _ in position_captures:
+                first_captures.setdefault(slot, position)
+        self.branches = [False] * num_positions
+        compared_slots = set()
+        for position in range(num_positions - 1, 0, -1):
+            self.branches[position] = any(first_captures.get(slot, position + 1) <= position
+                                          for slot in compared_slots)
+            compared_slots.update(slot for slot, _ in (equal_joins[position] if equal_joins else ()))
+            compared_slots.update(slot for slot, _, _ in (joins[position] if joins else ()))
+        # Starts of the completed sequences, with a heap of them to forget
+        # them once expired, for the matchers with branching positions
+        self.completed_starts = set() if any(self.branches) else None
+        self.completed_expiries = []
+        # partial[j] holds the sequences that matched positions 0 to j, which
+        # are checked against the comparisons of position j + 1. The last
+        # stage holds the completed sequences.
+        self.partial = []
+        for position in range(1, num_positions + 1):
+            position_equal_joins = equal_joins[position] if equal_joins and position < num_positions else ()
+            position_joins = joins[position] if joins and position < num_positions else ()
+            if position_equal_joins:
+                self.partial.append(PartitionedSequences(position_equal_joins, position_joins))
+            else:
+                self.partial.append(SequenceQueue(position_joins))
+
+    def feed(self, ordinal, positions, values=None):
+        """
+        Advances the partial sequences with an event.
+
+        Parameters:
+        - ordinal: Ordinal of the event, greater than that of any event fed before
+        - positions: Indexes of the positions the event matched, in increasing order
+        - values: Values of the event that captures and joins refer to by index
+
+        Positions are processed from the last to the first, so that an event
+        never extends a sequence it started or extended itself.
+        """
+        partial = self.partial
+        completed_starts = self.completed_starts
+        last_position = self.num_positions - 1
+        for position in reversed(positions):
+            if position == 0:
+                if not self.starts:
+                    continue
+                sequences = [(ordinal, (None,) * self.num_slots if self.num_slots else NO_CAPTURES)]
+            elif self.branches[position]:
+                sequences = partial[position - 1].matching(values)
+                sequences = [sequence for sequence in sequences if sequence[0] not in completed_starts]
+            else:
+                sequence = partial[position - 1].take(values)
+                while completed_starts and sequence is not None and sequence[0] in completed_starts:
+                    sequence = partial[position - 1].take(values)
+                sequences = [sequence] if sequence is not None else []
+
+            for sequence in sequences:
+                if self.track_events:
+                    sequence = (sequence[0], sequence[1], sequence[2] + (ordinal,) if position else (ordinal,))
+                if self.captures[position]:
+                    captured = list(sequence[1])
+                    for slot, value_index in self.captures[position]:
+                        captured[slot] = values[value_index]
+                    sequence = (sequence[0], tuple(captured)) + sequence[2:]
+                if position == last_position and completed_starts is not None:
+                    completed_starts.add(sequence[0])
+                    heapq.heappush(self.completed_expiries, sequence[0])
+                partial[position].add(sequence)
+
+    def expire(self, first_ordinal):
+        """
+        Drops the partial and completed sequences that started before
+        first_ordinal.
+        """
+        for stage in self.partial:
+            stage.expire(first_ordinal)
+        expiries = self.completed_expiries
+        while expiries and expiries[0] < first_ordinal:
+            self.completed_starts.discard(heapq.heappop(expiries))
+
+    def get_state(self):
+        """
+        Returns the partial and completed sequences, as lists and tuples, and
+        the starts that completed, for checkpoints. The captures and joins are
+        configuration, not state.
+        """
+        return [[stage.get_state() for stage in self.partial], sorted(self.completed_expiries)]
+
+    def set_state(self, state):
+        stages, completed_starts = state
+        for stage, stage_state in zip(self.partial, stages):
+            stage.set_state(stage_state)
+        if self.completed_starts is not None:
+            self.completed_expiries = list(completed_starts)
+            self.completed_starts = set(completed_starts)
+
+    def count(self):
+        """
+        Returns the number of completed sequences.
+        """
+        return len(self.partial[-1])
+
+    def completed(self):
+        """
+        Returns the completed sequences, oldest start first.
+        """
+        stage = self.partial[-1]
+        return stage.sequences[stage.head:]
+
+    def consume(self):
+        """
+        Removes the completed sequences and returns them, oldest start first.
+        The partial sequences are kept.
+        """
+        sequences = self.completed()
+        self.partial[-1].clear()
+        return sequences
+
+
+def count_sequences(correlated_indices):
+    """
+    Counts the ordered sequences in a list of lists of indices, the outer list
+    being in position order, by feeding them to a SequenceMatcher.
+    """
+    positions_by_index = collections.defaultdict(list)
+    for position, indices in enumerate(correlated_indices):
+        for index in indices:
+            positions_by_index[index].append(position)
+
+    matcher = SequenceMatcher(len(correlated_indices))
+    for index in sorted(positions_by_index):
+        matcher.feed(index, positions_by_index[index])
+    return matcher.count()
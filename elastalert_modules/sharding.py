@@ -0,0 +1,159 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from elastalert.util import EAException, elastalert_logger
+
+# Correlation rule of the shard owned by the current worker process
+shard_rule = None
+
+
+def init_shard(rule_class, rules):
+    """
+    Initializer of the worker processes: creates the rule that keeps the
+    windows and match state of the query_keys of the shard.
+    """
+    global shard_rule
+    shard_rule = rule_class(rules)
+
+
+def add_shard_events(shard_events):
+    """
+    Adds the events of a run to the rule of the shard, and returns the
+    matches they triggered, see CorrelationRule.add_shard_events.
+    """
+    return shard_rule.add_shard_events(shard_events)
+
+
+def collect_shard_garbage(timestamp):
+    shard_rule.garbage_collect(timestamp)
+
+
+def get_shard_metrics():
+    return shard_rule.get_metrics()
+
+
+def get_shard_restored_until():
+    return shard_rule.restored_until
+
+
+class ShardPool(object):
+    """
+    Worker processes that each own the correlation state of a shard of the
+    query_keys.
+
+    Each shard is a ProcessPoolExecutor with a single worker, so that the
+    calls for a shard always run in the process that holds its state, and
+    the worker creates its own instance of the rule, from the rule options
+    of its shard, when it starts. The workers are spawned rather than
+    forked, as forking the multi-threaded ElastAlert process is not safe,
+    and are started by the first call.
+
+    A worker that dies is replaced by a new one, which restores the
+    checkpoint of its shard if the rule has one, and the call is retried
+    once. The workers are shut down at exit, as ElastAlert2 never tears the
+    rules down.
+    """
+
+    def __init__(self, rule_class, shard_rules):
+        self.rule_class = rule_class
+        self.shard_rules = shard_rules
+        self.num_shards = len(shard_rules)
+        self.executors = None
+
+    def start(self):
+        self.executors = [self.create_executor(shard) for shard in range(self.num_shards)]
+        atexit.register(self.shutdown)
+
+    def create_executor(self, shard):
+        context = multiprocessing.get_context('spawn')
+        return ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=init_shard,
+                                   initargs=(self.rule_class, self.shard_rules[shard]))
+
+    def restart(self, shard):
+        self.executors[shard].shutdown(wait=False)
+        self.executors[shard] = self.create_executor(shard)
+
+    def submit(self, shard, function, *args):
+        """
+        Submits a call to the worker of a shard, replacing the worker if it
+        died since the previous call.
+        """
+        try:
+            return self.executors[shard].submit(function, *args)
+        except BrokenProcessPool:
+            self.log_restart(shard)
+            self.restart(shard)
+            return self.executors[shard].submit(function, *args)
+
+    def result(self, shard, future, function, *args):
+        """
+        Returns the result of a call to the worker of a shard. If the worker
+        died during the call, it is replaced and the call retried once, and
+        EAException is raised if the new worker dies as well.
+        """
+        try:
+            return future.result()
+        except BrokenProcessPool:
+            self.log_restart(shard)
+            self.restart(shard)
+        try:
+            return self.executors[shard].submit(function, *args).result()
+        except BrokenProcessPool:
+            self.restart(shard)
+            raise EAException('Worker of shard %d of rule %s died twice running %s' % (
+                shard, self.shard_rules[shard].get('name'), function.__name__))
+
+    def log_restart(self, shard):
+        elastalert_logger.error(
+            'Worker of shard %d of rule %s died, restarting it: the state of the shard since its last checkpoint '
+            'is lost' % (shard, self.shard_rules[shard].get('name')))
+
+    def call_all(self, function, args):
+        """
+        Calls a function in the workers of the shards, in parallel, with the
+        arguments of each shard, and returns their results. Shards whose
+        arguments are None are not called, and their result is None.
+        """
+        if self.executors is None:
+            self.start()
+        futures = [self.submit(shard, function, *shard_args) if shard_args is not None else None
+                   for shard, shard_args in enumerate(args)]
+        return [self.result(shard, future, function, *shard_args) if future else None
+                for shard, (future, shard_args) in enumerate(zip(futures, args))]
+
+    def add_data(self, batches):
+        """
+        Sends one batch of events to each shard, in parallel, and returns the
+        results of the shards, see add_shard_events. Empty batches are not
+        sent, and their result is None.
+        """
+        return self.call_all(add_shard_events, [(batch,) if batch else None for batch in batches])
+
+    def garbage_collect(self, timestamp):
+        if self.executors is not None:
+            self.call_all(collect_shard_garbage, [(timestamp,)] * self.num_shards)
+
+    def get_metrics(self):
+        """
+        Returns the metrics of the rules of the shards, once they started.
+        """
+        if self.executors is None:
+            return []
+        return self.call_all(get_shard_metrics, [()] * self.num_shards)
+
+    def get_restored_until(self):
+        """
+        Starts the workers, which restore the checkpoints of their shards,
+        and returns the time of the checkpoint of each shard, in
+        microseconds, or None if it had none.
+        """
+        return self.call_all(get_shard_restored_until, [()] * self.num_shards)
+
+    def shutdown(self):
+        if self.executors is not None:
+            atexit.unregister(self.shutdown)
+            for executor in self.executors:
+                executor.shutdown()
+            self.executors = None
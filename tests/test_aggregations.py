@@ -0,0 +1,157 @@
+"""
+Tests of the running window aggregations and of the aggregation_condition
+of aggregation positions.
+"""
+import collections
+import math
+import random
+
+import pytest
+from elastalert.util import EAException
+
+from elastalert_modules.aggregations import ApproxCardinalityAggregation, AvgAggregation, SumAggregation
+
+
+def test_sum_recovers_small_values_after_large_one_expires():
+    aggregation = SumAggregation()
+    aggregation.add(0, 1e20)
+    for ordinal in range(1, 11):
+        aggregation.add(ordinal, 0.1)
+    aggregation.expire(1)
+    assert aggregation.value() == pytest.approx(1.0)
+
+
+def test_sum_restarts_from_zero_when_window_empties():
+    aggregation = SumAggregation()
+    aggregation.add(0, 0.1)
+    aggregation.add(1, 0.2)
+    aggregation.expire(2)
+    assert aggregation.value() == 0
+    aggregation.add(2, 0.3)
+    assert aggregation.value() == 0.3
+
+
+def test_sum_of_integers_is_exact():
+    aggregation = SumAggregation()
+    for ordinal in range(1000):
+        aggregation.add(ordinal, 10 ** 18 + ordinal)
+    aggregation.expire(990)
+    assert aggregation.value() == sum(10 ** 18 + ordinal for ordinal in range(990, 1000))
+    assert isinstance(aggregation.value(), int)
+
+
+@pytest.mark.parametrize('aggregation_class', [SumAggregation, AvgAggregation])
+def test_sliding_sum_does_not_drift(aggregation_class):
+    rng = random.Random(0)
+    aggregation = aggregation_class()
+    values = []
+    for ordinal in range(100000):
+        value = rng.choice([1e12, 1.0, 0.1, -7.25]) * rng.random()
+        aggregation.add(ordinal, value)
+        values.append(value)
+        aggregation.expire(ordinal - 20)
+    live = values[-21:]
+    expected = math.fsum(live)
+    if aggregation_class is AvgAggregation:
+        expected /= len(live)
+    assert aggregation.value() == pytest.approx(expected, rel=1e-15, abs=1e-9)
+
+
+@pytest.fixture
+def duration_rule(make_rule):
+    """
+    Returns a function building a rule with one aggregation position over
+    the duration of the requests.
+    """
+    def build(condition, aggregation_type='avg', count=100):
+        position = {'position': 1, 'type': 'aggregation', 'query': 'event:request',
+                    'aggregation_type': aggregation_type, 'aggregation_field': 'duration', 'aggregation_count': count}
+        if condition is not None:
+            position['aggregation_condition'] = condition
+        return make_rule([position])
+    return build
+
+
+@pytest.fixture
+def requests(make_event):
+    def build(*durations):
+        return [make_event(index, event='request', duration=duration) for index, duration in enumerate(durations)]
+    return build
+
+
+@pytest.mark.parametrize('condition, durations, matched', [
+    # The average reaches 100 with the second event, and the match resets the
+    # aggregation, which the third event then reaches alone
+    (None, (50, 150, 300), [150, 300]),
+    ('above', (50, 150, 300), [150, 300]),
+    ('above', (50, 60, 70), []),
+    ('below', (150, 40, 20), [40, 20]),
+    ('below', (300, 150, 200), []),
+])
+def test_aggregation_condition(duration_rule, requests, condition, durations, matched):
+    rule = duration_rule(condition)
+    rule.add_data(requests(*durations))
+    assert [match['duration'] for match in rule.matches] == matched
+
+
+def test_aggregation_condition_is_inclusive(duration_rule, requests):
+    rule = duration_rule('below', aggregation_type='max', count=100)
+    rule.add_data(requests(100))
+    assert len(rule.matches) == 1
+
+
+def test_unknown_aggregation_condition(duration_rule):
+    with pytest.raises(EAException, match='aggregation_condition'):
+        duration_rule('between')
+
+
+def sliding_cardinality_errors(aggregation, values, window):
+    """
+    Returns the relative error of the estimate of the aggregation after each
+    value once the window is full, the window holding the last window values.
+    """
+    counts = collections.Counter()
+    errors = []
+    for ordinal, value in enumerate(values):
+        aggregation.add(ordinal, value)
+        counts[value] += 1
+        if ordinal >= window:
+            expired = values[ordinal - window]
+            counts[expired] -= 1
+            if not counts[expired]:
+                del counts[expired]
+            aggregation.expire(ordinal - window + 1)
+            errors.append(aggregation.value() / len(counts) - 1)
+    return errors
+
+
+def test_approx_cardinality_error_over_sliding_window():
+    error = 0.05
+    config = ApproxCardinalityAggregation.parse_config({'aggregation_error': error})
+    aggregation = ApproxCardinalityAggregation(**config)
+    rng = random.Random(0)
+    values = [rng.randrange(50000) for _ in range(60000)]
+    errors = sliding_cardinality_errors(aggregation, values, 20000)
+    assert abs(sum(errors) / len(errors)) < error / 2
+    assert math.sqrt(sum(e * e for e in errors) / len(errors)) < error
+    assert max(abs(e) for e in errors) < 3 * error
+
+
+class DeepApproxCardinalityAggregation(ApproxCardinalityAggregation):
+    DEPTH = 64
+
+
+@pytest.mark.parametrize('precision', [4, 6])
+def test_approx_cardinality_full_registers_keep_estimate(precision):
+    # With a few registers for 20000 values, the registers often get a new
+    # entry when they are full
+    estimates = []
+    for aggregation_class in (ApproxCardinalityAggregation, DeepApproxCardinalityAggregation):
+        aggregation = aggregation_class(precision)
+        values = []
+        for ordinal in range(60000):
+            aggregation.add(ordinal, ordinal)
+            aggregation.expire(ordinal - 20000 + 1)
+            values.append(aggregation.value())
+        estimates.append(values)
+    assert estimates[0] == estimates[1]
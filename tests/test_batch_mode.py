@@ -0,0 +1,70 @@
+"""
+Tests of batch_mode: the rule finds the same matches, with the same related
+events and in the same order, as when it processes the events one at a time.
+"""
+import random
+
+import pytest
+
+pytest.importorskip('numpy')
+
+
+@pytest.fixture
+def login_rule(make_rule):
+    """
+    Returns a function building a rule matching a failure from a country,
+    then failures with two error codes, then a success from another country.
+    Options set to None are left out.
+    """
+    def build(**options):
+        options = dict({'query_key': 'user', 'attach_related': True}, **options)
+        options = dict((option, value) for option, value in options.items() if value is not None)
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure',
+             'capture_fields': [{'field': 'country', 'as': 'country'}]},
+            {'position': 2, 'type': 'aggregation', 'query': 'result:failure', 'aggregation_type': 'cardinality',
+             'aggregation_field': 'code', 'aggregation_count': 2},
+            {'position': 3, 'key': 'result', 'value': 'success',
+             'compare_fields': [{'field': 'country', 'to': 'country', 'condition': 'not_equal'}]},
+        ], **options)
+    return build
+
+
+def random_batches(make_event, seed, num_batches=20, batch_size=30):
+    """
+    Returns batches of random logins. One in five events is up to a minute
+    older than the previous one, within its batch or across batches.
+    """
+    rng = random.Random(seed)
+    batches = []
+    seconds = 0
+    for _ in range(num_batches):
+        batch = []
+        for _ in range(batch_size):
+            seconds += rng.randint(0, 20)
+            timestamp = seconds - rng.randint(1, 60) if rng.random() < 0.2 else seconds
+            batch.append(make_event(timestamp, _id=str(len(batches) * batch_size + len(batch)),
+                                    user=rng.choice(['alice', 'bob', 'carol']),
+                                    result=rng.choice(['failure', 'failure', 'success', 'other']),
+                                    country=rng.choice(['NZ', 'US']), code=rng.choice([50126, 50053, 50074])))
+        batches.append(batch)
+    return batches
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'related_events': 'sequences'},
+    {'related_events': 'ids'},
+    {'on_match': 'consume'},
+    {'match_cooldown': {'minutes': 2}},
+    {'query_key': None, 'related_events': 'sequences'},
+])
+@pytest.mark.parametrize('seed', range(3))
+def test_batch_mode_matches_are_event_mode_matches(login_rule, make_event, run_batches, options, seed):
+    batches = random_batches(make_event, seed)
+    expected = run_batches(login_rule(**options), batches)
+    rule = login_rule(batch_mode=True, **options)
+    assert rule.batch_mode
+    matches = run_batches(rule, batches)
+    assert len(expected) > 5
+    assert matches == expected
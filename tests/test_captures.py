@@ -0,0 +1,252 @@
+"""
+Tests of the values compare_fields compares with: an event extending a
+sequence is compared with the values captured by the earlier events of that
+very sequence, not with the latest capture of the window. Each condition
+compares the values as its type: numbers, subnets or timestamps within a
+duration, and invalid compare_fields are refused.
+"""
+import datetime
+
+import pytest
+from elastalert.util import EAException
+
+from elastalert_modules.positions import Comparison
+from elastalert_modules.sequence import SequenceMatcher
+
+
+def make_matcher(comparison, num_positions=2, track_events=True):
+    """
+    Returns a SequenceMatcher where the first position captures the value of
+    the events into slot 0, and the last one compares the value of the events
+    with it, as CorrelationRule.get_matcher_options sets them up. The values
+    of the events are (coerced value,).
+    """
+    captures = [((0, 0),)] + [()] * (num_positions - 1)
+    equal_joins = [()] * num_positions
+    joins = [()] * num_positions
+    if comparison.equal:
+        equal_joins[-1] = ((0, 0),)
+    else:
+        joins[-1] = ((0, 0, comparison.test),)
+    return SequenceMatcher(num_positions, num_slots=1, captures=captures, equal_joins=equal_joins, joins=joins,
+                           track_events=track_events)
+
+
+def feed(matcher, comparison, events):
+    """
+    Feeds (positions, value) events to a matcher, with their index as ordinal.
+    """
+    for ordinal, (positions, value) in enumerate(events):
+        matcher.feed(ordinal, positions, (comparison.coerce(value),))
+
+
+def completed_events(matcher):
+    return [sequence[2] for sequence in matcher.completed()]
+
+
+@pytest.mark.parametrize('condition, events, expected', [
+    # The success from DE extends the sequence of the failure from FR, the
+    # newest one it differs from, even though the latest failure is from DE
+    ('not_equal', [([0], 'FR'), ([0], 'DE'), ([1], 'DE')], [(0, 2)]),
+    # The success from DE extends the sequence of the older failure from DE
+    ('equal', [([0], 'DE'), ([0], 'FR'), ([1], 'DE')], [(0, 2)]),
+    # No failure from another country
+    ('not_equal', [([0], 'DE'), ([0], 'DE'), ([1], 'DE')], []),
+    # Each success extends the sequence of the failure it equals
+    ('equal', [([0], 'DE'), ([0], 'FR'), ([1], 'FR'), ([1], 'DE')], [(0, 3), (1, 2)]),
+])
+def test_comparison_uses_captures_of_its_sequence(condition, events, expected):
+    comparison = Comparison({'field': 'country', 'to': 'country', 'condition': condition})
+    matcher = make_matcher(comparison)
+    feed(matcher, comparison, events)
+    assert completed_events(matcher) == expected
+
+
+def test_comparison_uses_earliest_position_capture():
+    """
+    A value captured at the first position is compared at the third one, and
+    the event of the second position does not replace it.
+    """
+    comparison = Comparison({'field': 'bytes', 'to': 'bytes', 'condition': 'greater_than'})
+    matcher = make_matcher(comparison, num_positions=3)
+    feed(matcher, comparison, [([0], 100), ([0, 1], 1000), ([2], 500)])
+    # 500 > 100 but not > 1000: the sequence started by 100 completes, the
+    # event of 1000 being its second position
+    assert completed_events(matcher) == [(0, 1, 2)]
+
+
+def test_expired_captures_are_not_compared():
+    comparison = Comparison({'field': 'country', 'to': 'country', 'condition': 'not_equal'})
+    matcher = make_matcher(comparison)
+    feed(matcher, comparison, [([0], 'FR'), ([0], 'DE')])
+    matcher.expire(1)
+    matcher.feed(2, [1], (comparison.coerce('DE'),))
+    assert matcher.count() == 0
+    matcher.feed(3, [1], (comparison.coerce('US'),))
+    assert completed_events(matcher) == [(1, 3)]
+
+
+def test_coerced_comparison():
+    """
+    The captures and the compared values are coerced to the type of the
+    condition: numbers compare as numbers, even when given as text.
+    """
+    comparison = Comparison({'field': 'bytes', 'to': 'bytes', 'condition': 'greater_than'})
+    matcher = make_matcher(comparison)
+    feed(matcher, comparison, [([0], '9'), ([1], '10')])
+    assert matcher.count() == 1
+
+
+@pytest.fixture
+def travel_rule(make_rule):
+    """
+    Returns a function building a rule matching a success from a country
+    compared, with the given condition, to the country of a failure.
+    """
+    def build(condition):
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure',
+             'capture_fields': [{'field': 'country', 'as': 'failure_country'}]},
+            {'position': 2, 'key': 'result', 'value': 'success',
+             'compare_fields': [{'field': 'country', 'to': 'failure_country', 'condition': condition}]},
+        ], query_key='user')
+    return build
+
+
+@pytest.fixture
+def login(make_event):
+    def build(minutes, result, country, user='alice'):
+        return make_event(60 * minutes, result=result, country=country, user=user)
+    return build
+
+
+def test_rule_compares_with_captures_of_its_sequence(travel_rule, login):
+    rule = travel_rule('not_equal')
+    rule.add_data([login(0, 'failure', 'FR'), login(1, 'failure', 'DE'), login(2, 'success', 'DE')])
+    assert len(rule.matches) == 1
+
+    rule = travel_rule('not_equal')
+    rule.add_data([login(0, 'failure', 'DE'), login(1, 'failure', 'DE'), login(2, 'success', 'DE')])
+    assert rule.matches == []
+
+
+def test_rule_captures_are_per_query_key(travel_rule, login):
+    rule = travel_rule('not_equal')
+    rule.add_data([login(0, 'failure', 'FR', user='bob'), login(1, 'failure', 'DE'), login(2, 'success', 'DE')])
+    assert rule.matches == []
+    rule.add_data([login(3, 'success', 'DE', user='bob')])
+    assert [match['user'] for match in rule.matches] == ['bob']
+
+
+MIDNIGHT = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def compare(config, value, captured):
+    """
+    Returns whether an event value passes a comparison with a captured value,
+    as the matcher compares them once coerced.
+    """
+    comparison = Comparison(dict({'field': 'field', 'to': 'alias'}, **config))
+    value = comparison.coerce(value)
+    captured = comparison.coerce(captured)
+    if comparison.equal:
+        return value is not None and captured is not None and value == captured
+    return comparison.test(value, captured)
+
+
+@pytest.mark.parametrize('config, value, captured, expected', [
+    # Numbers, given as numbers or text
+    ({'condition': 'greater_than'}, 10, '9', True),
+    ({'condition': 'greater_than'}, '9', 10, False),
+    ({'condition': 'greater_than'}, 10, 10.0, False),
+    ({'condition': 'greater_than'}, '1e3', 999, True),
+    ({'condition': 'greater_than'}, 'many', 1, False),
+    ({'condition': 'greater_than'}, None, 1, False),
+    ({'condition': 'less_than'}, -1.5, '0', True),
+    ({'condition': 'less_than'}, 2, 1, False),
+    # Text
+    ({'condition': 'equal'}, 10, '10', True),
+    ({'condition': 'equal'}, 'DE', 'de', False),
+    ({'condition': 'equal', 'ignore_case': True}, 'DE', 'de', True),
+    ({'condition': 'not_equal'}, 'DE', None, False),
+    ({'condition': 'contains'}, 'admin-user', 'admin', True),
+    ({'condition': 'not_contains'}, 'admin-user', 'root', True),
+    # Subnets, /24 and /64 by default, IPv4-mapped IPv6 addresses are IPv4
+    ({'condition': 'same_subnet'}, '10.0.0.200', '10.0.0.1', True),
+    ({'condition': 'same_subnet'}, '10.0.1.1', '10.0.0.1', False),
+    ({'condition': 'same_subnet', 'prefix_length': 16}, '10.0.1.1', '10.0.0.1', True),
+    ({'condition': 'same_subnet', 'prefix_length': 0}, '192.168.0.1', '10.0.0.1', True),
+    ({'condition': 'same_subnet'}, '::ffff:10.0.0.5', '10.0.0.1', True),
+    ({'condition': 'same_subnet'}, '2001:db8::1', '2001:db8::ffff', True),
+    ({'condition': 'same_subnet'}, '2001:db8:0:1::1', '2001:db8::1', False),
+    ({'condition': 'same_subnet', 'ipv6_prefix_length': 48}, '2001:db8:0:1::1', '2001:db8::1', True),
+    ({'condition': 'same_subnet', 'prefix_length': 0, 'ipv6_prefix_length': 0}, '::1', '10.0.0.1', False),
+    ({'condition': 'same_subnet'}, 'localhost', '10.0.0.1', False),
+    ({'condition': 'different_subnet'}, '10.0.1.1', '10.0.0.1', True),
+    ({'condition': 'different_subnet'}, '10.0.0.2', '10.0.0.1', False),
+    ({'condition': 'different_subnet'}, 'localhost', '10.0.0.1', False),
+    # Timestamps, as datetimes, text or epoch milliseconds
+    ({'condition': 'time_within', 'duration': {'minutes': 5}}, '2024-01-01T00:05:00Z', MIDNIGHT, True),
+    ({'condition': 'time_within', 'duration': {'minutes': 5}}, '2024-01-01T00:05:01Z', MIDNIGHT, False),
+    ({'condition': 'time_within', 'duration': {'minutes': 5}}, MIDNIGHT, '2024-01-01T00:04:00+00:00', True),
+    ({'condition': 'time_within', 'duration': datetime.timedelta(seconds=1)}, 1704067200500, MIDNIGHT, True),
+    ({'condition': 'time_within', 'duration': {'minutes': 5}}, 'yesterday', MIDNIGHT, False),
+    ({'condition': 'time_apart', 'duration': {'hours': 1}}, '2024-01-01T01:00:01Z', MIDNIGHT, True),
+    ({'condition': 'time_apart', 'duration': {'hours': 1}}, '2024-01-01T01:00:00Z', MIDNIGHT, False),
+    ({'condition': 'time_apart', 'duration': {'hours': 1}}, MIDNIGHT - datetime.timedelta(hours=2), MIDNIGHT, True),
+])
+def test_typed_comparison(config, value, captured, expected):
+    assert compare(config, value, captured) == expected
+
+
+@pytest.fixture
+def session_rule(make_rule):
+    """
+    Returns a function building a rule matching a login then a transfer of a
+    user, compared with the given compare_fields options.
+    """
+    def build(field, **comparison):
+        return make_rule([
+            {'position': 1, 'key': 'event', 'value': 'login', 'capture_fields': [{'field': field, 'as': 'login'}]},
+            {'position': 2, 'key': 'event', 'value': 'transfer',
+             'compare_fields': [dict({'field': field, 'to': 'login'}, **comparison)]},
+        ], query_key='user', timeframe=datetime.timedelta(hours=2))
+    return build
+
+
+def test_rule_time_within(session_rule, make_event):
+    rule = session_rule('session_start', condition='time_within', duration={'minutes': 10})
+    rule.add_data([
+        make_event(0, event='login', user='alice', session_start='2024-01-01T00:00:00Z'),
+        make_event(1, event='login', user='bob', session_start='2024-01-01T00:00:00Z'),
+        make_event(2, event='transfer', user='alice', session_start='2024-01-01T00:09:00Z'),
+        make_event(3, event='transfer', user='bob', session_start='2024-01-01T00:11:00Z'),
+    ])
+    assert [match['user'] for match in rule.matches] == ['alice']
+
+
+def test_rule_same_subnet(session_rule, make_event):
+    rule = session_rule('source.ip', condition='same_subnet', prefix_length=16)
+    rule.add_data([
+        make_event(0, event='login', user='alice', source={'ip': '10.1.0.1'}),
+        make_event(1, event='login', user='bob', source={'ip': '10.1.0.1'}),
+        make_event(2, event='transfer', user='alice', source={'ip': '10.1.200.7'}),
+        make_event(3, event='transfer', user='bob', source={'ip': '10.2.0.1'}),
+    ])
+    assert [match['user'] for match in rule.matches] == ['alice']
+
+
+@pytest.mark.parametrize('comparison, error', [
+    ({'condition': 'roughly_equal'}, "Unknown condition 'roughly_equal'"),
+    ({'condition': 'time_within'}, 'requires a duration'),
+    ({'condition': 'time_apart', 'duration': {'fortnights': 2}}, 'requires a duration'),
+    ({'condition': 'time_apart', 'duration': 300}, 'requires a duration'),
+    ({'condition': 'same_subnet', 'prefix_length': 33}, 'prefix_length of compare_fields source.ip must be between'),
+    ({'condition': 'same_subnet', 'prefix_length': True}, 'prefix_length'),
+    ({'condition': 'different_subnet', 'ipv6_prefix_length': 129}, 'ipv6_prefix_length'),
+    ({'to': None}, 'require a field and a to'),
+    ({'to': 'logout'}, 'which no earlier position captures'),
+])
+def test_invalid_comparison(session_rule, comparison, error):
+    with pytest.raises(EAException, match='Invalid correlated_events.*%s' % error):
+        session_rule('source.ip', **comparison)
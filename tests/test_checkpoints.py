@@ -0,0 +1,85 @@
+"""
+Tests of checkpoints: a rule restarted from a checkpoint queries from the
+time of the checkpoint and finds the matches of an uninterrupted rule.
+"""
+import datetime
+import logging
+
+import pytest
+
+pytest.importorskip('msgpack')
+
+
+@pytest.fixture
+def login_rule(make_rule, tmp_path):
+    """
+    Returns a function building a rule matching a failure then a success of
+    a user, which checkpoints to the same file, at most once an hour.
+    """
+    def build(**options):
+        options = dict({'query_key': 'user', 'checkpoint_file': str(tmp_path / 'rule.ckpt'),
+                        'checkpoint_interval': 3600}, **options)
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'result', 'value': 'success'},
+        ], **options)
+    return build
+
+
+@pytest.fixture
+def login(make_event):
+    def build(seconds, result, user):
+        return make_event(seconds, _id='%s%d' % (user, seconds), result=result, user=user)
+    return build
+
+
+@pytest.fixture
+def runs(login):
+    # The sequence of alice spans the checkpoint, written after the first run,
+    # the one of bob starts after it
+    return [
+        [login(0, 'failure', 'alice'), login(1, 'failure', 'carol'), login(2, 'success', 'carol')],
+        [login(3, 'success', 'alice'), login(4, 'failure', 'bob')],
+        [login(5, 'success', 'bob'), login(6, 'failure', 'carol'), login(7, 'success', 'carol')],
+    ]
+
+
+def query(runs, starttime):
+    """
+    Returns the events of the runs ElastAlert2 would return for a query
+    starting at starttime, which includes it as the buffer time overlaps.
+    """
+    return [event for run in runs for event in run if event['@timestamp'] >= starttime]
+
+
+def match_ids(matches):
+    return [match['_id'] for match in matches]
+
+
+def test_restarted_rule_matches_uninterrupted_rule(login_rule, runs, run_batches, tmp_path):
+    expected = match_ids(run_batches(login_rule(checkpoint_file=None), runs))
+
+    rule = login_rule()
+    matches = match_ids(run_batches(rule, runs))
+    assert matches == expected
+    # Only the first run was checkpointed: the rule restarts from there
+    first_run_matches = expected[:1]
+
+    restarted = login_rule()
+    checkpoint_time = max(event['@timestamp'] for event in runs[0])
+    assert restarted.rules['starttime'] == checkpoint_time
+    assert restarted.rules['previous_endtime'] == checkpoint_time
+    run_batches(restarted, [query(runs, restarted.rules['starttime'])])
+    assert first_run_matches + match_ids(restarted.matches) == expected
+
+
+def test_gap_after_checkpoint_is_logged(login_rule, runs, run_batches, t0, caplog):
+    run_batches(login_rule(), runs[:1])
+    restarted = login_rule()
+    restarted.rules['original_starttime'] = t0 + datetime.timedelta(seconds=10)
+    with caplog.at_level(logging.WARNING, logger='elastalert'):
+        restarted.add_data(query(runs, restarted.rules['original_starttime']))
+        restarted.add_data([])
+    warnings = [record for record in caplog.records if 'missed' in record.getMessage()]
+    assert len(warnings) == 1
+    assert '0:00:08' in warnings[0].getMessage()
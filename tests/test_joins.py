@@ -0,0 +1,142 @@
+"""
+Tests of field comparisons as joins on the sequence being built: whenever
+a chain of events passes the comparisons with its own captures, the matcher
+completes a sequence, which an exhaustive search of the chains confirms.
+"""
+import operator
+import random
+
+import pytest
+
+from elastalert_modules.sequence import SequenceMatcher
+
+# Conditions of the random joins, besides equal
+TESTS = (operator.ne, operator.gt, operator.lt)
+
+
+def random_matcher_options(rng, num_positions):
+    """
+    Returns random captures and comparisons, in the SequenceMatcher layout:
+    each position but the last may capture one of the two values of its
+    events into its own slot, and each position but the first may compare
+    one value of its events with the slots captured before it.
+    """
+    captures = [()] * num_positions
+    equal_joins = [()] * num_positions
+    joins = [()] * num_positions
+    for position in range(num_positions - 1):
+        if rng.random() < 0.7:
+            captures[position] = ((position, rng.randrange(2)),)
+    for position in range(1, num_positions):
+        slots = [slot for slot in range(position) if captures[slot]]
+        for slot in rng.sample(slots, min(len(slots), rng.randint(0, 2))):
+            if rng.random() < 0.5:
+                equal_joins[position] += ((slot, rng.randrange(2)),)
+            else:
+                joins[position] += ((slot, rng.randrange(2), rng.choice(TESTS)),)
+    return {'num_slots': num_positions, 'captures': captures, 'equal_joins': equal_joins, 'joins': joins}
+
+
+def random_events(rng, num_positions, num_events):
+    """
+    Returns random (positions, values) events: each event matches one or two
+    positions, and has two values out of three.
+    """
+    events = []
+    for _ in range(num_events):
+        positions = sorted(rng.sample(range(num_positions), rng.choice([1, 1, 2])))
+        events.append((positions, (rng.randrange(3), rng.randrange(3))))
+    return events
+
+
+def passes(options, position, values, captured):
+    for slot, value_index in options['equal_joins'][position]:
+        if values[value_index] != captured[slot]:
+            return False
+    for slot, value_index, test in options['joins'][position]:
+        if not test(values[value_index], captured[slot]):
+            return False
+    return True
+
+
+def valid_chain(options, events, chain):
+    """
+    Returns whether the events at the given ordinals, one per position in
+    increasing order, match their positions and pass the comparisons with
+    the values captured by the chain.
+    """
+    captured = [None] * options['num_slots']
+    for position, ordinal in enumerate(chain):
+        positions, values = events[ordinal]
+        if position not in positions or not passes(options, position, values, captured):
+            return False
+        for slot, value_index in options['captures'][position]:
+            captured[slot] = values[value_index]
+    return all(earlier < later for earlier, later in zip(chain, chain[1:]))
+
+
+def find_chain(options, events, num_positions, first_ordinal=0):
+    """
+    Returns whether a chain of events starting at or after first_ordinal
+    completes all the positions, by trying every event for every position.
+    """
+    def search(position, start, captured):
+        if position == num_positions:
+            return True
+        for ordinal in range(start, len(events)):
+            positions, values = events[ordinal]
+            if position in positions and passes(options, position, values, captured):
+                extended = list(captured)
+                for slot, value_index in options['captures'][position]:
+                    extended[slot] = values[value_index]
+                if search(position + 1, ordinal + 1, extended):
+                    return True
+        return False
+    return search(0, first_ordinal, [None] * options['num_slots'])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matcher_finds_every_chain(seed):
+    rng = random.Random(seed)
+    found = 0
+    for _ in range(1000):
+        num_positions = rng.randint(2, 4)
+        options = random_matcher_options(rng, num_positions)
+        events = random_events(rng, num_positions, rng.randint(0, 10))
+        matcher = SequenceMatcher(num_positions, track_events=True, **options)
+        for ordinal, (positions, values) in enumerate(events):
+            matcher.feed(ordinal, positions, values)
+        first_ordinal = rng.randint(0, len(events))
+        matcher.expire(first_ordinal)
+
+        expected = find_chain(options, events, num_positions, first_ordinal)
+        assert (matcher.count() > 0) == expected, (options, events, first_ordinal)
+        completed = matcher.completed()
+        assert all(valid_chain(options, events, sequence[2]) for sequence in completed)
+        # A start completes at most once
+        assert len(set(sequence[0] for sequence in completed)) == len(completed)
+        found += expected
+    assert found > 100
+
+
+def test_later_comparison_with_capture_of_extending_event(make_rule, make_event):
+    """
+    The success from US must extend the failure even though the success
+    from AU extended it first: only its session is used next.
+    """
+    rule = make_rule([
+        {'position': 1, 'key': 'event', 'value': 'login_fail', 'capture_fields': [{'field': 'country', 'as': 'c1'}]},
+        {'position': 2, 'key': 'event', 'value': 'login_ok',
+         'compare_fields': [{'field': 'country', 'to': 'c1', 'condition': 'not_equal'}],
+         'capture_fields': [{'field': 'session', 'as': 's2'}]},
+        {'position': 3, 'key': 'event', 'value': 'sensitive',
+         'compare_fields': [{'field': 'session', 'to': 's2', 'condition': 'equal'}]},
+    ], attach_related=True, related_events='sequences')
+    rule.add_data([
+        make_event(0, event='login_fail', country='NZ'),
+        make_event(1, event='login_ok', country='AU', session='s1'),
+        make_event(2, event='login_ok', country='US', session='s2'),
+        make_event(3, event='sensitive', session='s2'),
+    ])
+    assert len(rule.matches) == 1
+    assert [event.get('country') for event in rule.matches[0]['related_events']] == ['NZ', 'US']
@@ -0,0 +1,112 @@
+"""
+Tests of the memory bounds: max_keys evicts the least recently updated
+query_key, max_events_per_key drops the oldest events of a query_key,
+max_memory_mb evicts query_keys until the estimate is within the limit, and
+the evictions are counted.
+"""
+import logging
+
+import pytest
+from elastalert.util import EAException
+
+
+@pytest.fixture
+def login_rule(make_rule):
+    """
+    Returns a function building a rule matching a failure then a success of
+    a user.
+    """
+    def build(**options):
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'result', 'value': 'success'},
+        ], query_key='user', **options)
+    return build
+
+
+@pytest.fixture
+def login(make_event):
+    def build(seconds, result, user):
+        return make_event(seconds, _id='%s%d' % (user, seconds), result=result, user=user)
+    return build
+
+
+def test_max_keys_evicts_least_recently_updated_key(login_rule, login):
+    rule = login_rule(max_keys=2)
+    rule.add_data([login(0, 'failure', 'alice'), login(1, 'failure', 'bob'), login(2, 'failure', 'alice')])
+    assert list(rule.occurrences) == ['bob', 'alice']
+    # carol evicts bob, updated before alice
+    rule.add_data([login(3, 'failure', 'carol')])
+    assert list(rule.occurrences) == ['alice', 'carol']
+    assert (rule.evicted_keys, rule.evicted_events) == (1, 1)
+    # The sequence of bob was evicted with him, that of alice completes
+    rule.add_data([login(4, 'success', 'alice'), login(5, 'success', 'bob')])
+    assert [match['_id'] for match in rule.matches] == ['alice4']
+    assert list(rule.occurrences) == ['carol', 'bob']
+    assert (rule.evicted_keys, rule.evicted_events) == (1, 1)
+    assert rule.correlation_states.keys() == rule.occurrences.keys()
+
+
+def test_max_events_per_key_drops_oldest_events(login_rule, login, run_batches):
+    events = [login(0, 'failure', 'alice'), login(1, 'success', 'bob'), login(2, 'success', 'bob'),
+              login(3, 'failure', 'bob'), login(4, 'success', 'bob'), login(5, 'success', 'alice')]
+    assert len(run_batches(login_rule(), [events])) == 2
+
+    rule = login_rule(max_events_per_key=3)
+    rule.add_data([dict(event) for event in events[:4]])
+    assert rule.occurrences['bob'].count() == 3
+    assert rule.num_events == 4
+    assert (rule.evicted_keys, rule.evicted_events) == (0, 0)
+    # The first success of bob is dropped, the failure before his last one
+    # is kept
+    rule.add_data([dict(event) for event in events[4:]])
+    assert [match['_id'] for match in rule.matches] == ['bob4', 'alice5']
+    assert (rule.evicted_keys, rule.evicted_events) == (0, 1)
+
+
+def test_max_memory_mb_evicts_keys_until_within_limit(login_rule, login):
+    max_memory_mb = 0.01
+    rule = login_rule(max_memory_mb=max_memory_mb)
+    users = ['user%d' % index for index in range(10)]
+    for seconds, user in enumerate(users):
+        rule.add_data([login(seconds, 'failure', user)])
+        assert rule.estimate_memory() <= max_memory_mb * 1024 * 1024
+        # The most recently updated query_key is kept, the others in order
+        assert list(rule.occurrences)[-1] == user
+        assert list(rule.occurrences) == users[seconds + 1 - len(rule.occurrences):seconds + 1]
+    assert 1 < len(rule.occurrences) < len(users)
+    assert rule.evicted_keys == len(users) - len(rule.occurrences)
+    assert rule.evicted_events == rule.evicted_keys
+
+
+def test_max_memory_mb_keeps_most_recent_key(login_rule, login):
+    # The limit is below the overhead of a single query_key
+    rule = login_rule(max_memory_mb=0.001)
+    rule.add_data([login(0, 'failure', 'alice'), login(1, 'failure', 'bob')])
+    assert list(rule.occurrences) == ['bob']
+    rule.add_data([login(2, 'failure', 'bob'), login(3, 'success', 'bob')])
+    assert [match['_id'] for match in rule.matches] == ['bob3']
+
+
+def test_eviction_counters(login_rule, login, caplog):
+    rule = login_rule(max_keys=1, max_events_per_key=1)
+    with caplog.at_level(logging.WARNING, logger='elastalert'):
+        rule.add_data([login(0, 'failure', 'alice'), login(1, 'failure', 'alice'), login(2, 'failure', 'bob')])
+        rule.add_data([login(3, 'failure', 'bob')])
+        rule.add_data([login(4, 'other', 'bob'), login(5, 'failure', 'carol')])
+    metrics = rule.get_metrics()
+    assert (metrics['keys_evicted'], metrics['events_evicted']) == (rule.evicted_keys, rule.evicted_events) == (2, 4)
+    assert (metrics['keys'], metrics['events']) == (1, 1)
+    warnings = [record.getMessage() for record in caplog.records if 'evicted' in record.getMessage()]
+    assert len(warnings) == 3
+    assert 'evicted 1 query_key values and 2 events' in warnings[0]
+    assert 'evicted 0 query_key values and 1 events' in warnings[1]
+    assert 'evicted 1 query_key values and 1 events' in warnings[2]
+    assert '(2 and 4 since it was loaded)' in warnings[2]
+
+
+@pytest.mark.parametrize('option, value', [('max_keys', 0), ('max_events_per_key', -1), ('max_memory_mb', 'a lot'),
+                                           ('max_keys', True)])
+def test_invalid_limit(login_rule, option, value):
+    with pytest.raises(EAException, match='Invalid %s' % option):
+        login_rule(**{option: value})
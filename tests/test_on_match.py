@@ -0,0 +1,116 @@
+"""
+Tests of what a match does to the state of its query_key: on_match: reset
+drops it, on_match: consume only removes the events of the completed
+sequences, and match_cooldown holds the matches of a query_key back without
+touching its state.
+"""
+import datetime
+
+import pytest
+from elastalert.util import EAException
+
+
+@pytest.fixture
+def login_rule(make_rule):
+    """
+    Returns a function building a rule matching a failure then a success of
+    a user, with the _id of the events of the sequences attached.
+    """
+    def build(**options):
+        options = dict({'query_key': 'user', 'attach_related': True, 'related_events': 'ids'}, **options)
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'result', 'value': 'success'},
+        ], **options)
+    return build
+
+
+@pytest.fixture
+def login(make_event):
+    def build(seconds, result, user='alice'):
+        return make_event(seconds, _id='%s%d' % (user, seconds), result=result, user=user)
+    return build
+
+
+def match_ids(rule):
+    return [(match['_id'], match['related_events']) for match in rule.matches]
+
+
+def test_reset_drops_partial_sequences(login_rule, login, run_batches):
+    rule = login_rule()
+    run_batches(rule, [[login(0, 'failure'), login(1, 'failure'), login(2, 'success'), login(3, 'success')]])
+    assert match_ids(rule) == [('alice2', ['alice1'])]
+    # Only the success after the match is left, the failure before it was
+    # dropped
+    assert rule.occurrences['alice'].count() == 1
+
+
+def test_consume_keeps_partial_sequences(login_rule, login, run_batches):
+    rule = login_rule(on_match='consume')
+    run_batches(rule, [[login(0, 'failure'), login(1, 'failure'), login(2, 'success'), login(3, 'success')]])
+    assert match_ids(rule) == [('alice2', ['alice1']), ('alice3', ['alice0'])]
+    # Every event was consumed, which drops the query_key
+    assert 'alice' not in rule.occurrences
+    assert rule.num_events == 0
+
+
+def test_consumed_events_are_not_matched_again(login_rule, login, run_batches):
+    rule = login_rule(on_match='consume')
+    run_batches(rule, [[login(0, 'failure'), login(1, 'success'), login(2, 'other'), login(3, 'success')],
+                       [login(4, 'success')]])
+    assert match_ids(rule) == [('alice1', ['alice0'])]
+    assert rule.occurrences['alice'].count() == 2
+
+
+@pytest.mark.parametrize('on_match, matched', [('reset', ['alice2']), ('consume', ['alice2', 'alice4'])])
+def test_aggregations_count_consumed_events(make_rule, login, run_batches, on_match, matched):
+    rule = make_rule([
+        {'position': 1, 'type': 'aggregation', 'query': 'result:failure', 'aggregation_type': 'count',
+         'aggregation_field': 'result', 'aggregation_count': 2},
+        {'position': 2, 'key': 'result', 'value': 'success'},
+    ], query_key='user', on_match=on_match)
+    run_batches(rule, [[login(0, 'failure'), login(1, 'failure'), login(2, 'success'), login(3, 'failure'),
+                        login(4, 'success')]])
+    # With consume, the failures of the first match still count towards the
+    # second one
+    assert [match['_id'] for match in rule.matches] == matched
+
+
+@pytest.mark.parametrize('on_match', ['reset', 'consume'])
+def test_cooldown_holds_matches_back_until_over(login_rule, login, run_batches, on_match):
+    rule = login_rule(on_match=on_match, match_cooldown={'minutes': 2})
+    run_batches(rule, [
+        [login(0, 'failure'), login(1, 'success')],
+        # Within the cooldown: the sequence completes but does not match
+        [login(30, 'failure'), login(31, 'success'), login(35, 'failure', 'bob'), login(36, 'success', 'bob')],
+        # The cooldown is over with the first event of alice 2 minutes after
+        # the match
+        [login(100, 'other'), login(121, 'failure'), login(200, 'failure', 'bob')],
+    ])
+    assert match_ids(rule) == [('alice1', ['alice0']), ('bob36', ['bob35']),
+                               ('alice121', ['alice30', 'alice31'])]
+
+
+def test_cooldown_is_in_event_time(login_rule, login, run_batches):
+    # Querying the same range again, or replaying it, gives the same matches
+    batches = [[login(seconds, result) for seconds, result in enumerate(['failure', 'success'] * 100)]]
+    expected = [match['_id'] for match in run_batches(login_rule(match_cooldown={'seconds': 50}), batches)]
+    assert expected == ['alice1', 'alice51', 'alice101', 'alice151']
+    rule = login_rule(match_cooldown={'seconds': 50})
+    run_batches(rule, [batch[:100] for batch in batches])
+    run_batches(rule, [batch[100:] for batch in batches])
+    assert [match['_id'] for match in rule.matches] == expected
+
+
+@pytest.mark.parametrize('options, error', [
+    ({'on_match': 'drop'}, 'Invalid on_match'),
+    ({'match_cooldown': {'fortnights': 1}}, 'Invalid match_cooldown'),
+    ({'match_cooldown': 'PT5M'}, 'Invalid match_cooldown'),
+])
+def test_invalid_options(login_rule, options, error):
+    with pytest.raises(EAException, match=error):
+        login_rule(**options)
+
+
+def test_cooldown_option_accepts_timedelta(login_rule):
+    assert login_rule(match_cooldown=datetime.timedelta(minutes=1)).match_cooldown == 60 * 10 ** 6
@@ -0,0 +1,148 @@
+"""
+Tests of the Elasticsearch push-down: push_down_filter adds the pre-filter
+of the rule to its filter, which keeps every event the rule can match, and
+limit_source_fields restricts include to the fields the rule reads.
+"""
+import fnmatch
+import operator
+import random
+
+import pytest
+from elastalert.util import lookup_es_key
+
+from elastalert_modules.rule_group import CorrelationRuleGroup
+
+# Correlated events reading key fields, captures, comparisons and a query
+# with each kind of clause
+CORRELATED_EVENTS = [
+    {'position': 1, 'key': 'result', 'value': 'failure', 'capture_fields': [{'field': 'country', 'as': 'country'}]},
+    {'position': 2, 'key': 'result', 'value': 'success',
+     'compare_fields': [{'field': 'country', 'to': 'country', 'condition': 'not_equal'}]},
+    {'position': 3, 'type': 'aggregation', 'query': 'code:(1 OR 2) AND NOT host:web-* AND bytes:>=10 AND tag:*',
+     'aggregation_type': 'cardinality', 'aggregation_field': 'code', 'aggregation_count': 2},
+]
+
+
+def es_match(query, event):
+    """
+    Returns whether an event matches a query DSL clause, for the clauses
+    get_push_down_filter builds, on keyword and numeric fields.
+    """
+    (kind, body), = query.items()
+    if kind == 'bool':
+        if not all(es_match(clause, event) for clause in body.get('filter', [])):
+            return False
+        if any(es_match(clause, event) for clause in body.get('must_not', [])):
+            return False
+        should = body.get('should', [])
+        return sum(es_match(clause, event) for clause in should) >= body.get('minimum_should_match', 0)
+    if kind == 'exists':
+        return lookup_es_key(event, body['field']) is not None
+    (field, condition), = body.items()
+    value = lookup_es_key(event, field)
+    if value is None:
+        return False
+    if kind == 'term':
+        return str(value) == str(condition)
+    if kind == 'terms':
+        return str(value) in [str(term) for term in condition]
+    if kind == 'wildcard':
+        return fnmatch.fnmatchcase(str(value), condition['value'])
+    if kind == 'range':
+        tests = {'gte': operator.ge, 'gt': operator.gt, 'lte': operator.le, 'lt': operator.lt}
+        return all(tests[bound](value, limit) for bound, limit in condition.items())
+    raise ValueError('Unexpected clause %r' % (query,))
+
+
+@pytest.fixture
+def logins(make_event):
+    rng = random.Random(0)
+    events = []
+    for seconds in range(300):
+        event = make_event(seconds, _id=str(seconds), user=rng.choice(['alice', 'bob']),
+                           result=rng.choice(['failure', 'success', 'other']), country=rng.choice(['NZ', 'US']),
+                           code=rng.choice([1, 2, 3]), host=rng.choice(['web-1', 'db-1']), bytes=rng.randint(0, 20))
+        if rng.random() < 0.5:
+            event['tag'] = 'x'
+        events.append(event)
+    return events
+
+
+def test_push_down_filter(make_rule):
+    rule = make_rule(CORRELATED_EVENTS, push_down_filter=True, filter=[{'term': {'event.kind': 'event'}}])
+    assert rule.rules['filter'] == [
+        {'term': {'event.kind': 'event'}},
+        {'bool': {'should': [
+            {'terms': {'result': ['failure', 'success']}},
+            {'bool': {'filter': [
+                {'terms': {'code': ['1', '2']}},
+                {'bool': {'must_not': [{'wildcard': {'host': {'value': 'web-*'}}}]}},
+                {'range': {'bytes': {'gte': 10.0}}},
+                {'exists': {'field': 'tag'}},
+            ]}},
+        ], 'minimum_should_match': 1}},
+    ]
+
+
+def test_push_down_filter_single_and_repeated_values(make_rule):
+    rule = make_rule([
+        {'position': 1, 'key': 'result', 'value': 'failure'},
+        {'position': 2, 'key': 'result', 'value': 'failure'},
+        {'position': 3, 'key': 'action', 'value': 'delete'},
+    ], push_down_filter=True)
+    assert rule.rules['filter'] == [{'bool': {'should': [
+        {'term': {'action': 'delete'}},
+        {'term': {'result': 'failure'}},
+    ], 'minimum_should_match': 1}}]
+
+
+def test_no_push_down_by_default(make_rule):
+    rule = make_rule(CORRELATED_EVENTS, query_key='user')
+    assert 'filter' not in rule.rules
+    assert 'include' not in rule.rules
+
+
+def test_push_down_filter_keeps_matched_events(make_rule, logins, run_batches):
+    options = {'query_key': 'user', 'attach_related': True, 'related_events': 'sequences', 'on_match': 'consume'}
+    expected = run_batches(make_rule(CORRELATED_EVENTS, **options), [logins])
+    rule = make_rule(CORRELATED_EVENTS, push_down_filter=True, **options)
+    queried = [event for event in logins if all(es_match(query, event) for query in rule.rules['filter'])]
+    assert len(queried) < len(logins)
+    # The filter drops exactly the events without a candidate position
+    assert [event['_id'] for event in queried] == [
+        event['_id'] for event in logins if rule.get_candidate_positions(
+            tuple([accessor(event) for accessor in rule.field_accessors]))]
+    assert run_batches(rule, [queried]) == expected
+    assert len(expected) > 5
+
+
+@pytest.mark.parametrize('options, include', [
+    ({}, ['@timestamp', 'bytes', 'code', 'country', 'host', 'result', 'tag', 'user']),
+    ({'include': ['*', 'message']}, ['@timestamp', 'bytes', 'code', 'country', 'host', 'message', 'result', 'tag',
+                                     'user']),
+    ({'query_key': 'user.name,host', 'compound_query_key': ['user.name', 'host']},
+     ['@timestamp', 'bytes', 'code', 'country', 'host', 'result', 'tag', 'user.name']),
+])
+def test_limit_source_fields(make_rule, options, include):
+    options = dict({'query_key': 'user'}, **options)
+    rule = make_rule(CORRELATED_EVENTS, limit_source_fields=True, **options)
+    assert rule.rules['include'] == include
+
+
+def test_group_push_down(rule_options):
+    correlation_rules = [
+        {'name': 'Failed Login', 'correlated_events': CORRELATED_EVENTS},
+        {'name': 'Deletions', 'query_key': 'actor', 'correlated_events': [
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'action', 'value': 'delete'},
+        ]},
+    ]
+    group = CorrelationRuleGroup(rule_options(None, name='Logins', query_key='user', push_down_filter=True,
+                                              limit_source_fields=True, correlation_rules=correlation_rules))
+    # The clauses of both rules, without duplicates
+    should = group.rules['filter'][0]['bool']['should']
+    assert should[0] == {'terms': {'result': ['failure', 'success']}}
+    assert should[2:] == [{'term': {'action': 'delete'}}, {'term': {'result': 'failure'}}]
+    assert len(should) == 4
+    assert group.rules['include'] == ['@timestamp', 'action', 'actor', 'bytes', 'code', 'country', 'host', 'result',
+                                      'tag', 'user']
@@ -0,0 +1,114 @@
+"""
+Tests of the query parser: each construct of the supported Lucene syntax
+compiles to the expected predicate, with Lucene's precedence, and malformed
+queries are refused.
+"""
+import pytest
+
+from elastalert_modules.query import QuerySyntaxError, compile_query
+
+
+@pytest.mark.parametrize('query, predicate', [
+    # Terms, phrases and escapes
+    ('status:failed', "Term('status', 'failed')"),
+    ('auth.status:failed', "Term('auth.status', 'failed')"),
+    ('operationName:"Sign-in activity"', "Term('operationName', 'Sign-in activity')"),
+    (r'message:"say \"hi\""', "Term('message', 'say \"hi\"')"),
+    (r'path:a\:b', "Term('path', 'a:b')"),
+    ('temperature:-5', "Term('temperature', '-5')"),
+    # Boolean operators and their symbols
+    ('a:1 AND b:2', "And([Term('a', '1'), Term('b', '2')])"),
+    ('a:1 && b:2', "And([Term('a', '1'), Term('b', '2')])"),
+    ('a:1 OR b:2', "Or([Term('a', '1'), Term('b', '2')])"),
+    ('a:1 || b:2', "Or([Term('a', '1'), Term('b', '2')])"),
+    ('a:1 b:2', "Or([Term('a', '1'), Term('b', '2')])"),
+    ('NOT a:1', "Not(Term('a', '1'))"),
+    ('!a:1', "Not(Term('a', '1'))"),
+    ('a:1 OR a:2', "Terms('a', ['1', '2'])"),
+    # Required and prohibited clauses
+    ('-a:1', "Not(Term('a', '1'))"),
+    ('+a:1', "Term('a', '1')"),
+    ('a:1 NOT b:2', "And([Term('a', '1'), Not(Term('b', '2'))])"),
+    ('a:1 -b:2', "And([Term('a', '1'), Not(Term('b', '2'))])"),
+    ('+a:1 b:2', "Term('a', '1')"),
+    ('+a:1 +b:2 -c:3', "And([Term('a', '1'), Term('b', '2'), Not(Term('c', '3'))])"),
+    # Parentheses, around clauses and around the values of a field
+    ('(a:1 OR b:2) AND c:3', "And([Or([Term('a', '1'), Term('b', '2')]), Term('c', '3')])"),
+    ('a:(1 OR 2 OR 3)', "Terms('a', ['1', '2', '3'])"),
+    ('a:(1 2)', "Terms('a', ['1', '2'])"),
+    ('a:(1 AND 2)', "And([Term('a', '1'), Term('a', '2')])"),
+    ('a:(1 2 -3)', "And([Terms('a', ['1', '2']), Not(Term('a', '3'))])"),
+    ('a:("x y" OR z*)', "Or([Term('a', 'x y'), Wildcard('a', 'z*')])"),
+    # Ranges
+    ('a:[1 TO 5]', "Range('a', 1.0, 5.0, True, True)"),
+    ('a:{1 TO 5}', "Range('a', 1.0, 5.0, False, False)"),
+    ('a:[1 TO 5}', "Range('a', 1.0, 5.0, True, False)"),
+    ('a:{1 TO *]', "Range('a', 1.0, None, False, True)"),
+    ('a:[-5 TO 5]', "Range('a', -5.0, 5.0, True, True)"),
+    ('a:[a TO m]', "Range('a', 'a', 'm', True, True)"),
+    ('a:>3', "Range('a', 3.0, None, False, True)"),
+    ('a:>=3', "Range('a', 3.0, None, True, True)"),
+    ('a:<3', "Range('a', None, 3.0, True, False)"),
+    ('a:<=3', "Range('a', None, 3.0, True, True)"),
+    # Wildcards and existence
+    ('host:web-*', "Wildcard('host', 'web-*')"),
+    ('host:w?b', "Wildcard('host', 'w?b')"),
+    ('host:*', "Exists('host')"),
+    (r'host:web\*', "Term('host', 'web*')"),
+])
+def test_parse(query, predicate):
+    assert repr(compile_query(query)) == predicate
+
+
+@pytest.mark.parametrize('query, predicate', [
+    # NOT binds tighter than AND, which binds tighter than OR
+    ('a:1 OR b:2 AND c:3', "Or([Term('a', '1'), And([Term('b', '2'), Term('c', '3')])])"),
+    ('a:1 AND b:2 OR c:3', "Or([Term('c', '3'), And([Term('a', '1'), Term('b', '2')])])"),
+    ('NOT a:1 AND b:2', "And([Not(Term('a', '1')), Term('b', '2')])"),
+    ('a:1 || b:2 && !c:3', "Or([Term('a', '1'), And([Term('b', '2'), Not(Term('c', '3'))])])"),
+    ('NOT (a:1 OR b:2)', "Not(Or([Term('a', '1'), Term('b', '2')]))"),
+    ('NOT NOT a:1', "Not(Not(Term('a', '1')))"),
+])
+def test_precedence(query, predicate):
+    assert repr(compile_query(query)) == predicate
+
+
+@pytest.mark.parametrize('query, event, matched', [
+    ('a:1 OR b:2 AND c:3', {'a': 1}, True),
+    ('a:1 OR b:2 AND c:3', {'b': 2}, False),
+    ('a:1 NOT b:2', {'a': 1, 'b': 2}, False),
+    ('a:1 NOT b:2', {'a': 1, 'b': 3}, True),
+    ('-a:1', {}, True),
+    ('a:[1 TO 5}', {'a': 5}, False),
+    ('a:[1 TO 5}', {'a': '4.5'}, True),
+    ('a:>3', {'a': 'many'}, False),
+    ('host:web-*', {'host': ['db-1', 'web-1']}, True),
+    ('host:w?b', {'host': 'web-1'}, False),
+    ('host:*', {'host': None}, False),
+    ('enabled:True', {'enabled': True}, True),
+    ('enabled:true', {'enabled': True}, False),
+])
+def test_match(query, event, matched):
+    assert compile_query(query)(event) == matched
+
+
+@pytest.mark.parametrize('query, error', [
+    ('', 'Empty query'),
+    ('status', "Expected field:value, got 'status'"),
+    (':x', "Expected field:value, got ':'"),
+    ('a:', 'Unexpected end'),
+    ('a:1 AND', 'Unexpected end'),
+    ('a:1 OR AND b:2', "Expected field:value, got 'AND'"),
+    ('(a:1', 'Unexpected end'),
+    ('a:1)', "Unexpected '\\)'"),
+    ('a:(1 OR 2', 'Unexpected end'),
+    ('a:"x', 'Unterminated quoted phrase'),
+    ('a:[1 5]', 'Expected TO in range'),
+    ('a:[1 TO 5', 'Unexpected end'),
+    ('a:[1 TO 5)', 'Missing \\] or }'),
+    ('a:[( TO 5]', "Expected range bound, got '\\('"),
+    ('a:>', 'Unexpected end'),
+])
+def test_malformed_query(query, error):
+    with pytest.raises(QuerySyntaxError, match=error):
+        compile_query(query)
@@ -0,0 +1,87 @@
+"""
+Tests of rule groups: the rules of a group find the matches they find when
+each runs its own query, whatever their query_key.
+"""
+import pytest
+
+from elastalert_modules.custom_rule_types import CorrelationRule
+from elastalert_modules.rule_group import MATCH_KEY_FIELD, CorrelationRuleGroup
+
+
+def load_query_key(rules):
+    """
+    Converts a list query_key as the ElastAlert2 loader does, for the rules
+    it loads.
+    """
+    query_key = rules.get('query_key')
+    if isinstance(query_key, list):
+        if len(query_key) > 1:
+            rules['compound_query_key'] = query_key
+            rules['query_key'] = ','.join(query_key)
+        elif query_key:
+            rules['query_key'] = query_key[0]
+        else:
+            del rules['query_key']
+    return rules
+
+
+def query(rule, events):
+    """
+    Returns copies of the events as ElastAlert2 passes them to a rule, with
+    the value of a compound_query_key written to its query_key field.
+    """
+    events = [dict(event) for event in events]
+    if 'compound_query_key' in rule.rules:
+        for event in events:
+            values = [event.get(field) for field in rule.rules['compound_query_key']]
+            event[rule.rules['query_key']] = ', '.join([str(value) for value in values])
+    return events
+
+
+@pytest.fixture
+def rule_configs():
+    return [
+        {'name': 'Failed Login', 'correlated_events': [
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'result', 'value': 'success'},
+        ]},
+        {'name': 'Repeated Failures', 'num_events': 2, 'correlated_events': [
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+        ]},
+    ]
+
+
+@pytest.fixture
+def logins(make_event):
+    events = []
+    for seconds, (result, user, host) in enumerate([
+            ('failure', 'alice', 'h1'), ('success', 'alice', 'h2'), ('failure', 'alice', 'h2'),
+            ('failure', 'bob', 'h1'), ('success', 'alice', 'h2'), ('failure', 'bob', 'h2'),
+            ('success', 'bob', 'h1'), ('failure', 'alice', 'h1')]):
+        events.append(make_event(seconds, _id='%s%d' % (user, seconds), result=result, user=user, host=host))
+    return events
+
+
+@pytest.mark.parametrize('query_key, rule_query_keys', [
+    (['user', 'host'], [None, None]),
+    (['user', 'host'], [None, 'user']),
+    ('user', [['user', 'host'], None]),
+    (['user'], [None, ['host']]),
+])
+def test_group_matches_are_rule_matches(rule_options, rule_configs, logins, query_key, rule_query_keys):
+    for config, rule_query_key in zip(rule_configs, rule_query_keys):
+        if rule_query_key:
+            config['query_key'] = rule_query_key
+    group = CorrelationRuleGroup(load_query_key(rule_options(None, name='Logins', query_key=query_key,
+                                                             correlation_rules=rule_configs)))
+    group.add_data(query(group, logins))
+
+    for config in rule_configs:
+        options = dict({'query_key': query_key}, **config)
+        rule = CorrelationRule(load_query_key(rule_options(options.pop('correlated_events'), **options)))
+        rule.add_data(query(rule, logins))
+        group_matches = [match for match in group.matches if match['correlation_rule'] == config['name']]
+        assert [match['_id'] for match in group_matches] == [match['_id'] for match in rule.matches]
+        assert [match[MATCH_KEY_FIELD] for match in group_matches] == [
+            '%s.%s' % (config['name'], match[rule.rules['query_key']]) for match in rule.matches]
+        assert rule.matches
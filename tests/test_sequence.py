@@ -0,0 +1,129 @@
+"""
+Differential tests of the streaming SequenceMatcher against the algorithm it
+replaced, CorrelationRule.get_num_correlations as it was before the matcher:
+on random lists of event indices, both must count the same sequences.
+"""
+import collections
+import copy
+import random
+
+import pytest
+
+from elastalert_modules.sequence import SequenceMatcher, count_sequences
+
+
+def reference_num_correlations(correlated_indices):
+    """
+    The original get_num_correlations, which rescans the lists for every
+    sequence it finds.
+    """
+    # Deep copy the passed in list of lists, to avoid modifying it
+    positions_list = copy.deepcopy(correlated_indices)
+    num_matches = 0
+    for positions in positions_list:
+        positions.sort()
+    initial_positions_len = len(positions_list[0])
+    for i in range(initial_positions_len):
+        matching_positions = []
+        if len(positions_list[0]) > 0:
+            previous_position = positions_list[0][0]
+            matching_positions.append(positions_list[0][0])
+            for positions in positions_list[1:]:
+                valid_sequence = False
+                for position in positions:
+                    if position > previous_position:
+                        valid_sequence = True
+                        previous_position = position
+                        matching_positions.append(position)
+                        break
+                    else:
+                        continue
+            if valid_sequence:
+                num_matches += 1
+                for i, position in enumerate(matching_positions):
+                    del positions_list[i][positions_list[i].index(position)]
+            else:
+                return num_matches
+    return num_matches
+
+
+def reference_or_none(correlated_indices):
+    """
+    Returns the count of the original algorithm, or None for the lists it
+    fails on: when a sequence breaks off at a middle position but a later
+    one matches, it removes the indices from the wrong lists.
+    """
+    try:
+        return reference_num_correlations(correlated_indices)
+    except ValueError:
+        return None
+
+
+def random_indices(rng, max_positions=5, max_events=25):
+    """
+    Returns random lists of event indices, one per position. An event can
+    match several positions.
+    """
+    num_events = rng.randint(0, max_events)
+    return [rng.sample(range(num_events), rng.randint(0, num_events))
+            for _ in range(rng.randint(2, max_positions))]
+
+
+def positions_by_index(correlated_indices):
+    positions = collections.defaultdict(list)
+    for position, indices in enumerate(correlated_indices):
+        for index in indices:
+            positions[index].append(position)
+    return positions
+
+
+@pytest.mark.parametrize('correlated_indices, expected', [
+    ([[2, 4], [1, 5], [0, 3]], 0),
+    ([[0, 5], [2, 10], [3, 11]], 2),
+    ([[0, 5], [2, 10], [1, 7]], 1),
+])
+def test_count_sequences_examples(correlated_indices, expected):
+    assert count_sequences(correlated_indices) == expected
+    assert reference_num_correlations(correlated_indices) == expected
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_count_sequences_matches_reference(seed):
+    rng = random.Random(seed)
+    compared = 0
+    for _ in range(2000):
+        correlated_indices = random_indices(rng)
+        expected = reference_or_none(correlated_indices)
+        if expected is None:
+            continue
+        assert count_sequences(correlated_indices) == expected, correlated_indices
+        compared += 1
+    assert compared > 1000
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matcher_after_expiry_matches_reference(seed):
+    """
+    After events expire, the matcher counts the sequences the original
+    algorithm finds in the remaining events, whenever the expiries happen.
+    """
+    rng = random.Random(seed)
+    compared = 0
+    for _ in range(2000):
+        correlated_indices = random_indices(rng)
+        num_events = max([index + 1 for indices in correlated_indices for index in indices] or [0])
+        first_index = rng.randint(0, num_events)
+        matcher = SequenceMatcher(len(correlated_indices))
+        positions = positions_by_index(correlated_indices)
+        for index in sorted(positions):
+            matcher.feed(index, positions[index])
+            if rng.random() < 0.2:
+                matcher.expire(min(first_index, index))
+        matcher.expire(first_index)
+        remaining = [[index for index in indices if index >= first_index] for indices in correlated_indices]
+        expected = reference_or_none(remaining)
+        if expected is None:
+            continue
+        assert matcher.count() == expected, (correlated_indices, first_index)
+        compared += 1
+    assert compared > 1000
@@ -0,0 +1,99 @@
+"""
+Tests of sharded rules: the workers get stand-ins of the documents, the
+matches are the documents the in-process rule returns, and a worker that
+dies is replaced.
+"""
+import datetime
+import os
+import signal
+
+import pytest
+
+from elastalert_modules.custom_rule_types import SHARD_REF
+
+
+@pytest.fixture
+def login_rule(make_rule):
+    """
+    Returns a function building a rule matching a failure then a success of
+    a user, with the _id of the failure attached.
+    """
+    def build(**options):
+        options = dict({'query_key': 'user', 'attach_related': True, 'related_events': 'ids'}, **options)
+        return make_rule([
+            {'position': 1, 'key': 'result', 'value': 'failure'},
+            {'position': 2, 'key': 'result', 'value': 'success'},
+        ], **options)
+    return build
+
+
+@pytest.fixture
+def sharded_rule(login_rule):
+    rule = login_rule(workers=2)
+    yield rule
+    rule.shards.shutdown()
+
+
+@pytest.fixture
+def login(make_event):
+    def build(seconds, result, user):
+        return make_event(seconds, _id='%s%d' % (user, seconds), result=result, user=user, message='x' * 100)
+    return build
+
+
+@pytest.fixture
+def runs(login):
+    return [
+        [login(0, 'failure', 'alice'), login(1, 'other', 'alice'), login(2, 'failure', 'bob'),
+         login(2, 'success', 'erin')],
+        # The failures of carol and erin arrive after their success, which is
+        # the match, sent to the workers in the same run for carol and in the
+        # previous one for erin
+        [login(3, 'success', 'alice'), login(5, 'success', 'carol'), login(4, 'failure', 'carol'),
+         login(1, 'failure', 'erin')],
+        [login(6, 'success', 'bob'), login(7, 'failure', 'carol'), login(8, 'success', 'carol')],
+    ]
+
+
+def sorted_matches(matches):
+    return sorted(matches, key=lambda match: match['_id'])
+
+
+@pytest.mark.parametrize('options', [{}, {'related_events': 'sequences'}, {'on_match': 'consume'}])
+def test_sharded_matches_are_in_process_matches(login_rule, runs, run_batches, options):
+    expected = sorted_matches(run_batches(login_rule(**options), runs))
+    rule = login_rule(workers=2, **options)
+    try:
+        matches = sorted_matches(run_batches(rule, runs))
+    finally:
+        rule.shards.shutdown()
+    assert matches == expected
+    assert matches and all(SHARD_REF not in match and match['message'] for match in matches)
+
+
+def test_sharded_metrics_count_filtered_events(sharded_rule, runs, run_batches):
+    run_batches(sharded_rule, runs)
+    metrics = sharded_rule.get_metrics()
+    assert metrics['events_ingested'] == 11
+    assert metrics['events_filtered'] == 1
+    assert metrics['matches'] == 5
+
+
+def test_documents_of_expired_windows_are_dropped(sharded_rule, runs, run_batches, t0):
+    run_batches(sharded_rule, runs[:1])
+    assert len(sharded_rule.shard_documents) == 3
+    sharded_rule.garbage_collect(t0 + datetime.timedelta(hours=1))
+    assert sharded_rule.shard_documents == {}
+    assert sharded_rule.shard_newest == {}
+
+
+def test_dead_worker_is_restarted(sharded_rule, runs, run_batches):
+    run_batches(sharded_rule, runs[:1])
+    for executor in sharded_rule.shards.executors:
+        for process in list(executor._processes.values()):
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+    # The events of the first run are lost with the workers, the events of
+    # carol are both in the second one
+    run_batches(sharded_rule, runs[1:2])
+    assert [match['_id'] for match in sharded_rule.matches] == ['carol5']